@@ -3,14 +3,22 @@ import os
 import csv
 from io import StringIO # 導入 StringIO 用於處理處理 CSV 數據
 # 修正導入：將 send_response 替換為 send_file
-from flask import render_template, request, redirect, url_for, flash, Blueprint, current_app, send_file # 導入 send_file
+from flask import render_template, request, redirect, url_for, flash, Blueprint, current_app, send_file, jsonify, Response # 導入 send_file
 from flask_login import login_required, current_user
 from werkzeug.security import generate_password_hash, check_password_hash
 from werkzeug.utils import secure_filename
 # 導入 config 以使用 UPLOAD_FOLDER 和 allowed_file
 import config
 from app.__init__ import get_db # 導入資料庫連接函式
+from app.cache import invalidate_user, shared_cache # 導入使用者快取失效函式與共用快取
+from app.db import get_pool, acquire_connection, release_connection
+from app.kiosk import invalidate_card_index, kiosk_status # 刷卡登記使用的卡號索引
+from app.class_catalog import class_catalog, get_classes, invalidate_class_catalog # 進程內的班級目錄
+from app.csv_import import CSVImportError, start_import_job, commit_preview_job, get_job # CSV 匯入 (背景執行，可查詢進度)
 from app.models import User # 導入 User 模型
+from app.models import COMPETITION_RESULTS # 共用的參賽結果定義
+from app.models import SUMMARY_ALL_TERMS, AWARD_PUNISH_SUMMARY_COLUMNS, COMPETITION_SUMMARY_COLUMNS # 學生統計摘要
+from app.models import bump_data_versions # 讀取頁面 ETag 使用的資料版本
 # 修正導入方式，確保從 app.forms 導入所有需要的表單類
 from app.forms import (
     AddUserForm, EditUserForm, AddStudentForm, EditStudentForm,
@@ -22,6 +30,82 @@ from datetime import datetime # 導入 datetime 模組
 from functools import wraps
 
 
+# 學生列表可排序的欄位 (查詢參數 sort 的值 -> ORDER BY 欄位)
+STUDENT_SORT_COLUMNS = {
+    'class': ['c.class_name', 's.student_number', 's.name'],
+    'student_number': ['s.student_number', 's.name'],
+    'name': ['s.name'],
+    'late_count': ['s.late_count'],
+    'incomplete_homework_count': ['s.incomplete_homework_count'],
+    'violation_points': ['s.violation_points'],
+    'award_points': ['s.award_points'],
+}
+
+# 學生 CSV 匯出中獎懲類型欄位的順序 (先懲罰後獎勵)
+EXPORT_AP_TYPES = ['警告', '缺點', '小過', '大過', '表揚', '優點', '小功', '大功']
+
+# 使用者 CSV 匯出：所有使用者數據，包括分配的班級名稱
+USERS_EXPORT_SQL = """
+    SELECT u.user_id, u.username, u.role, u.teacher_name, u.id_card_number,
+           GROUP_CONCAT(c.class_name ORDER BY c.class_name SEPARATOR ', ') AS assigned_class_names
+    FROM users u
+    LEFT JOIN teacher_classes tc ON u.user_id = tc.user_id
+    LEFT JOIN classes c ON tc.class_id = c.class_id
+    GROUP BY u.user_id
+    ORDER BY u.role, u.username
+"""
+
+
+def build_manage_students_queries(class_id, sort, direction, limit, offset):
+    """
+    管理學生列表的查詢：返回 ((計數語句, 參數), (當前頁語句, 參數))，flask db explain 也使用這個函式。
+    sort 必須是 STUDENT_SORT_COLUMNS 的鍵 (白名單，避免 SQL 注入)，direction 為 'asc' 或 'desc'。
+    """
+    where_sql = "WHERE s.class_id = %s" if class_id else ""
+    where_params = (class_id,) if class_id else ()
+    order_sql = ", ".join(f"{column} {direction.upper()}" for column in STUDENT_SORT_COLUMNS[sort])
+    # 缺席總節數和參賽記錄計數從 student_summary 的全部學期行讀取 (每個學生一次主鍵查找)
+    comp_columns = ", ".join(f"COALESCE(ss.{column}, 0) AS `comp_count_{comp_result}`"
+                             for comp_result, column in COMPETITION_SUMMARY_COLUMNS.items())
+    page_sql = f"""
+        SELECT s.student_id, s.student_number, s.name, c.class_name,
+               s.late_count, s.incomplete_homework_count, s.violation_points, s.award_points,
+               s.id_card_number, s.student_id_number, -- 新增獲取 ID 卡號碼和學生證號碼
+               COALESCE(ss.absence_sessions, 0) AS total_absences_sessions, {comp_columns}
+        FROM students s
+        JOIN classes c ON s.class_id = c.class_id
+        LEFT JOIN student_summary ss ON ss.student_id = s.student_id AND ss.term = %s
+        {where_sql}
+        ORDER BY {order_sql}, s.student_id
+        LIMIT %s OFFSET %s
+    """
+    return ((f"SELECT COUNT(*) AS total FROM students s {where_sql}", where_params),
+            (page_sql, (SUMMARY_ALL_TERMS, *where_params, limit, offset)))
+
+
+def build_students_export_query():
+    """
+    學生 CSV 匯出的查詢語句與參數 (flask db explain 也使用這個函式)：一次查詢取得所有學生資料、班級名稱和統計數據。
+    缺席節數、各獎懲類型和各參賽結果的次數從 student_summary 的全部學期行讀取，
+    不需要在匯出時掃描記錄表分組計算，結果可以直接從游標串流輸出。
+    """
+    ap_columns = ", ".join(f"COALESCE(ss.{AWARD_PUNISH_SUMMARY_COLUMNS[ap_type]}, 0) AS ap_{i}"
+                           for i, ap_type in enumerate(EXPORT_AP_TYPES))
+    comp_columns = ", ".join(f"COALESCE(ss.{COMPETITION_SUMMARY_COLUMNS[comp_result]}, 0) AS comp_{i}"
+                             for i, comp_result in enumerate(COMPETITION_RESULTS))
+    sql = f"""
+        SELECT s.student_id, s.student_number, s.name, c.class_name,
+               s.late_count, s.incomplete_homework_count, s.violation_points, s.award_points,
+               s.id_card_number, s.student_id_number,
+               COALESCE(ss.absence_sessions, 0) AS total_sessions, {ap_columns}, {comp_columns}
+        FROM students s
+        JOIN classes c ON s.class_id = c.class_id
+        LEFT JOIN student_summary ss ON ss.student_id = s.student_id AND ss.term = %s
+        ORDER BY c.class_name, s.student_number, s.name
+    """
+    return sql, (SUMMARY_ALL_TERMS,)
+
+
 # 定義管理員藍圖
 bp = Blueprint('admin', __name__, url_prefix='/admin') # 將藍圖命名為 bp 以符合註冊習慣
 
@@ -38,6 +122,59 @@ def admin_required(f):
     return decorated_function
 
 
+# --- CSV 串流匯出工具 ---
+def _close_stream(conn, cursor):
+    """關閉串流匯出使用的游標並將連接歸還到連接池"""
+    try:
+        if cursor is not None:
+            cursor.close()
+    except mysql.connector.Error:
+        pass
+    release_connection(conn)
+
+
+def _csv_stream_response(conn, cursor, headers, make_row, filename, log_label):
+    """
+    將已執行查詢的伺服器端游標以 CSV 串流輸出。
+    每次 fetchmany() CSV_EXPORT_CHUNK_SIZE 行並立即送出，記憶體用量與總行數無關；
+    串流結束時結束快照事務並歸還連接。生成器沒有開始執行時 (HEAD 請求、送出第一批數據前客戶端中斷、
+    視圖返回後發生錯誤) 關閉生成器不會執行其 finally，因此同時以 response.call_on_close() 註冊歸還，
+    兩處呼叫同一個只執行一次的 close()。
+    """
+    logger = current_app.logger # 生成器在請求上下文外執行，先取得 logger
+    closed = []
+
+    def close():
+        if not closed:
+            closed.append(True)
+            _close_stream(conn, cursor)
+
+    def generate():
+        si = StringIO()
+        cw = csv.writer(si)
+        try:
+            cw.writerow(headers)
+            yield si.getvalue() # 立即送出表頭，瀏覽器可以馬上開始下載
+            while True:
+                rows = cursor.fetchmany(config.CSV_EXPORT_CHUNK_SIZE)
+                if not rows:
+                    break
+                si.seek(0)
+                si.truncate(0)
+                cw.writerows(make_row(row) for row in rows)
+                yield si.getvalue()
+        except mysql.connector.Error as err:
+            # 回應已開始傳送，無法再重定向，只能記錄錯誤並中止 (客戶端會收到不完整的文件)
+            logger.error(f"資料庫錯誤 ({log_label}，串流中斷): {err}")
+        finally:
+            close()
+
+    response = Response(generate(), mimetype='text/csv')
+    response.headers['Content-Disposition'] = f'attachment; filename={filename}'
+    response.call_on_close(close)
+    return response
+
+
 # --- 管理員儀表板 ---
 @bp.route('/')
 @login_required
@@ -88,23 +225,16 @@ def add_user():
     """新增使用者帳號"""
     form = AddUserForm()
 
-    conn = get_db()
     classes = [] # 用於儲存所有班級列表
     # assigned_class_ids 用於在表單驗證失敗時保留已選中的班級
     assigned_class_ids = []
 
-    if conn:
-        cursor = conn.cursor(dictionary=True)
-        try:
-            # 獲取所有班級列表供分配
-            cursor.execute("SELECT class_id, class_name FROM classes ORDER BY class_name")
-            classes = cursor.fetchall()
-        except mysql.connector.Error as err:
-            flash(f"資料庫錯誤: {err}", 'danger')
-            current_app.logger.error(f"資料庫錯誤 (新增使用者 - 獲取班級): {err}")
-        finally:
-            # 這裡不關閉連接，因為 POST 請求時還會用到
-            pass # 保持連接開啟，直到請求結束或在 POST 處理中關閉
+    try:
+        # 獲取所有班級列表供分配 (班級目錄)
+        classes = get_classes()
+    except mysql.connector.Error as err:
+        flash(f"資料庫錯誤: {err}", 'danger')
+        current_app.logger.error(f"資料庫錯誤 (新增使用者 - 獲取班級): {err}")
 
 
     if form.validate_on_submit():
@@ -122,7 +252,8 @@ def add_user():
         # 雜湊密碼
         hashed_password = generate_password_hash(password)
 
-        if conn: # 使用上面開啟的連接
+        conn = get_db()
+        if conn:
             cursor = conn.cursor()
             try:
                 # 檢查使用者名稱是否已存在
@@ -197,9 +328,8 @@ def edit_user(user_id):
                      conn.close()
                 return redirect(url_for('admin.manage_users'))
 
-            # 獲取所有班級列表供分配
-            cursor.execute("SELECT class_id, class_name FROM classes ORDER BY class_name")
-            classes = cursor.fetchall()
+            # 獲取所有班級列表供分配 (班級目錄)
+            classes = get_classes()
 
             # 獲取該使用者已分配的班級 ID
             cursor.execute("SELECT class_id FROM teacher_classes WHERE user_id = %s", (user_id,))
@@ -274,7 +404,9 @@ def edit_user(user_id):
                     user_class_data = [(user_id, class_id) for class_id in new_assigned_class_ids]
                     cursor.executemany("INSERT INTO teacher_classes (user_id, class_id) VALUES (%s, %s)", user_class_data)
 
+                bump_data_versions(cursor, user_ids=[user_id]) # 記錄時間線顯示記錄人姓名；班級權限的快取
                 conn.commit() # 提交所有更改 (使用者資料更新和班級關聯更新)
+                invalidate_user(user_id) # 讓該使用者的快取立即失效
                 flash(f'使用者 "{user_data["username"]}" 已成功更新', 'success')
                 return redirect(url_for('admin.manage_users'))
             except mysql.connector.Error as err:
@@ -318,7 +450,9 @@ def delete_user(user_id):
             # 這裡保持 RESTRICT 約束，要求先刪除使用者記錄的所有事項才能刪除使用者。
 
             cursor.execute("DELETE FROM users WHERE user_id = %s", (user_id,))
+            bump_data_versions(cursor, user_ids=[user_id])
             conn.commit()
+            invalidate_user(user_id) # 被刪除的使用者不能再從快取中載入
             flash('使用者已成功刪除', 'success')
         except mysql.connector.IntegrityError as err:
              # 捕獲外鍵約束錯誤
@@ -341,78 +475,43 @@ def delete_user(user_id):
 @login_required
 @admin_required
 def export_users_csv():
-    """匯出使用者帳號為 CSV 文件"""
-    conn = get_db()
-    if not conn:
+    """匯出使用者帳號為 CSV 文件 (串流輸出)"""
+    try:
+        conn = acquire_connection() # 獨立連接，串流結束時才歸還
+    except mysql.connector.Error as err:
         flash('無法連接到資料庫，無法匯出使用者數據', 'danger')
+        current_app.logger.error(f"資料庫錯誤 (匯出使用者 CSV): {err}")
         return redirect(url_for('admin.manage_users'))
 
+    cursor = None
     try:
-        cursor = conn.cursor(dictionary=True)
+        # 在一致性快照的唯讀事務中執行查詢，確保整個文件對應同一時間點的數據
+        conn.start_transaction(consistent_snapshot=True, isolation_level='REPEATABLE READ', readonly=True)
+        cursor = conn.cursor(dictionary=True, buffered=False) # 伺服器端游標，逐批讀取
         # 獲取所有使用者數據，包括分配的班級名稱
-        cursor.execute("""
-            SELECT u.user_id, u.username, u.role, u.teacher_name, u.id_card_number,
-                   GROUP_CONCAT(c.class_name ORDER BY c.class_name SEPARATOR ', ') AS assigned_class_names
-            FROM users u
-            LEFT JOIN teacher_classes tc ON u.user_id = tc.user_id
-            LEFT JOIN classes c ON tc.class_id = c.class_id
-            GROUP BY u.user_id
-            ORDER BY u.role, u.username
-        """)
-        users = cursor.fetchall()
-
-        # 使用 StringIO 在記憶體中構建 CSV 數據
-        si = StringIO()
-        cw = csv.writer(si)
-
-        # 寫入 CSV 表頭
-        # 根據您希望匯出的欄位來定義表頭
-        headers = ['使用者ID', '使用者名稱', '角色', '教師姓名', 'ID卡號碼', '分配班級']
-        cw.writerow(headers)
-
-        # 寫入使用者數據
-        for user in users:
-            # 確保每個欄位都是字串或可以轉換為字串
-            row = [
-                user.get('user_id', ''),
-                user.get('username', ''),
-                user.get('role', ''),
-                user.get('teacher_name', ''),
-                user.get('id_card_number', ''),
-                user.get('assigned_class_names', '') # 已合併的班級名稱
-            ]
-            cw.writerow(row)
-
-        # 獲取 CSV 數據
-        output = si.getvalue()
-
-        # 使用 send_file 發送 CSV 文件
-        # 需要將 StringIO 對象轉換為文件對象，或者直接傳遞 StringIO 對象 (Flask 1.0+ 支持)
-        # 或者將數據寫入臨時文件再發送
-        # 最簡單的方式是使用 BytesIO 或 StringIO 並設置 mimetype
-        from io import BytesIO
-        buffer = BytesIO(output.encode('utf-8'))
-        buffer.seek(0) # 將文件指針移到開頭
-
-        # 修正：使用 send_file
-        return send_file(buffer,
-                         mimetype='text/csv',
-                         as_attachment=True,
-                         download_name='users_export.csv')
-
-
+        cursor.execute(USERS_EXPORT_SQL)
     except mysql.connector.Error as err:
         flash(f"資料庫錯誤，無法匯出使用者數據: {err}", 'danger')
         current_app.logger.error(f"資料庫錯誤 (匯出使用者 CSV): {err}")
-    except Exception as e:
-        flash(f"匯出使用者數據時發生錯誤: {e}", 'danger')
-        current_app.logger.error(f"匯出使用者 CSV 時發生錯誤: {e}")
-    finally:
-        if conn and conn.is_connected():
-             cursor.close()
-             conn.close()
+        _close_stream(conn, cursor)
+        return redirect(url_for('admin.manage_users')) # 匯出失敗時重定向
+
+    # 寫入 CSV 表頭
+    # 根據您希望匯出的欄位來定義表頭
+    headers = ['使用者ID', '使用者名稱', '角色', '教師姓名', 'ID卡號碼', '分配班級']
+
+    def make_row(user):
+        # 確保每個欄位都是字串或可以轉換為字串
+        return [
+            user.get('user_id', ''),
+            user.get('username', ''),
+            user.get('role', ''),
+            user.get('teacher_name', ''),
+            user.get('id_card_number', ''),
+            user.get('assigned_class_names', '') # 已合併的班級名稱
+        ]
 
-    return redirect(url_for('admin.manage_users')) # 匯出失敗時重定向
+    return _csv_stream_response(conn, cursor, headers, make_row, 'users_export.csv', '匯出使用者 CSV')
 
 @bp.route('/users/import_csv', methods=['GET', 'POST'])
 @login_required
@@ -422,148 +521,28 @@ def import_users_csv():
     form = CSVUploadForm()
 
     if form.validate_on_submit():
-        csv_file = form.csv_file.data
-        # 確保文件存在且是允許的類型 (FileAllowed 驗證器已經檢查了擴展名)
-
+        # 上傳的文件先複製到暫存文件，然後在背景逐行讀取並分批寫入 (或只產生預覽)，請求立即返回進度頁面
         try:
-            # 使用 StringIO 從文件對象讀取 CSV 數據
-            stream = StringIO(csv_file.stream.read().decode("UTF8"))
-            csv_reader = csv.reader(stream)
-            header = next(csv_reader) # 跳過表頭行
-
-            # 根據您的 CSV 格式確定各欄位在 CSV 中的索引
-            # 這裡假設 CSV 欄位順序為：使用者名稱, 密碼, 角色, 教師姓名, ID卡號碼, 分配班級(以逗號分隔)
-            # 請根據實際 CSV 文件格式調整索引
-            try:
-                username_idx = header.index('使用者名稱')
-                password_idx = header.index('密碼')
-                role_idx = header.index('角色')
-                teacher_name_idx = header.index('教師姓名') if '教師姓名' in header else -1 # 可選欄位
-                id_card_number_idx = header.index('ID卡號碼') if 'ID卡號碼' in header else -1 # 可選欄位
-                assigned_classes_idx = header.index('分配班級') if '分配班級' in header else -1 # 可選欄位
-            except ValueError as e:
-                 flash(f"CSV 文件表頭格式不正確，缺少必要欄位: {e}", 'danger')
-                 return render_template('admin/import_csv.html', title='匯入使用者 (CSV)', form=form)
-
-
-            conn = get_db()
-            if not conn:
-                flash('無法連接到資料庫，無法匯入使用者數據', 'danger')
-                return render_template('admin/import_csv.html', title='匯入使用者 (CSV)', form=form)
-
-            cursor = conn.cursor()
-            imported_count = 0
-            updated_count = 0
-            errors = []
-
-            # 獲取所有班級的 class_name 到 class_id 的映射，以便處理分配班級
-            class_name_to_id = {}
-            try:
-                cursor.execute("SELECT class_id, class_name FROM classes")
-                for class_id, class_name in cursor.fetchall():
-                    class_name_to_id[class_name] = class_id
-            except mysql.connector.Error as err:
-                 flash(f"資料庫錯誤，無法獲取班級列表: {err}", 'danger')
-                 current_app.logger.error(f"資料庫錯誤 (匯入使用者 CSV - 獲取班級): {err}")
-                 if conn.is_connected(): cursor.close(); conn.close()
-                 return render_template('admin/import_csv.html', title='匯入使用者 (CSV)', form=form)
-
-
-            for row in csv_reader:
-                # 確保行數據長度足夠包含所有預期的欄位
-                if not row or len(row) < max(username_idx, password_idx, role_idx) + 1:
-                    errors.append(f"跳過無效行 (欄位不足): {row}")
-                    continue
-
-                try:
-                    username = row[username_idx].strip()
-                    password = row[password_idx].strip()
-                    role = row[role_idx].strip().lower() # 角色轉換為小寫
-                    teacher_name = row[teacher_name_idx].strip() if teacher_name_idx != -1 and len(row) > teacher_name_idx and row[teacher_name_idx].strip() else None
-                    id_card_number = row[id_card_number_idx].strip() if id_card_number_idx != -1 and len(row) > id_card_number_idx and row[id_card_number_idx].strip() else None
-                    assigned_classes_str = row[assigned_classes_idx].strip() if assigned_classes_idx != -1 and len(row) > assigned_classes_idx and row[assigned_classes_idx].strip() else ''
-
-
-                    # 驗證角色是否有效
-                    if role not in ['admin', 'supervisor', 'teacher']:
-                        errors.append(f"使用者 '{username}' 的角色無效: {row}")
-                        continue
-
-                    # 雜湊密碼
-                    hashed_password = generate_password_hash(password)
-
-                    # 檢查使用者名稱是否已存在
-                    cursor.execute("SELECT user_id FROM users WHERE username = %s", (username,))
-                    existing_user = cursor.fetchone()
-
-                    if existing_user:
-                        # 使用者已存在，更新
-                        user_id = existing_user[0]
-                        update_sql = "UPDATE users SET password_hash = %s, role = %s, teacher_name = %s, id_card_number = %s WHERE user_id = %s"
-                        update_params = (hashed_password, role, teacher_name, id_card_number, user_id)
-                        cursor.execute(update_sql, update_params)
-                        updated_count += 1
-
-                         # 處理班級分配更新 (先刪除舊的，再插入新的)
-                        cursor.execute("DELETE FROM teacher_classes WHERE user_id = %s", (user_id,))
-                        if role == 'teacher' and assigned_classes_str:
-                            assigned_class_names = [name.strip() for name in assigned_classes_str.split(',') if name.strip()]
-                            teacher_classes_values = []
-                            for class_name in assigned_class_names:
-                                if class_name in class_name_to_id:
-                                    teacher_classes_values.append((user_id, class_name_to_id[class_name]))
-                                else:
-                                    errors.append(f"使用者 '{username}' 分配的班級 '{class_name}' 不存在。")
-                            if teacher_classes_values:
-                                cursor.executemany("INSERT INTO teacher_classes (user_id, class_id) VALUES (%s, %s)", teacher_classes_values)
-
-                    else:
-                        # 使用者不存在，插入新使用者
-                        insert_sql = "INSERT INTO users (username, password_hash, role, teacher_name, id_card_number) VALUES (%s, %s, %s, %s, %s)"
-                        insert_params = (username, hashed_password, role, teacher_name, id_card_number)
-                        cursor.execute(insert_sql, insert_params)
-                        user_id = cursor.lastrowid # 獲取新插入使用者的 ID
-                        imported_count += 1
-
-                        # 如果是教師，處理班級分配
-                        if role == 'teacher' and assigned_classes_str:
-                            assigned_class_names = [name.strip() for name in assigned_classes_str.split(',') if name.strip()]
-                            teacher_classes_values = []
-                            for class_name in assigned_class_names:
-                                if class_name in class_name_to_id:
-                                    teacher_classes_values.append((user_id, class_name_to_id[class_name]))
-                                else:
-                                    errors.append(f"使用者 '{username}' 分配的班級 '{class_name}' 不存在。")
-                            if teacher_classes_values:
-                                cursor.executemany("INSERT INTO teacher_classes (user_id, class_id) VALUES (%s, %s)", teacher_classes_values)
-
-
-                except mysql.connector.IntegrityError as err:
-                    # 捕獲唯一性約束錯誤 (例如 ID 卡號碼重複)
-                    errors.append(f"使用者 '{username}' 數據無效 (唯一性衝突): {err}")
-                    current_app.logger.error(f"資料庫完整性錯誤 (匯入使用者 CSV): {err}")
-                except Exception as e:
-                    errors.append(f"處理使用者 '{username}' 數據時發生錯誤: {e}")
-                    current_app.logger.error(f"處理使用者 CSV 行時發生錯誤: {e}")
-
-            conn.commit() # 提交所有更改
-            flash(f'使用者數據匯入完成。新增 {imported_count} 筆，更新 {updated_count} 筆。', 'success')
-            if errors:
-                flash(f"匯入過程中發生以下錯誤: {'; '.join(errors)}", 'warning')
-
-        except Exception as e:
+            job = start_import_job('users', form.csv_file.data, current_user.id, dry_run=form.dry_run.data)
+        except CSVImportError as e:
+            flash(str(e), 'danger')
+        except (UnicodeDecodeError, csv.Error, OSError) as e:
             flash(f"讀取或處理 CSV 文件時發生錯誤: {e}", 'danger')
-            current_app.logger.error(f"讀取或處理使用者 CSV 文件時發生錯誤: {e}")
-        finally:
-            if conn and conn.is_connected():
-                 cursor.close()
-                 conn.close()
+            current_app.logger.error(f"讀取使用者 CSV 文件時發生錯誤: {e}")
+        else:
+            return redirect(url_for('admin.import_job', job_id=job.id))
 
+    # GET 請求或上傳失敗時渲染上傳表單
+    return render_template('admin/import_csv.html', title='匯入使用者 (CSV)', form=form, back_url=url_for('admin.manage_users'))
 
-        return redirect(url_for('admin.manage_users')) # 匯入完成後重定向
 
-    # GET 請求時渲染上傳表單
-    return render_template('admin/import_csv.html', title='匯入使用者 (CSV)', form=form)
+@bp.route('/cache_stats')
+@login_required
+@admin_required
+def cache_stats():
+    """返回使用者快取命中率、共用快取、連接池、刷卡登記佇列與班級目錄的狀態 (JSON)，供監控使用"""
+    return jsonify(db_pool=get_pool().status(), kiosk=kiosk_status(),
+                   class_catalog=class_catalog.status(), shared_cache=shared_cache.stats())
 
 
 # --- 學生管理 ---
@@ -571,39 +550,34 @@ def import_users_csv():
 @login_required
 @admin_required
 def manage_students():
-    """管理學生資料列表"""
+    """管理學生資料列表 (支援班級篩選、排序與分頁)"""
+    # 讀取查詢參數：班級篩選、排序欄位、排序方向與頁碼
+    class_id = request.args.get('class_id', type=int)
+    sort = request.args.get('sort', 'class')
+    if sort not in STUDENT_SORT_COLUMNS:
+        sort = 'class'
+    direction = 'desc' if request.args.get('dir') == 'desc' else 'asc'
+    page = max(request.args.get('page', 1, type=int), 1)
+    per_page = min(max(request.args.get('per_page', config.STUDENTS_PER_PAGE, type=int), 10), 200)
+
     conn = get_db()
     students = []
+    classes = []
+    total = 0
     if conn:
         cursor = conn.cursor(dictionary=True)
         try:
-            # 獲取所有學生列表及其班級名稱，並包含統計數據
-            cursor.execute("""
-                SELECT s.student_id, s.student_number, s.name, c.class_name,
-                       s.late_count, s.incomplete_homework_count, s.violation_points, s.award_points,
-                       s.id_card_number, s.student_id_number -- 新增獲取 ID 卡號碼和學生證號碼
-                FROM students s
-                JOIN classes c ON s.class_id = c.class_id
-                ORDER BY c.class_name, s.student_number, s.name
-            """)
-            students = cursor.fetchall()
+            # 獲取所有班級供篩選 (班級目錄)
+            classes = get_classes()
 
-            # TODO: 計算缺席總節數和參賽記錄計數 (這需要在獲取學生列表後進行額外查詢或在模板中處理)
-            # 這裡可以在後端為每個學生添加這些統計數據
-            for student in students:
-                 # 獲取缺席總節數
-                 cursor.execute("SELECT SUM(session_count) AS total_sessions FROM absences WHERE student_id = %s", (student['student_id'],))
-                 absence_summary = cursor.fetchone()
-                 student['total_absences_sessions'] = absence_summary['total_sessions'] if absence_summary and absence_summary['total_sessions'] is not None else 0
-
-                 # 獲取參賽記錄計數
-                 cursor.execute("SELECT result, COUNT(*) as count FROM competitions WHERE student_id = %s GROUP BY result", (student['student_id'],))
-                 comp_summary_list = cursor.fetchall()
-                 comp_summary = {item['result']: item['count'] for item in comp_summary_list}
-                 student['comp_count_參與'] = comp_summary.get('參與', 0)
-                 student['comp_count_入圍'] = comp_summary.get('入圍', 0)
-                 student['comp_count_得獎'] = comp_summary.get('得獎', 0)
+            count_query, page_query = build_manage_students_queries(class_id, sort, direction, per_page, (page - 1) * per_page)
+            # 計算符合條件的學生總數 (用於分頁)
+            cursor.execute(*count_query)
+            total = cursor.fetchone()['total']
 
+            # 只獲取當前頁的學生及其班級名稱
+            cursor.execute(*page_query)
+            students = cursor.fetchall()
 
         except mysql.connector.Error as err:
             flash(f"資料庫錯誤: {err}", 'danger')
@@ -613,8 +587,11 @@ def manage_students():
                  cursor.close()
                  conn.close()
 
-
-    return render_template('admin/manage_students.html', title='管理學生', students=students)
+    pages = max((total + per_page - 1) // per_page, 1)
+    return render_template('admin/manage_students.html', title='管理學生', students=students,
+                           classes=classes, class_id=class_id, sort=sort, direction=direction,
+                           page=page, pages=pages, per_page=per_page, total=total,
+                           comp_results=COMPETITION_RESULTS)
 
 @bp.route('/students/add', methods=['GET', 'POST'])
 @login_required
@@ -623,20 +600,13 @@ def add_student():
     """新增學生資料"""
     form = AddStudentForm()
 
-    conn = get_db()
-    classes_data = []
-    if conn:
-        cursor = conn.cursor(dictionary=True)
-        try:
-            # 獲取所有班級列表供選擇
-            cursor.execute("SELECT class_id, class_name FROM classes ORDER BY class_name")
-            classes_data = cursor.fetchall()
-            form.class_id.choices = [(c['class_id'], c['class_name']) for c in classes_data]
-        except mysql.connector.Error as err:
-            flash(f"資料庫錯誤: {err}", 'danger')
-            current_app.logger.error(f"資料庫錯誤 (新增學生 - 獲取班級): {err}")
-            if conn.is_connected(): cursor.close(); conn.close()
-            return render_template('admin/add_student.html', title='新增學生', form=form) # 發生錯誤時渲染表單
+    try:
+        # 獲取所有班級列表供選擇 (班級目錄)
+        form.class_id.choices = [(c['class_id'], c['class_name']) for c in get_classes()]
+    except mysql.connector.Error as err:
+        flash(f"資料庫錯誤: {err}", 'danger')
+        current_app.logger.error(f"資料庫錯誤 (新增學生 - 獲取班級): {err}")
+        return render_template('admin/add_student.html', title='新增學生', form=form) # 發生錯誤時渲染表單
 
 
     if form.validate_on_submit():
@@ -655,7 +625,9 @@ def add_student():
                     "INSERT INTO students (student_number, name, class_id, id_card_number, student_id_number) VALUES (%s, %s, %s, %s, %s)",
                     (student_number, name, class_id, id_card_number, student_id_number)
                 )
+                bump_data_versions(cursor, class_ids=[class_id])
                 conn.commit()
+                invalidate_card_index()
                 flash(f'學生 "{name}" 已成功新增', 'success')
                 return redirect(url_for('admin.manage_students'))
             except mysql.connector.Error as err:
@@ -694,9 +666,8 @@ def edit_student(student_id):
                 if conn.is_connected(): cursor.close(); conn.close()
                 return redirect(url_for('admin.manage_students'))
 
-            # 獲取所有班級列表供選擇
-            cursor.execute("SELECT class_id, class_name FROM classes ORDER BY class_name")
-            classes_data = cursor.fetchall()
+            # 獲取所有班級列表供選擇 (班級目錄)
+            classes_data = get_classes()
 
 
         except mysql.connector.Error as err:
@@ -743,7 +714,10 @@ def edit_student(student_id):
                     "UPDATE students SET student_number = %s, name = %s, class_id = %s, id_card_number = %s, student_id_number = %s WHERE student_id = %s",
                     (student_number, name, class_id, id_card_number, student_id_number, student_id)
                 )
+                # 學生、新班級與原來的班級 (轉班時) 的資料版本
+                bump_data_versions(cursor, student_ids=[student_id], class_ids=[student_data['class_id']])
                 conn.commit()
+                invalidate_card_index()
                 flash(f'學生 "{name}" 的資料已成功更新', 'success')
                 return redirect(url_for('admin.manage_students'))
             except mysql.connector.Error as err:
@@ -772,8 +746,11 @@ def delete_student(student_id):
         try:
             # 刪除學生
             # 由於記錄表格使用了 ON DELETE CASCADE，刪除學生時其相關記錄會自動刪除
+            # 刪除前遞增資料版本 (需要從學生行找到所屬班級)
+            bump_data_versions(cursor, student_ids=[student_id])
             cursor.execute("DELETE FROM students WHERE student_id = %s", (student_id,))
             conn.commit()
+            invalidate_card_index()
             flash('學生資料及其相關記錄已成功刪除', 'success')
         except mysql.connector.Error as err:
             conn.rollback()
@@ -792,129 +769,53 @@ def delete_student(student_id):
 @login_required
 @admin_required
 def export_students_csv():
-    """匯出學生資料為 CSV 文件"""
-    conn = get_db()
-    if not conn:
+    """匯出學生資料為 CSV 文件 (串流輸出)"""
+    try:
+        conn = acquire_connection() # 獨立連接，串流結束時才歸還
+    except mysql.connector.Error as err:
         flash('無法連接到資料庫，無法匯出學生數據', 'danger')
+        current_app.logger.error(f"資料庫錯誤 (匯出學生 CSV): {err}")
         return redirect(url_for('admin.manage_students'))
 
+    ap_types = EXPORT_AP_TYPES
+    cursor = None
     try:
-        cursor = conn.cursor(dictionary=True)
-        # 獲取所有學生資料，包括班級名稱和所有統計數據
-        cursor.execute("""
-            SELECT s.student_id, s.student_number, s.name, c.class_name,
-                   s.late_count, s.incomplete_homework_count, s.violation_points, s.award_points,
-                   s.id_card_number, s.student_id_number -- 新增獲取 ID 卡號碼和學生證號碼
-            FROM students s
-            JOIN classes c ON s.class_id = c.class_id
-            ORDER BY c.class_name, s.student_number, s.name
-        """)
-        students = cursor.fetchall()
-
-        # 獲取每個學生的詳細記錄以計算額外統計數據 (缺席總節數, 參賽計數)
-        for student in students:
-             # 獲取缺席總節數
-             cursor.execute("SELECT SUM(session_count) AS total_sessions FROM absences WHERE student_id = %s", (student['student_id'],))
-             absence_summary = cursor.fetchone()
-             student['total_absences_sessions'] = absence_summary['total_sessions'] if absence_summary and absence_summary['total_sessions'] is not None else 0
-
-             # 獲取獎懲記錄計數 (警告, 缺點, 小過, 大過, 表揚, 優點, 小功, 大功)
-             award_punish_counts = {}
-             cursor.execute("SELECT type, COUNT(*) as count FROM awards_punishments WHERE student_id = %s GROUP BY type", (student['student_id'],))
-             for row in cursor.fetchall():
-                  award_punish_counts[row['type']] = row['count']
-
-             student['award_punish_count_警告'] = award_punish_counts.get('警告', 0)
-             student['award_punish_count_缺點'] = award_punish_counts.get('缺點', 0)
-             student['award_punish_count_小過'] = award_punish_counts.get('小過', 0) # 修正這裡的鍵名
-             student['award_punish_count_大過'] = award_punish_counts.get('大過', 0) # 修正這裡的鍵名
-             student['award_punish_count_表揚'] = award_punish_counts.get('表揚', 0)
-             student['award_punish_count_優點'] = award_punish_counts.get('優點', 0)
-             student['award_punish_count_小功'] = award_punish_counts.get('小功', 0)
-             student['award_punish_count_大功'] = award_punish_counts.get('大功', 0)
-
-
-             # 獲取參賽記錄計數 (參與, 入圍, 得獎)
-             comp_counts = {}
-             cursor.execute("SELECT result, COUNT(*) as count FROM competitions WHERE student_id = %s GROUP BY result", (student['student_id'],))
-             for row in cursor.fetchall():
-                  comp_counts[row['result']] = row['count']
-
-             student['comp_count_參與'] = comp_counts.get('參與', 0)
-             student['comp_count_入圍'] = comp_counts.get('入圍', 0)
-             student['comp_count_得獎'] = comp_counts.get('得獎', 0)
-
-
-        # 使用 StringIO 在記憶體中構建 CSV 數據
-        si = StringIO()
-        cw = csv.writer(si)
-
-        # 寫入 CSV 表頭
-        headers = [
-            '學生ID', '學號', '姓名', '班級名稱', 'ID卡號碼', '學生證號碼', '總缺席節數', '總遲到次數', '總欠交功課次數',
-            '總違規點數', '總獎勵點數',
-            '獎懲_警告次數', '獎懲_缺點次數', '獎懲_小過次數', '獎懲_大過次數',
-            '獎懲_表揚次數', '獎懲_優點次數', '獎懲_小功次數', '獎懲_大功次數',
-            '參賽_參與次數', '參賽_入圍次數', '參賽_得獎次數'
-        ]
-        cw.writerow(headers)
-
-        # 寫入學生數據
-        for student in students:
-            row = [
-                student.get('student_id', ''),
-                student.get('student_number', ''),
-                student.get('name', ''),
-                student.get('class_name', ''),
-                student.get('id_card_number', ''), # 匯出 ID 卡號碼
-                student.get('student_id_number', ''), # 匯出 學生證號碼
-                student.get('total_absences_sessions', 0),
-                student.get('late_count', 0),
-                student.get('incomplete_homework_count', 0),
-                student.get('violation_points', 0),
-                student.get('award_points', 0),
-                student.get('award_punish_count_警告', 0),
-                student.get('award_punish_count_缺點', 0),
-                student.get('award_punish_count_小過', 0), # 修正這裡的鍵名
-                student.get('award_punish_count_大過', 0), # 修正這裡的鍵名
-                student.get('award_punish_count_表揚', 0),
-                student.get('award_punish_count_優點', 0),
-                student.get('award_punish_count_小功', 0),
-                student.get('award_punish_count_大功', 0),
-                student.get('comp_count_參與', 0),
-                student.get('comp_count_入圍', 0),
-                student.get('comp_count_得獎', 0)
-            ]
-            cw.writerow(row)
-
-        # 獲取 CSV 數據
-        output = si.getvalue()
-
-        # 使用 send_file 發送 CSV 文件
-        from io import BytesIO
-        buffer = BytesIO(output.encode('utf-8'))
-        buffer.seek(0) # 將文件指針移到開頭
-
-        # 修正：使用 send_file
-        return send_file(buffer,
-                         mimetype='text/csv',
-                         as_attachment=True,
-                         download_name='students_export.csv')
-
-
+        # 在一致性快照的唯讀事務中執行查詢，確保整個文件對應同一時間點的數據
+        conn.start_transaction(consistent_snapshot=True, isolation_level='REPEATABLE READ', readonly=True)
+        cursor = conn.cursor(dictionary=True, buffered=False) # 伺服器端游標，逐批讀取
+        cursor.execute(*build_students_export_query())
     except mysql.connector.Error as err:
         flash(f"資料庫錯誤，無法匯出學生數據: {err}", 'danger')
         current_app.logger.error(f"資料庫錯誤 (匯出學生 CSV): {err}")
-    except Exception as e:
-        flash(f"匯出學生數據時發生錯誤: {e}", 'danger')
-        current_app.logger.error(f"匯出學生 CSV 時發生錯誤: {e}")
-    finally:
-        if conn and conn.is_connected():
-             cursor.close()
-             conn.close()
-
-    return redirect(url_for('admin.manage_students')) # 匯出失敗時重定向
+        _close_stream(conn, cursor)
+        return redirect(url_for('admin.manage_students')) # 匯出失敗時重定向
+
+    # 寫入 CSV 表頭
+    headers = [
+        '學生ID', '學號', '姓名', '班級名稱', 'ID卡號碼', '學生證號碼', '總缺席節數', '總遲到次數', '總欠交功課次數',
+        '總違規點數', '總獎勵點數',
+        *[f'獎懲_{ap_type}次數' for ap_type in ap_types],
+        *[f'參賽_{comp_result}次數' for comp_result in COMPETITION_RESULTS]
+    ]
+
+    def make_row(student):
+        return [
+            student.get('student_id', ''),
+            student.get('student_number', ''),
+            student.get('name', ''),
+            student.get('class_name', ''),
+            student.get('id_card_number', ''), # 匯出 ID 卡號碼
+            student.get('student_id_number', ''), # 匯出 學生證號碼
+            int(student.get('total_sessions') or 0),
+            student.get('late_count', 0),
+            student.get('incomplete_homework_count', 0),
+            student.get('violation_points', 0),
+            student.get('award_points', 0),
+            *[int(student.get(f'ap_{i}') or 0) for i in range(len(ap_types))],
+            *[int(student.get(f'comp_{i}') or 0) for i in range(len(COMPETITION_RESULTS))]
+        ]
 
+    return _csv_stream_response(conn, cursor, headers, make_row, 'students_export.csv', '匯出學生 CSV')
 
 @bp.route('/students/import_csv', methods=['GET', 'POST'])
 @login_required
@@ -924,129 +825,72 @@ def import_students_csv():
     form = CSVUploadForm()
 
     if form.validate_on_submit():
-        csv_file = form.csv_file.data
-        # 確保文件存在且是允許的類型 (FileAllowed 驗證器已經檢查了擴展名)
-
+        # 上傳的文件先複製到暫存文件，然後在背景逐行讀取並分批寫入 (或只產生預覽)，請求立即返回進度頁面
         try:
-            # 使用 StringIO 從文件對象讀取 CSV 數據
-            stream = StringIO(csv_file.stream.read().decode("UTF8"))
-            csv_reader = csv.reader(stream)
-            header = next(csv_reader) # 跳過表頭行
-
-            # 根據您的 CSV 格式確定各欄位在 CSV 中的索引
-            # 這裡假設 CSV 欄位順序為：學號, 姓名, 班級名稱, ID卡號碼, 學生證號碼
-            # 請根據實際 CSV 文件格式調整索引
-            try:
-                student_number_idx = header.index('學號') if '學號' in header else -1
-                name_idx = header.index('姓名')
-                class_name_idx = header.index('班級名稱')
-                id_card_number_idx = header.index('ID卡號碼') if 'ID卡號碼' in header else -1
-                student_id_number_idx = header.index('學生證號碼') if '學生證號碼' in header else -1
-            except ValueError as e:
-                 flash(f"CSV 文件表頭格式不正確，缺少必要欄位 (姓名, 班級名稱): {e}", 'danger')
-                 return render_template('admin/import_csv.html', title='匯入學生 (CSV)', form=form)
-
-
-            conn = get_db()
-            if not conn:
-                flash('無法連接到資料庫，無法匯入學生數據', 'danger')
-                return render_template('admin/import_csv.html', title='匯入學生 (CSV)', form=form)
-
-            cursor = conn.cursor()
-            imported_count = 0
-            updated_count = 0
-            errors = []
-
-            # 獲取所有班級的 class_name 到 class_id 的映射
-            class_name_to_id = {}
-            try:
-                cursor.execute("SELECT class_id, class_name FROM classes")
-                for class_id, class_name in cursor.fetchall():
-                    class_name_to_id[class_name] = class_id
-            except mysql.connector.Error as err:
-                 flash(f"資料庫錯誤，無法獲取班級列表: {err}", 'danger')
-                 current_app.logger.error(f"資料庫錯誤 (匯入學生 CSV - 獲取班級): {err}")
-                 if conn.is_connected(): cursor.close(); conn.close()
-                 return render_template('admin/import_csv.html', title='匯入學生 (CSV)', form=form)
-
-
-            for row in csv_reader:
-                # 確保行數據長度足夠包含所有預期的欄位
-                if not row or len(row) < max(name_idx, class_name_idx) + 1:
-                    errors.append(f"跳過無效行 (欄位不足): {row}")
-                    continue
-
-                try:
-                    student_number = row[student_number_idx].strip() if student_number_idx != -1 and len(row) > student_number_idx and row[student_number_idx].strip() else None
-                    name = row[name_idx].strip()
-                    class_name = row[class_name_idx].strip()
-                    id_card_number = row[id_card_number_idx].strip() if id_card_number_idx != -1 and len(row) > id_card_number_idx and row[id_card_number_idx].strip() else None
-                    student_id_number = row[student_id_number_idx].strip() if student_id_number_idx != -1 and len(row) > student_id_number_idx and row[student_id_number_idx].strip() else None
-
-
-                    # 獲取班級 ID
-                    class_id = class_name_to_id.get(class_name)
-                    if class_id is None:
-                        errors.append(f"學生 '{name}' (學號: {student_number if student_number else 'N/A'}) 的班級 '{class_name}' 不存在。")
-                        continue
-
-                    # 檢查學生是否已存在 (根據學號和姓名，或者其他唯一標識)
-                    # 這裡假設根據學號和姓名組合來判斷是否為同一學生
-                    # 更嚴謹的做法可能是根據 ID 卡號碼或學生證號碼等唯一識別碼
-                    # 這裡使用學號作為主要判斷依據，如果學號存在，則更新；如果學號不存在但姓名和班級組合存在，也可以考慮更新
-                    existing_student_id = None
-                    if student_number:
-                         cursor.execute("SELECT student_id FROM students WHERE student_number = %s", (student_number,))
-                         result = cursor.fetchone()
-                         if result:
-                              existing_student_id = result[0]
-                    # 如果沒有學號，嘗試根據姓名和班級判斷 (可能不夠準確)
-                    # else:
-                    #      cursor.execute("SELECT student_id FROM students WHERE name = %s AND class_id = %s", (name, class_id))
-                    #      result = cursor.fetchone()
-                    #      if result:
-                    #           existing_student_id = result[0]
-
-
-                    if existing_student_id:
-                        # 學生已存在，更新
-                        update_sql = "UPDATE students SET name = %s, class_id = %s, id_card_number = %s, student_id_number = %s WHERE student_id = %s"
-                        update_params = (name, class_id, id_card_number, student_id_number, existing_student_id)
-                        cursor.execute(update_sql, update_params)
-                        updated_count += 1
-                    else:
-                        # 學生不存在，插入新學生
-                        insert_sql = "INSERT INTO students (student_number, name, class_id, id_card_number, student_id_number) VALUES (%s, %s, %s, %s, %s)"
-                        insert_params = (student_number, name, class_id, id_card_number, student_id_number)
-                        cursor.execute(insert_sql, insert_params)
-                        imported_count += 1
-
-                except mysql.connector.IntegrityError as err:
-                    # 捕獲唯一性約束錯誤 (例如 ID 卡號碼或學生證號碼重複)
-                    errors.append(f"學生 '{name}' (學號: {student_number if student_number else 'N/A'}) 數據無效 (唯一性衝突): {err}")
-                    current_app.logger.error(f"資料庫完整性錯誤 (匯入學生 CSV): {err}")
-                except Exception as e:
-                    errors.append(f"處理學生 '{name}' (學號: {student_number if student_number else 'N/A'}) 數據時發生錯誤: {e}")
-                    current_app.logger.error(f"處理學生 CSV 行時發生錯誤: {e}")
-
-            conn.commit() # 提交所有更改
-            flash(f'學生數據匯入完成。新增 {imported_count} 筆，更新 {updated_count} 筆。', 'success')
-            if errors:
-                flash(f"匯入過程中發生以下錯誤: {'; '.join(errors)}", 'warning')
-
-        except Exception as e:
+            job = start_import_job('students', form.csv_file.data, current_user.id, dry_run=form.dry_run.data)
+        except CSVImportError as e:
+            flash(str(e), 'danger')
+        except (UnicodeDecodeError, csv.Error, OSError) as e:
             flash(f"讀取或處理 CSV 文件時發生錯誤: {e}", 'danger')
-            current_app.logger.error(f"讀取或處理學生 CSV 文件時發生錯誤: {e}")
-        finally:
-            if conn and conn.is_connected():
-                 cursor.close()
-                 conn.close()
+            current_app.logger.error(f"讀取學生 CSV 文件時發生錯誤: {e}")
+        else:
+            return redirect(url_for('admin.import_job', job_id=job.id))
 
+    # GET 請求或上傳失敗時渲染上傳表單
+    return render_template('admin/import_csv.html', title='匯入學生 (CSV)', form=form, back_url=url_for('admin.manage_students'))
 
-        return redirect(url_for('admin.manage_students')) # 匯入完成後重定向
 
-    # GET 請求時渲染上傳表單
-    return render_template('admin/import_csv.html', title='匯入學生 (CSV)', form=form)
+@bp.route('/import_jobs/<job_id>')
+@login_required
+@admin_required
+def import_job(job_id):
+    """CSV 匯入進度頁面 (頁面中的腳本會輪詢 import_job_progress)"""
+    job = get_job(job_id)
+    if job is None or job.user_id != current_user.id:
+        flash('找不到該匯入任務，可能已過期', 'warning')
+        return redirect(url_for('admin.admin_dashboard'))
+    back_url = url_for('admin.manage_users') if job.kind == 'users' else url_for('admin.manage_students')
+
+    # 預覽完成後分頁顯示差異，可按動作 (新增 / 更新 / 衝突) 篩選
+    diff = []
+    diff_counts = {}
+    action = request.args.get('action')
+    if action not in ('insert', 'update', 'conflict'):
+        action = None
+    page = max(request.args.get('page', 1, type=int), 1)
+    pages = 1
+    if job.dry_run and job.status == 'done':
+        diff, total = job.diff_page(action, page, config.IMPORT_PREVIEW_PER_PAGE)
+        diff_counts = job.diff_counts()
+        pages = max((total + config.IMPORT_PREVIEW_PER_PAGE - 1) // config.IMPORT_PREVIEW_PER_PAGE, 1)
+    return render_template('admin/import_job.html', title='匯入進度', job=job.to_dict(), back_url=back_url,
+                           diff=diff, diff_counts=diff_counts, action=action, page=page, pages=pages)
+
+@bp.route('/import_jobs/<job_id>/commit', methods=['POST'])
+@login_required
+@admin_required
+def commit_import_job(job_id):
+    """確認 CSV 匯入預覽，在一個事務中寫入預覽的所有變更"""
+    job = get_job(job_id)
+    if job is None or job.user_id != current_user.id:
+        flash('找不到該匯入任務，可能已過期', 'warning')
+        return redirect(url_for('admin.admin_dashboard'))
+    try:
+        commit_job = commit_preview_job(job)
+    except CSVImportError as e:
+        flash(str(e), 'danger')
+        return redirect(url_for('admin.import_job', job_id=job.id))
+    return redirect(url_for('admin.import_job', job_id=commit_job.id))
+
+@bp.route('/import_jobs/<job_id>/progress')
+@login_required
+@admin_required
+def import_job_progress(job_id):
+    """返回 CSV 匯入任務的進度 (JSON)"""
+    job = get_job(job_id)
+    if job is None or job.user_id != current_user.id:
+        return jsonify(error='找不到該匯入任務'), 404
+    return jsonify(job.to_dict())
 
 
 # --- 班級管理 ---
@@ -1055,21 +899,13 @@ def import_students_csv():
 @admin_required
 def manage_classes():
     """管理班級列表"""
-    conn = get_db()
     classes = []
-    if conn:
-        cursor = conn.cursor(dictionary=True)
-        try:
-            # 獲取所有班級列表
-            cursor.execute("SELECT * FROM classes ORDER BY class_name")
-            classes = cursor.fetchall()
-        except mysql.connector.Error as err:
-            flash(f"資料庫錯誤: {err}", 'danger')
-            current_app.logger.error(f"資料庫錯誤 (管理班級列表): {err}")
-        finally:
-            if conn and conn.is_connected():
-                 cursor.close()
-                 conn.close()
+    try:
+        # 獲取所有班級列表 (班級目錄)
+        classes = get_classes()
+    except mysql.connector.Error as err:
+        flash(f"資料庫錯誤: {err}", 'danger')
+        current_app.logger.error(f"資料庫錯誤 (管理班級列表): {err}")
 
     return render_template('admin/manage_classes.html', title='管理班級', classes=classes)
 
@@ -1089,7 +925,9 @@ def add_class():
             try:
                 # 插入新班級到資料庫
                 cursor.execute("INSERT INTO classes (class_name) VALUES (%s)", (class_name,))
+                bump_data_versions(cursor, class_ids=[cursor.lastrowid], class_catalog=True)
                 conn.commit()
+                invalidate_class_catalog()
                 flash(f'班級 "{class_name}" 已成功新增', 'success')
                 return redirect(url_for('admin.manage_classes'))
             except mysql.connector.Error as err:
@@ -1153,7 +991,10 @@ def edit_class(class_id):
             try:
                 # 更新班級名稱
                 cursor.execute("UPDATE classes SET class_name = %s WHERE class_id = %s", (class_name, class_id))
+                bump_data_versions(cursor, class_ids=[class_id], cascade_classes=True, class_catalog=True) # 學生記錄頁面也顯示班級名稱
                 conn.commit()
+                invalidate_card_index()
+                invalidate_class_catalog()
                 flash(f'班級 "{class_name}" 已成功更新', 'success')
                 return redirect(url_for('admin.manage_classes'))
             except mysql.connector.Error as err:
@@ -1191,7 +1032,10 @@ def delete_class(class_id):
             # 由於 students 和 teacher_classes 表格使用了 ON DELETE CASCADE，
             # 刪除班級時其下的所有學生及其相關記錄，以及與該班級相關的教師關聯都會自動刪除。
             cursor.execute("DELETE FROM classes WHERE class_id = %s", (class_id,))
+            bump_data_versions(cursor, class_ids=[class_id], class_catalog=True)
             conn.commit()
+            invalidate_card_index()
+            invalidate_class_catalog()
             flash('班級及其下的所有學生和相關記錄已成功刪除', 'success')
         except mysql.connector.Error as err:
             conn.rollback()
@@ -0,0 +1,511 @@
+# app/cache.py
+# 快取工具：進程內的 TTLCache，以及多個工作進程共用、以標籤失效的 shared_cache (也用於 user_loader 的使用者資料)
+import hashlib
+import hmac
+import os
+import pickle
+import sqlite3
+import time
+import threading
+import uuid
+from collections import OrderedDict
+
+from flask import current_app, has_app_context
+
+import config
+
+
+_MISSING = object()
+
+
+class TTLCache:
+    """
+    有大小上限與存活時間 (TTL) 的執行緒安全 LRU 快取。
+    超過 maxsize 時淘汰最久未使用的項目；項目寫入超過 ttl 秒後視為過期。
+    hits / misses 計數器可用於監控命中率。
+    """
+    def __init__(self, maxsize=1024, ttl=60):
+        self.maxsize = maxsize
+        self.ttl = ttl
+        self._data = OrderedDict() # key -> (過期時間, 值)
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+
+    def get(self, key, default=None):
+        """取得快取值，不存在或已過期時返回 default"""
+        now = time.monotonic()
+        with self._lock:
+            item = self._data.get(key, _MISSING)
+            if item is not _MISSING:
+                expires_at, value = item
+                if expires_at > now:
+                    self._data.move_to_end(key)
+                    self.hits += 1
+                    return value
+                del self._data[key]
+            self.misses += 1
+            return default
+
+    def set(self, key, value):
+        """寫入快取值，必要時淘汰最久未使用的項目"""
+        with self._lock:
+            self._data[key] = (time.monotonic() + self.ttl, value)
+            self._data.move_to_end(key)
+            while len(self._data) > self.maxsize:
+                self._data.popitem(last=False)
+
+    def delete(self, key):
+        """立即移除一個項目 (資料變更時呼叫)"""
+        with self._lock:
+            self._data.pop(key, None)
+
+    def clear(self):
+        """清空所有項目"""
+        with self._lock:
+            self._data.clear()
+
+    def stats(self):
+        """返回命中/未命中計數與目前大小"""
+        with self._lock:
+            total = self.hits + self.misses
+            return {
+                'size': len(self._data),
+                'maxsize': self.maxsize,
+                'ttl': self.ttl,
+                'hits': self.hits,
+                'misses': self.misses,
+                'hit_rate': round(self.hits / total, 4) if total else 0.0,
+            }
+
+
+# --- 共用快取 (多個工作進程之間一致) ---
+# 每個工作進程各自一份的 TTLCache 會彼此不一致，而且記憶體用量隨進程數增加。
+# shared_cache 將快取項目存放在可替換的後端中，並以標籤實現失效：
+# - MemoryBackend：進程內 LRU (單進程部署或開發時使用)
+# - SQLiteBackend：同一主機上所有工作進程共用的 SQLite 文件 (WAL 模式)
+# - NetworkBackend：網路快取服務 (例如 Redis) 的客戶端介面；LocalNetworkClient 是進程內的替代實現
+# 每個標籤 (例如 'class:3'、'student:42'、'user:7') 在後端中保存一個隨機令牌。項目寫入時記錄其標籤當時的令牌，
+# 讀取時令牌不一致即視為未命中；使標籤失效只需寫入新的令牌，不需要找出帶有該標籤的項目。
+# 標籤的令牌被淘汰時會產生新令牌，只會造成未命中，不會返回過期的數據。
+# 寫入路徑不直接使標籤失效：bump_data_versions() 以 queue_invalidation() 記錄受影響的標籤，
+# 事務提交後 (RequestConnection.commit()、release_connection() 或請求結束時) 才由 flush_invalidations() 寫入新令牌，
+# 避免其他請求在提交前以新令牌快取舊的數據。
+# 快取後端發生錯誤時視為未命中並直接載入數據，不影響請求。
+# 項目以 pickle 序列化，並附上以 SECRET_KEY 計算的 HMAC-SHA256 簽名；簽名不符的項目不會被反序列化 (視為未命中)，
+# 因此能寫入快取文件或快取服務的其他程式無法讓工作進程執行任意程式碼。
+class CacheBackend:
+    """
+    快取後端介面：以字串為鍵保存 bytes 值。
+    過期時間與標籤由 TaggedCache 管理；ttl 為 None 的項目 (標籤令牌) 不會過期，但仍可能被淘汰。
+    """
+    name = 'base'
+
+    def get_many(self, keys):
+        """返回 {鍵: 值}，不存在的鍵不包含在結果中"""
+        raise NotImplementedError
+
+    def set_many(self, items, ttl=None):
+        raise NotImplementedError
+
+    def delete_many(self, keys):
+        raise NotImplementedError
+
+    def clear(self):
+        raise NotImplementedError
+
+    def stats(self):
+        return {'backend': self.name}
+
+
+class MemoryBackend(CacheBackend):
+    """進程內 LRU 後端 (每個進程各自一份，標籤失效只影響本進程)"""
+    name = 'memory'
+
+    def __init__(self, maxsize):
+        # 項目的過期時間由 TaggedCache 檢查，這裡的 TTL 只用於清理長時間未更新的標籤令牌
+        self._cache = TTLCache(maxsize=maxsize, ttl=24 * 3600)
+
+    def get_many(self, keys):
+        found = {}
+        for key in keys:
+            value = self._cache.get(key, _MISSING)
+            if value is not _MISSING:
+                found[key] = value
+        return found
+
+    def set_many(self, items, ttl=None):
+        for key, value in items.items():
+            self._cache.set(key, value)
+
+    def delete_many(self, keys):
+        for key in keys:
+            self._cache.delete(key)
+
+    def clear(self):
+        self._cache.clear()
+
+    def stats(self):
+        return {'backend': self.name, **self._cache.stats()}
+
+
+class SQLiteBackend(CacheBackend):
+    """
+    同一主機上所有工作進程共用的 SQLite 文件後端。
+    每個執行緒使用自己的連接 (fork 後的子進程重新連接)；WAL 模式下讀取不會被寫入阻塞。
+    項目數超過 max_entries 時按過期時間淘汰最早過期的項目 (標籤令牌不會被淘汰)。
+    文件 (及其所在的文件夾) 只允許目前的使用者讀寫；文件已存在但屬於其他使用者時拒絕使用。
+    """
+    name = 'sqlite'
+    PRUNE_EVERY = 500 # 每寫入多少次清理一次過期項目
+
+    def __init__(self, path, max_entries):
+        self.path = path
+        self.max_entries = max_entries
+        self._local = threading.local()
+        self._writes = 0
+
+    def _secure_file(self):
+        """以 0600 權限建立快取文件 (WAL 與共享記憶體文件沿用資料庫文件的權限)"""
+        folder = os.path.dirname(os.path.abspath(self.path))
+        os.makedirs(folder, mode=0o700, exist_ok=True)
+        fd = os.open(self.path, os.O_RDWR | os.O_CREAT, 0o600)
+        try:
+            if os.fstat(fd).st_uid != os.getuid():
+                raise PermissionError(f"快取文件 {self.path} 屬於其他使用者，拒絕使用")
+            os.fchmod(fd, 0o600)
+        finally:
+            os.close(fd)
+
+    def _connection(self):
+        pid = os.getpid()
+        conn = getattr(self._local, 'conn', None)
+        if conn is None or self._local.pid != pid:
+            self._secure_file()
+            conn = sqlite3.connect(self.path, timeout=5, isolation_level=None) # 自動提交
+            conn.execute("PRAGMA journal_mode=WAL")
+            conn.execute("PRAGMA synchronous=NORMAL")
+            conn.execute("CREATE TABLE IF NOT EXISTS cache_entries (key TEXT PRIMARY KEY, value BLOB NOT NULL, expires_at REAL)")
+            conn.execute("CREATE INDEX IF NOT EXISTS idx_cache_entries_expires_at ON cache_entries (expires_at)")
+            self._local.conn = conn
+            self._local.pid = pid
+        return conn
+
+    def get_many(self, keys):
+        conn = self._connection()
+        rows = conn.execute(
+            f"SELECT key, value FROM cache_entries WHERE key IN ({', '.join(['?'] * len(keys))})"
+            f" AND (expires_at IS NULL OR expires_at > ?)",
+            [*keys, time.time()]
+        ).fetchall()
+        return dict(rows)
+
+    def set_many(self, items, ttl=None):
+        conn = self._connection()
+        expires_at = time.time() + ttl if ttl is not None else None
+        conn.executemany("INSERT OR REPLACE INTO cache_entries (key, value, expires_at) VALUES (?, ?, ?)",
+                         [(key, value, expires_at) for key, value in items.items()])
+        self._writes += 1
+        if self._writes % self.PRUNE_EVERY == 0:
+            self._prune(conn)
+
+    def _prune(self, conn):
+        conn.execute("DELETE FROM cache_entries WHERE expires_at <= ?", (time.time(),))
+        (count,) = conn.execute("SELECT COUNT(*) FROM cache_entries WHERE expires_at IS NOT NULL").fetchone()
+        if count > self.max_entries:
+            conn.execute("""
+                DELETE FROM cache_entries WHERE key IN (
+                    SELECT key FROM cache_entries WHERE expires_at IS NOT NULL ORDER BY expires_at LIMIT ?
+                )
+            """, (count - self.max_entries,))
+
+    def delete_many(self, keys):
+        self._connection().executemany("DELETE FROM cache_entries WHERE key = ?", [(key,) for key in keys])
+
+    def clear(self):
+        self._connection().execute("DELETE FROM cache_entries")
+
+    def stats(self):
+        (count,) = self._connection().execute("SELECT COUNT(*) FROM cache_entries").fetchone()
+        return {'backend': self.name, 'path': self.path, 'size': count, 'max_entries': self.max_entries}
+
+
+class LocalNetworkClient:
+    """
+    網路快取客戶端的進程內替代實現 (開發 / 測試使用)，提供 NetworkBackend 需要的 Redis 風格方法：
+    mget、set (ex 為存活秒數)、delete、scan_iter。
+    """
+    def __init__(self):
+        self._data = {} # 鍵 -> (過期時間或 None, 值)
+        self._lock = threading.Lock()
+
+    def mget(self, keys):
+        now = time.time()
+        with self._lock:
+            values = []
+            for key in keys:
+                item = self._data.get(key)
+                if item is not None and item[0] is not None and item[0] <= now:
+                    del self._data[key]
+                    item = None
+                values.append(item[1] if item is not None else None)
+            return values
+
+    def set(self, key, value, ex=None):
+        with self._lock:
+            self._data[key] = (time.time() + ex if ex is not None else None, value)
+        return True
+
+    def delete(self, *keys):
+        with self._lock:
+            return sum(self._data.pop(key, None) is not None for key in keys)
+
+    def scan_iter(self, match='*'):
+        prefix = match.rstrip('*')
+        with self._lock:
+            keys = [key for key in self._data if key.startswith(prefix)]
+        return iter(keys)
+
+
+class NetworkBackend(CacheBackend):
+    """
+    網路快取服務後端：client 需要提供 Redis 風格的 mget / set(ex=) / delete / scan_iter 方法
+    (redis.Redis 或 LocalNetworkClient)。所有鍵加上 prefix，避免與共用同一服務的其他應用程式衝突。
+    """
+    name = 'network'
+
+    def __init__(self, client, prefix='school_records:'):
+        self.client = client
+        self.prefix = prefix
+
+    def get_many(self, keys):
+        values = self.client.mget([self.prefix + key for key in keys])
+        return {key: value for key, value in zip(keys, values) if value is not None}
+
+    def set_many(self, items, ttl=None):
+        ex = max(int(ttl), 1) if ttl is not None else None
+        for key, value in items.items():
+            self.client.set(self.prefix + key, value, ex=ex)
+
+    def delete_many(self, keys):
+        if keys:
+            self.client.delete(*[self.prefix + key for key in keys])
+
+    def clear(self):
+        keys = list(self.client.scan_iter(match=self.prefix + '*'))
+        if keys:
+            self.client.delete(*keys)
+
+    def stats(self):
+        return {'backend': self.name, 'client': type(self.client).__name__}
+
+
+def create_network_client(url):
+    """依網址建立網路快取客戶端：'local://' 為進程內的替代實現，'redis://...' 需要安裝 redis 套件"""
+    if url.startswith('local://'):
+        return LocalNetworkClient()
+    if url.startswith(('redis://', 'rediss://', 'unix://')):
+        try:
+            import redis
+        except ImportError:
+            raise RuntimeError("CACHE_NETWORK_URL 使用 Redis，但未安裝 redis 套件 (pip install redis)")
+        return redis.Redis.from_url(url)
+    raise ValueError(f"不支援的快取服務網址: {url}")
+
+
+def create_backend(name=None, sqlite_path=None):
+    """依 config.CACHE_BACKEND ('memory'、'sqlite' 或 'network') 建立快取後端"""
+    name = name or config.CACHE_BACKEND
+    if name == 'memory':
+        return MemoryBackend(config.CACHE_MEMORY_SIZE)
+    if name == 'sqlite':
+        sqlite_path = sqlite_path or config.CACHE_SQLITE_PATH
+        if not sqlite_path:
+            raise ValueError("'sqlite' 快取後端需要 CACHE_SQLITE_PATH，或先以 shared_cache.init_app(app) 使用 instance 文件夾")
+        return SQLiteBackend(sqlite_path, config.CACHE_SQLITE_MAX_ENTRIES)
+    if name == 'network':
+        return NetworkBackend(create_network_client(config.CACHE_NETWORK_URL))
+    raise ValueError(f"不支援的快取後端: {name}")
+
+
+def _new_token():
+    return uuid.uuid4().hex[:16]
+
+
+_SIGNATURE_SIZE = hashlib.sha256().digest_size
+
+
+class TaggedCache:
+    """帶標籤失效的快取前端 (後端在第一次使用時依設定建立)"""
+
+    def __init__(self, backend=None):
+        self._backend = backend
+        self._secret = config.SECRET_KEY.encode()
+        self._sqlite_path = None
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+        self.errors = 0
+        self.last_error = None
+
+    def init_app(self, app):
+        """使用應用程式的 SECRET_KEY 簽名項目；'sqlite' 後端的文件預設放在應用程式的 instance 文件夾"""
+        self._secret = app.config['SECRET_KEY'].encode()
+        self._sqlite_path = app.config.get('CACHE_SQLITE_PATH') or os.path.join(app.instance_path, 'cache.sqlite3')
+
+    @property
+    def backend(self):
+        if self._backend is None:
+            with self._lock:
+                if self._backend is None:
+                    self._backend = create_backend(sqlite_path=self._sqlite_path)
+        return self._backend
+
+    def _sign(self, payload):
+        return hmac.new(self._secret, payload, hashlib.sha256).digest() + payload
+
+    def _unsign(self, entry):
+        """驗證簽名並返回序列化的內容；簽名不符時拋出 ValueError (不反序列化)"""
+        signature, payload = entry[:_SIGNATURE_SIZE], entry[_SIGNATURE_SIZE:]
+        if not hmac.compare_digest(signature, hmac.new(self._secret, payload, hashlib.sha256).digest()):
+            raise ValueError("項目的簽名不符")
+        return payload
+
+    def _error(self, action, err):
+        self.errors += 1
+        self.last_error = f"{action}: {err}"
+        if has_app_context():
+            current_app.logger.error(f"快取錯誤 ({action}): {err}")
+
+    def get_or_set(self, key, loader, tags=(), ttl=None):
+        """
+        返回快取的值；未命中或標籤已失效時呼叫 loader() 載入並寫入快取。
+        標籤令牌在呼叫 loader() 之前讀取：載入期間有寫入使標籤失效時，寫入的項目在下一次讀取時即視為過期。
+        loader() 的查詢不能使用令牌讀取之前建立的交易快照 (連接池的連接使用 READ COMMITTED，見 app/db.py)，
+        否則令牌讀取之前提交的寫入不可見，舊的數據會以新的令牌快取。
+        loader() 拋出的例外不會被快取，直接傳給呼叫者；loader() 返回 None (例如找不到資料) 時也不寫入快取。
+        """
+        ttl = ttl or config.CACHE_DEFAULT_TTL
+        tag_keys = ['tag:' + tag for tag in tags]
+        try:
+            found = self.backend.get_many([key] + tag_keys)
+        except Exception as err:
+            self._error('讀取', err)
+            return loader()
+
+        tokens = {}
+        missing = {}
+        for tag, tag_key in zip(tags, tag_keys):
+            token = found.get(tag_key)
+            if token is None:
+                token = missing[tag_key] = _new_token()
+            elif isinstance(token, bytes):
+                token = token.decode()
+            tokens[tag] = token
+
+        entry = found.get(key)
+        if entry is not None and not missing:
+            try:
+                expires_at, entry_tokens, value = pickle.loads(self._unsign(entry))
+            except Exception as err:
+                self._error('反序列化', err)
+            else:
+                if expires_at > time.time() and entry_tokens == tokens:
+                    self.hits += 1
+                    return value
+        self.misses += 1
+
+        try:
+            if missing:
+                self.backend.set_many(missing)
+        except Exception as err:
+            self._error('寫入標籤', err)
+            return loader()
+        value = loader()
+        if value is None:
+            return value
+        try:
+            payload = pickle.dumps((time.time() + ttl, tokens, value), pickle.HIGHEST_PROTOCOL)
+            self.backend.set_many({key: self._sign(payload)}, ttl=ttl)
+        except Exception as err:
+            self._error('寫入', err)
+        return value
+
+    def invalidate(self, *tags):
+        """使帶有這些標籤的所有項目失效 (寫入新的標籤令牌)"""
+        if not tags:
+            return
+        try:
+            self.backend.set_many({'tag:' + tag: _new_token() for tag in set(tags)})
+        except Exception as err:
+            self._error('標籤失效', err)
+
+    def delete(self, key):
+        try:
+            self.backend.delete_many([key])
+        except Exception as err:
+            self._error('刪除', err)
+
+    def clear(self):
+        try:
+            self.backend.clear()
+        except Exception as err:
+            self._error('清空', err)
+
+    def stats(self):
+        total = self.hits + self.misses
+        try:
+            backend_stats = self.backend.stats()
+        except Exception as err:
+            backend_stats = {'error': str(err)}
+        return {
+            **backend_stats,
+            'hits': self.hits,
+            'misses': self.misses,
+            'hit_rate': round(self.hits / total, 4) if total else 0.0,
+            'errors': self.errors,
+            'last_error': self.last_error,
+        }
+
+
+shared_cache = TaggedCache()
+
+
+# --- user_loader 使用的使用者資料 ---
+# users 表的資料列保存在 shared_cache 中，標籤為 'user:<id>' 與 'users'，因此失效對所有工作進程立即生效
+# (降級或刪除的使用者不會在其他進程中保留原有的角色)。修改使用者資料的路由在提交後呼叫 invalidate_user()；
+# bump_data_versions(user_ids=...) 也會在提交後使這些標籤失效。
+def user_cache_key(user_id):
+    return f"user_row:{int(user_id)}"
+
+
+def user_cache_tags(user_id):
+    return [f"user:{int(user_id)}", 'users']
+
+
+def invalidate_user(user_id=None):
+    """讓指定使用者的快取失效；不指定 user_id 時讓所有使用者的快取失效"""
+    if user_id is None:
+        shared_cache.invalidate('users')
+    else:
+        shared_cache.invalidate(f"user:{int(user_id)}")
+
+
+# --- 延遲到提交後的標籤失效 ---
+_pending = threading.local()
+
+
+def queue_invalidation(tags):
+    """記錄目前執行緒的事務提交後需要失效的標籤 (由 bump_data_versions() 呼叫)"""
+    pending = getattr(_pending, 'tags', None)
+    if pending is None:
+        pending = _pending.tags = set()
+    pending.update(tags)
+
+
+def flush_invalidations():
+    """使目前執行緒記錄的標籤失效 (事務提交後呼叫；事務回滾後呼叫只會造成多餘的未命中)"""
+    tags = getattr(_pending, 'tags', None)
+    if tags:
+        _pending.tags = set()
+        shared_cache.invalidate(*tags)
@@ -0,0 +1,135 @@
+# app/class_catalog.py
+# 班級目錄 (進程內快取)
+#
+# 班級很少變更，但幾乎每個頁面都需要班級列表或班級名稱 (儀表板、學生 / 使用者表單、主管頁面、CSV 匯入)。
+# 班級目錄以一次查詢載入所有班級，保存 班級 ID -> 名稱、名稱 -> 班級 ID 以及按名稱排序的列表，之後的讀取不查詢資料庫。
+# - 新增 / 修改 / 刪除班級的路由在提交後呼叫 invalidate_class_catalog() 遞增進程內的版本，下一次讀取時重新載入。
+# - 同一事務中以 bump_data_versions(..., class_catalog=True) 遞增資料庫中的班級目錄版本 ('classes', 0)；
+#   其他進程每 CLASS_CATALOG_CHECK_INTERVAL 秒以一個主鍵查詢比較這個版本，版本改變時才重新載入班級。
+# 在請求中讀取時使用請求已借出的連接 (不再借出第二個連接)，查詢在鎖之外執行，完成後才在鎖內替換目錄。
+import threading
+import time
+
+from flask import has_request_context
+
+import config
+from app.db import acquire_connection, release_connection, get_request_connection
+
+
+class ClassCatalog:
+    """班級 ID 與名稱的記憶體目錄"""
+
+    def __init__(self):
+        self._classes = [] # [{'class_id', 'class_name'}, ...]，按班級名稱排序
+        self._by_id = {}
+        self._by_name = {}
+        self._version = 0 # 進程內版本 (invalidate() 遞增)
+        self._loaded_version = None # 目前資料對應的進程內版本，None 表示尚未載入
+        self._db_version = None # 目前資料對應的資料庫版本
+        self._checked_at = 0
+        self._checking = False # 已有執行緒正在檢查資料庫版本
+        self._lock = threading.Lock()
+        self.loads = 0
+
+    def invalidate(self):
+        with self._lock:
+            self._version += 1
+
+    def _read_db_version(self, cursor):
+        cursor.execute("SELECT version FROM data_versions WHERE scope = 'classes' AND scope_id = 0")
+        row = cursor.fetchone()
+        return row[0] if row else 0
+
+    def _ensure_current(self):
+        """
+        必要時重新載入。查詢在 _lock 之外執行：已載入時同一時間只有一個執行緒檢查版本，其他執行緒繼續使用目前的目錄；
+        尚未載入 (或本進程已使其失效) 時，每個需要目錄的執行緒各自讀取。
+        """
+        with self._lock:
+            loaded = self._loaded_version == self._version
+            if loaded and (self._checking or time.monotonic() - self._checked_at < config.CLASS_CATALOG_CHECK_INTERVAL):
+                return
+            self._checking = loaded
+            version = self._version
+            known_db_version = self._db_version
+        try:
+            db_version, classes = self._load(None if not loaded else known_db_version)
+        finally:
+            if loaded:
+                with self._lock:
+                    self._checking = False
+        with self._lock:
+            if classes is not None:
+                self._classes = classes
+                self._by_id = {c['class_id']: c['class_name'] for c in classes}
+                self._by_name = {c['class_name']: c['class_id'] for c in classes}
+                self._loaded_version = version # 讀取期間再次失效時版本不同，下一次讀取會再重新載入
+                self.loads += 1
+            self._db_version = db_version
+            self._checked_at = time.monotonic()
+
+    def _load(self, known_db_version):
+        """
+        讀取資料庫版本，版本與 known_db_version 不同 (或 known_db_version 為 None) 時一併讀取班級。
+        返回 (資料庫版本, 班級列表或 None)。請求中使用請求的連接，其他情況 (背景執行緒、命令) 借出一個連接。
+        """
+        in_request = has_request_context()
+        conn = get_request_connection() if in_request else acquire_connection()
+        try:
+            cursor = conn.cursor()
+            try:
+                db_version = self._read_db_version(cursor)
+                if known_db_version is not None and db_version == known_db_version:
+                    return db_version, None
+                # 先讀取版本再讀取班級：期間有其他寫入時，下一次檢查會再重新載入
+                cursor.execute("SELECT class_id, class_name FROM classes ORDER BY class_name")
+                return db_version, [{'class_id': class_id, 'class_name': class_name} for class_id, class_name in cursor.fetchall()]
+            finally:
+                cursor.close()
+        finally:
+            if not in_request:
+                release_connection(conn)
+
+    def _current(self):
+        self._ensure_current()
+        with self._lock:
+            return self._classes, self._by_id, self._by_name
+
+    def classes(self):
+        """所有班級 (按名稱排序的字典列表，與 cursor(dictionary=True) 的結果相同)；列表為共用的，不可修改"""
+        return self._current()[0]
+
+    def name_of(self, class_id):
+        """班級名稱，班級不存在時返回 None"""
+        return self._current()[1].get(class_id)
+
+    def id_of(self, class_name):
+        """班級 ID，班級不存在時返回 None"""
+        return self._current()[2].get(class_name)
+
+    def maps(self):
+        """返回 (班級 ID -> 名稱, 名稱 -> 班級 ID) 兩個字典 (共用的，不可修改)"""
+        _, by_id, by_name = self._current()
+        return by_id, by_name
+
+    def status(self):
+        return {'classes': len(self._classes), 'loads': self.loads,
+                'stale': self._loaded_version != self._version, 'db_version': self._db_version}
+
+
+class_catalog = ClassCatalog()
+
+
+def invalidate_class_catalog():
+    """新增、修改或刪除班級並提交後呼叫，讓這個進程下一次讀取時重新載入班級目錄"""
+    class_catalog.invalidate()
+
+
+def get_classes():
+    """所有班級列表 (按名稱排序)，讀取失敗時拋出 mysql.connector.Error"""
+    return class_catalog.classes()
+
+
+def get_class_name(class_id):
+    """班級名稱，班級不存在時返回 None"""
+    return class_catalog.name_of(class_id)
@@ -0,0 +1,802 @@
+# app/csv_import.py
+# 學生 / 使用者 CSV 匯入
+#
+# 上傳的文件先分塊複製到暫存文件，再由背景執行緒透過 TextIOWrapper 逐行讀取 (記憶體用量與文件大小無關)，
+# 每 CSV_IMPORT_COMMIT_ROWS 行分類、寫入並提交一次。匯入進度記錄在 ImportJob 中，瀏覽器可以輪詢查詢。
+# 預覽 (dry run) 任務以同樣的記憶體索引分類所有行但不寫入資料庫，產生逐行的差異 (新增 / 更新 / 衝突)；
+# 確認後以同一個暫存文件開始正式匯入，所有行在一個事務中寫入並提交。
+# 未確認的預覽在結束 IMPORT_PREVIEW_TTL 秒後刪除暫存文件 (使用者匯入的文件包含明文密碼)，其他任務在 IMPORT_JOB_TTL 秒後移除；
+# 過期的任務在每次查詢或建立任務時清理，並在任務結束時排定一次清理，沒有後續請求時也會刪除。
+# 預覽只保存前 IMPORT_PREVIEW_MAX_DIFF 行的差異 (仍計算各動作的總數)，記憶體用量不隨文件大小增加。
+# 注意：匯入任務保存在執行匯入的進程記憶體中，多進程部署時輪詢請求需要到達同一個進程
+# (例如使用 sticky session)，否則會找不到任務。
+import csv
+import io
+import os
+import shutil
+import tempfile
+import threading
+import time
+import uuid
+
+import mysql.connector
+from flask import current_app
+
+import config
+from app.cache import invalidate_user, flush_invalidations
+from app.db import acquire_connection, release_connection
+from app.hashing import hash_passwords
+from app.kiosk import invalidate_card_index
+from app.class_catalog import class_catalog
+from app.models import bump_data_versions
+
+
+class CSVImportError(Exception):
+    """上傳的 CSV 文件無法匯入 (例如表頭缺少必要欄位) 時拋出"""
+    pass
+
+
+# --- 匯入任務 ---
+class ImportJob:
+    """一次 CSV 匯入的狀態與進度 (由背景執行緒更新，請求執行緒讀取)"""
+
+    def __init__(self, kind, user_id, path, dry_run=False, single_batch=False):
+        self.id = uuid.uuid4().hex
+        self.kind = kind # 'students' 或 'users'
+        self.user_id = user_id # 發起匯入的管理員
+        self.path = path
+        self.dry_run = dry_run # 只驗證並產生差異，不寫入資料庫
+        self.single_batch = single_batch # 所有行在一個事務中寫入 (確認預覽後的匯入)
+        self.diff = [] # 預覽的逐行差異 (最多 IMPORT_PREVIEW_MAX_DIFF 行) [{'line', 'action': insert / update / conflict, 'label', 'changes'}, ...]
+        self.diff_totals = {'insert': 0, 'update': 0, 'conflict': 0} # 所有行的差異計數
+        self.committed_job_id = None # 預覽確認後開始的匯入任務
+        self.status = 'pending' # pending -> running -> done / failed
+        self.message = None
+        self.total_bytes = os.path.getsize(path)
+        self.bytes_read = 0
+        self.rows = 0
+        self.imported = 0
+        self.updated = 0
+        self.errors = []
+        self.error_count = 0
+        self.created_at = time.time()
+        self.finished_at = None
+
+    def add_errors(self, messages):
+        """記錄錯誤訊息；只保留前 IMPORT_JOB_MAX_ERRORS 條，但計算總數"""
+        for message in messages:
+            self.error_count += 1
+            if len(self.errors) < config.IMPORT_JOB_MAX_ERRORS:
+                self.errors.append(message)
+
+    def add_diff(self, line, action, label, changes):
+        """記錄一行的差異；只保留前 IMPORT_PREVIEW_MAX_DIFF 行，但計算各動作的總數"""
+        self.diff_totals[action] += 1
+        if len(self.diff) < config.IMPORT_PREVIEW_MAX_DIFF:
+            self.diff.append({'line': line, 'action': action, 'label': label, 'changes': changes})
+
+    @property
+    def diff_truncated(self):
+        return sum(self.diff_totals.values()) > len(self.diff)
+
+    def diff_page(self, action=None, page=1, per_page=100):
+        """返回 (該頁的差異項目, 符合條件的總數)；action 為 None 時返回所有項目"""
+        entries = self.diff if action is None else [entry for entry in self.diff if entry['action'] == action]
+        start = (page - 1) * per_page
+        return entries[start:start + per_page], len(entries)
+
+    def diff_counts(self):
+        return dict(self.diff_totals)
+
+    def expired(self, now):
+        """是否已過期：未確認的預覽在 IMPORT_PREVIEW_TTL 秒後，其他任務在 IMPORT_JOB_TTL 秒後"""
+        if not self.finished_at:
+            return False
+        ttl = config.IMPORT_PREVIEW_TTL if self.dry_run and self.committed_job_id is None else config.IMPORT_JOB_TTL
+        return now - self.finished_at > ttl
+
+    def to_dict(self):
+        percent = 100 if self.status == 'done' else int(self.bytes_read * 100 / self.total_bytes) if self.total_bytes else 0
+        return {
+            'id': self.id,
+            'kind': self.kind,
+            'status': self.status,
+            'dry_run': self.dry_run,
+            'diff_truncated': self.diff_truncated,
+            'committed_job_id': self.committed_job_id,
+            'message': self.message,
+            'percent': percent,
+            'rows': self.rows,
+            'imported': self.imported,
+            'updated': self.updated,
+            'error_count': self.error_count,
+            'errors': self.errors,
+        }
+
+
+_jobs = {}
+_jobs_lock = threading.Lock()
+
+
+def get_job(job_id):
+    """返回匯入任務，不存在 (或已過期) 時返回 None"""
+    purge_expired_jobs()
+    with _jobs_lock:
+        return _jobs.get(job_id)
+
+
+def purge_expired_jobs():
+    """移除過期的任務並刪除未確認的預覽保留的暫存文件"""
+    now = time.time()
+    with _jobs_lock:
+        expired = [_jobs.pop(job_id) for job_id, job in list(_jobs.items()) if job.expired(now)]
+    for job in expired:
+        if job.dry_run and job.committed_job_id is None:
+            _remove_file(job.path)
+
+
+def _schedule_purge(job):
+    """任務結束時排定一次清理，在任務過期後執行 (沒有後續請求時也會刪除暫存文件)"""
+    ttl = config.IMPORT_PREVIEW_TTL if job.dry_run else config.IMPORT_JOB_TTL
+    timer = threading.Timer(ttl + 1, purge_expired_jobs)
+    timer.daemon = True
+    timer.start()
+
+
+def _register_job(job):
+    purge_expired_jobs()
+    with _jobs_lock:
+        _jobs[job.id] = job
+
+
+def _remove_file(path):
+    try:
+        os.remove(path)
+    except OSError:
+        pass
+
+
+# --- CSV 讀取 ---
+def _open_csv(path):
+    """以串流方式開啟 CSV 文件，返回 (二進位文件, csv.reader)；utf-8-sig 可以處理 Excel 加上的 BOM"""
+    raw = open(path, 'rb')
+    return raw, csv.reader(io.TextIOWrapper(raw, encoding='utf-8-sig', newline=''))
+
+
+def _cell(row, idx):
+    """返回可選欄位去除空白後的值；欄位不存在或為空時返回 None"""
+    if idx == -1 or len(row) <= idx:
+        return None
+    return row[idx].strip() or None
+
+
+def _student_columns(header):
+    """解析學生 CSV 的表頭 (必要欄位：姓名、班級名稱)"""
+    try:
+        return {
+            'student_number': header.index('學號') if '學號' in header else -1,
+            'name': header.index('姓名'),
+            'class_name': header.index('班級名稱'),
+            'id_card_number': header.index('ID卡號碼') if 'ID卡號碼' in header else -1,
+            'student_id_number': header.index('學生證號碼') if '學生證號碼' in header else -1,
+        }
+    except ValueError as e:
+        raise CSVImportError(f"CSV 文件表頭格式不正確，缺少必要欄位 (姓名, 班級名稱): {e}")
+
+
+def _user_columns(header):
+    """解析使用者 CSV 的表頭 (必要欄位：使用者名稱、密碼、角色)"""
+    try:
+        return {
+            'username': header.index('使用者名稱'),
+            'password': header.index('密碼'),
+            'role': header.index('角色'),
+            'teacher_name': header.index('教師姓名') if '教師姓名' in header else -1,
+            'id_card_number': header.index('ID卡號碼') if 'ID卡號碼' in header else -1,
+            'assigned_classes': header.index('分配班級') if '分配班級' in header else -1,
+        }
+    except ValueError as e:
+        raise CSVImportError(f"CSV 文件表頭格式不正確，缺少必要欄位: {e}")
+
+
+HEADER_PARSERS = {'students': _student_columns, 'users': _user_columns}
+
+
+def _read_header(reader, kind):
+    header = next(reader, None)
+    if header is None:
+        raise CSVImportError("CSV 文件是空的")
+    return HEADER_PARSERS[kind](header)
+
+
+def _display(value):
+    return value if value not in (None, '') else '(空)'
+
+
+def _describe_changes(labels, previous, current):
+    """
+    預覽中一行的變更描述列表。previous 為 None (新增) 時列出所有非空的值，否則只列出改變的欄位。
+    labels、previous 與 current 的順序相同。
+    """
+    if previous is None:
+        return [f"{label}: {value}" for label, value in zip(labels, current) if value not in (None, '')]
+    return [f"{label}: {_display(old)} → {_display(new)}"
+            for label, old, new in zip(labels, previous, current) if old != new]
+
+
+def _record_row_diff(job, line, outcome, errors, describe):
+    """
+    記錄預覽中一行的結果：outcome 為 plan.add() 的返回值 (行被跳過時為 None)，
+    errors 為處理該行時產生的錯誤 (每個錯誤記錄為一個衝突)，describe(previous, current) 返回變更描述列表。
+    """
+    for error in errors:
+        job.add_diff(line, 'conflict', None, [error])
+    if outcome is not None:
+        action, label, previous, current = outcome
+        job.add_diff(line, action, label, describe(previous, current))
+        if action == 'insert':
+            job.imported += 1
+        else:
+            job.updated += 1
+
+
+def _commit_rows(job):
+    """每讀取多少行寫入並提交一次；single_batch 任務只在讀完文件後寫入並提交一次"""
+    return float('inf') if job.single_batch else config.CSV_IMPORT_COMMIT_ROWS
+
+
+def _chunks(items, size):
+    for start in range(0, len(items), size):
+        yield items[start:start + size]
+
+
+def _write_import_batches(cursor, sql, entries, chunk_size, written, errors, log_label):
+    """
+    將 entries (每項包含 'values' 與 'label') 按 chunk_size 分批以多行語句寫入，寫入成功的項目加入 written。
+    某一批因完整性錯誤失敗時 (例如匯入期間其他人修改了數據)，改為逐行寫入該批，只跳過出錯的行並記錄錯誤。
+    InnoDB 的重複鍵錯誤只回滾出錯的語句，不影響同一事務中已執行的其他批次。
+    """
+    if not entries:
+        return
+    row_sql = "(" + ", ".join(["%s"] * len(entries[0]['values'])) + ")"
+    for chunk in _chunks(entries, chunk_size):
+        try:
+            cursor.execute(sql.format(values=", ".join([row_sql] * len(chunk))),
+                           [value for entry in chunk for value in entry['values']])
+            written.extend(chunk)
+        except mysql.connector.IntegrityError:
+            for entry in chunk:
+                try:
+                    cursor.execute(sql.format(values=row_sql), entry['values'])
+                    written.append(entry)
+                except mysql.connector.IntegrityError as err:
+                    errors.append(f"{entry['label']} 數據無效 (唯一性衝突): {err}")
+                    current_app.logger.error(f"資料庫完整性錯誤 ({log_label}): {err}")
+
+
+# --- 學生匯入 ---
+# 既有學生：帶上 student_id，以主鍵衝突觸發 ON DUPLICATE KEY UPDATE 更新該學生
+STUDENT_UPSERT_SQL = (
+    "INSERT INTO students (student_id, student_number, name, class_id, id_card_number, student_id_number) VALUES {values} "
+    "ON DUPLICATE KEY UPDATE name = VALUES(name), class_id = VALUES(class_id), "
+    "id_card_number = VALUES(id_card_number), student_id_number = VALUES(student_id_number)"
+)
+# 新學生：一般的多行 INSERT (student_id 為 NULL)，唯一鍵衝突會報錯而不是更新其他學生
+STUDENT_INSERT_SQL = (
+    "INSERT INTO students (student_id, student_number, name, class_id, id_card_number, student_id_number) VALUES {values}"
+)
+# 預先載入所有學生 (每次匯入一次)，以及按學號與班級查詢新學生的 ID (flask db explain 也檢查這些查詢)
+STUDENT_PREFETCH_SQL = "SELECT student_id, student_number, name, class_id, id_card_number, student_id_number FROM students ORDER BY student_id"
+STUDENT_ID_LOOKUP_SQL = "SELECT student_id, student_number, class_id FROM students WHERE (student_number, class_id) IN ({values})"
+STUDENT_UNIQUE_LABELS = {'id_card_number': 'ID卡號碼', 'student_id_number': '學生證號碼', 'number_class': '學號 (同一班級)'}
+
+
+def _student_label(name, student_number):
+    return f"學生 '{name}' (學號: {student_number if student_number else 'N/A'})"
+
+
+class StudentImportPlan:
+    """
+    在記憶體中將 CSV 行分類為新增或更新，並預先檢查唯一性約束。
+    以一次查詢預先載入的所有學生初始化；同一文件中重複的學號合併為一筆 (後面的行覆蓋前面的值，與逐行匯入的結果相同)。
+    因為 ON DUPLICATE KEY UPDATE 在任何唯一鍵衝突時都會更新既有的行，衝突必須在寫入前找出，
+    否則一行重複的 ID 卡號碼會靜默地覆蓋另一個學生。
+    分批寫入時以 take_batch() 取出目前累積的項目，寫入後以 resolve() / discard() 更新索引。
+    """
+
+    def __init__(self, existing_students):
+        self.current = {} # student_id -> 資料庫中目前的值 (與寫入的值順序相同)，預覽時用於比較差異
+        self.by_number = {} # 學號 -> 學生鍵 (既有學生為 student_id，尚未寫入的新學生為 ('new', n))
+        self.owners = {} # (唯一鍵名稱, 值) -> 學生鍵
+        self.claims = {} # 學生鍵 -> 該學生目前佔用的唯一鍵
+        self.rows = {} # 學生鍵 -> {'key', 'values': 寫入的值, 'label': 錯誤訊息使用的名稱, 'imported': 行數, 'updated': 行數}
+        self.errors = []
+        self._new_count = 0
+        for student_id, student_number, name, class_id, id_card_number, student_id_number in existing_students:
+            self.current[student_id] = (student_id, student_number, name, class_id, id_card_number, student_id_number)
+            if student_number:
+                self.by_number.setdefault(student_number, student_id) # 與逐行查詢相同，學號重複時使用第一個學生
+            self._claim(student_id, self._unique_keys(student_number, class_id, id_card_number, student_id_number))
+
+    @staticmethod
+    def _unique_keys(student_number, class_id, id_card_number, student_id_number):
+        keys = set()
+        if student_number:
+            keys.add(('number_class', (student_number, class_id)))
+        if id_card_number:
+            keys.add(('id_card_number', id_card_number))
+        if student_id_number:
+            keys.add(('student_id_number', student_id_number))
+        return keys
+
+    def _claim(self, key, unique_keys):
+        for unique_key in self.claims.get(key, ()):
+            if self.owners.get(unique_key) == key:
+                del self.owners[unique_key]
+        for unique_key in unique_keys:
+            self.owners[unique_key] = key
+        self.claims[key] = unique_keys
+
+    def add(self, student_number, name, class_id, id_card_number, student_id_number):
+        """
+        加入一行，返回 (動作 'insert' / 'update', 名稱, 之前的值 (新增時為 None), 寫入的值)；
+        唯一性衝突時記錄錯誤並跳過該行 (返回 None)
+        """
+        label = _student_label(name, student_number)
+        key = self.by_number.get(student_number) if student_number else None
+        if key is None:
+            self._new_count += 1
+            key = ('new', self._new_count)
+
+        unique_keys = self._unique_keys(student_number, class_id, id_card_number, student_id_number)
+        conflicts = [unique_key for unique_key in unique_keys if self.owners.get(unique_key, key) != key]
+        if conflicts:
+            details = ", ".join(f"{STUDENT_UNIQUE_LABELS[key_name]} 已被其他學生使用" for key_name, _ in sorted(conflicts))
+            self.errors.append(f"{label} 數據無效 (唯一性衝突): {details}")
+            return None
+
+        self._claim(key, unique_keys)
+        if student_number:
+            self.by_number[student_number] = key
+        entry = self.rows.get(key)
+        if entry is None:
+            entry = self.rows[key] = {'key': key, 'imported': 0, 'updated': 0}
+            if isinstance(key, int):
+                entry['updated'] += 1
+                action, previous = 'update', self.current.get(key)
+            else:
+                entry['imported'] += 1
+                action, previous = 'insert', None
+        else:
+            # 同一文件中重複的學號：與前面的行比較
+            entry['updated'] += 1
+            action, previous = 'update', entry['values']
+        student_id = key if isinstance(key, int) else None
+        entry['values'] = (student_id, student_number, name, class_id, id_card_number, student_id_number)
+        entry['label'] = label
+        return action, label, previous, entry['values']
+
+    def take_batch(self):
+        """取出目前累積的項目 (寫入後請呼叫 resolve / discard 更新索引)"""
+        entries = list(self.rows.values())
+        self.rows = {}
+        return entries
+
+    def resolve(self, key, student_id, student_number):
+        """新學生寫入後，以實際的 student_id 取代暫時的鍵，之後重複的學號會被視為更新"""
+        if self.by_number.get(student_number) == key:
+            self.by_number[student_number] = student_id
+        self.claims[student_id] = self.claims.pop(key, set())
+        for unique_key in self.claims[student_id]:
+            if self.owners.get(unique_key) == key:
+                self.owners[unique_key] = student_id
+
+    def discard(self, key, student_number):
+        """新學生寫入失敗時，釋放它佔用的學號與唯一值"""
+        self._claim(key, set())
+        del self.claims[key]
+        if student_number and self.by_number.get(student_number) == key:
+            del self.by_number[student_number]
+
+
+def upsert_students(cursor, entries, chunk_size):
+    """
+    寫入學生項目，返回 (寫入成功的項目, 錯誤訊息列表)。
+    先更新既有學生再插入新學生，讓更新釋放的 ID 卡號碼等唯一值可以由同一批中的新學生使用。
+    """
+    written = []
+    errors = []
+    updates = [entry for entry in entries if entry['values'][0] is not None]
+    inserts = [entry for entry in entries if entry['values'][0] is None]
+    _write_import_batches(cursor, STUDENT_UPSERT_SQL, updates, chunk_size, written, errors, '匯入學生 CSV')
+    _write_import_batches(cursor, STUDENT_INSERT_SQL, inserts, chunk_size, written, errors, '匯入學生 CSV')
+    return written, errors
+
+
+def _flush_students(job, conn, cursor, plan):
+    """寫入並提交一批學生，然後更新計劃中的新學生 ID"""
+    entries = plan.take_batch()
+    chunk_size = config.CSV_IMPORT_CHUNK_SIZE
+    written, write_errors = upsert_students(cursor, entries, chunk_size)
+
+    # 取得新學生的 ID (多行 INSERT 只返回第一個自動編號，因此按學號與班級查詢；沒有學號的學生之後不會再被引用)
+    new_entries = [entry for entry in written if entry['values'][0] is None and entry['values'][1]]
+    keys_by_number_class = {(entry['values'][1], entry['values'][3]): entry['key'] for entry in new_entries}
+    for chunk in _chunks(list(keys_by_number_class), chunk_size):
+        cursor.execute(STUDENT_ID_LOOKUP_SQL.format(values=', '.join(['(%s, %s)'] * len(chunk))),
+                       [value for pair in chunk for value in pair])
+        for student_id, student_number, class_id in cursor.fetchall():
+            key = keys_by_number_class.get((student_number, class_id))
+            if key is not None:
+                plan.resolve(key, student_id, student_number)
+    if written:
+        # 更新的學生及其新舊班級、新學生所在班級的資料版本
+        updated_ids = [entry['key'] for entry in written if isinstance(entry['key'], int)]
+        class_ids = {entry['values'][3] for entry in written}
+        class_ids.update(plan.current[student_id][3] for student_id in updated_ids if student_id in plan.current)
+        bump_data_versions(cursor, student_ids=updated_ids, class_ids=class_ids)
+    conn.commit()
+    flush_invalidations() # 匯入期間一直使用同一個連接，每批提交後即使快取失效
+
+    written_keys = {entry['key'] for entry in written}
+    for entry in entries:
+        if entry['key'] not in written_keys and not isinstance(entry['key'], int):
+            plan.discard(entry['key'], entry['values'][1])
+    job.imported += sum(entry['imported'] for entry in written)
+    job.updated += sum(entry['updated'] for entry in written)
+    job.add_errors(plan.errors + write_errors)
+    plan.errors = []
+
+
+STUDENT_DIFF_LABELS = ('學號', '姓名', '班級', 'ID卡號碼', '學生證號碼')
+
+
+def _run_student_import(job, conn):
+    cursor = conn.cursor()
+    try:
+        # 班級映射來自班級目錄；預先載入所有學生的學號和唯一欄位 (每次匯入只查詢一次)
+        class_id_to_name, class_name_to_id = class_catalog.maps()
+        cursor.execute(STUDENT_PREFETCH_SQL)
+        plan = StudentImportPlan(cursor.fetchall())
+        if job.dry_run:
+            conn.commit() # 預覽不寫入，結束讀取快照
+
+        def describe(previous, current):
+            def shown(values):
+                _, student_number, name, class_id, id_card_number, student_id_number = values
+                return student_number, name, class_id_to_name.get(class_id, class_id), id_card_number, student_id_number
+            return _describe_changes(STUDENT_DIFF_LABELS, previous and shown(previous), shown(current))
+
+        raw, reader = _open_csv(job.path)
+        with raw:
+            columns = _read_header(reader, 'students')
+            pending = 0
+            for row in reader:
+                job.rows += 1
+                pending += 1
+                errors_before = len(plan.errors)
+                outcome = None
+                # 確保行數據長度足夠包含所有預期的欄位
+                if not row or len(row) < max(columns['name'], columns['class_name']) + 1:
+                    plan.errors.append(f"跳過無效行 (欄位不足): {row}")
+                else:
+                    student_number = _cell(row, columns['student_number'])
+                    name = row[columns['name']].strip()
+                    class_name = row[columns['class_name']].strip()
+                    class_id = class_name_to_id.get(class_name)
+                    if class_id is None:
+                        plan.errors.append(f"{_student_label(name, student_number)} 的班級 '{class_name}' 不存在。")
+                    else:
+                        # 學號已存在則更新該學生，否則新增
+                        outcome = plan.add(student_number, name, class_id,
+                                           _cell(row, columns['id_card_number']), _cell(row, columns['student_id_number']))
+                if job.dry_run:
+                    _record_row_diff(job, job.rows + 1, outcome, plan.errors[errors_before:], describe)
+
+                if pending >= _commit_rows(job):
+                    if not job.dry_run:
+                        _flush_students(job, conn, cursor, plan)
+                    job.bytes_read = raw.tell()
+                    pending = 0
+            if job.dry_run:
+                job.add_errors(plan.errors)
+            else:
+                _flush_students(job, conn, cursor, plan)
+    finally:
+        cursor.close()
+
+
+# --- 使用者匯入 ---
+# 與學生相同，既有使用者以主鍵觸發 ON DUPLICATE KEY UPDATE，新使用者以一般的多行 INSERT 插入
+USER_UPSERT_SQL = (
+    "INSERT INTO users (user_id, username, password_hash, role, teacher_name, id_card_number) VALUES {values} "
+    "ON DUPLICATE KEY UPDATE password_hash = VALUES(password_hash), role = VALUES(role), "
+    "teacher_name = VALUES(teacher_name), id_card_number = VALUES(id_card_number)"
+)
+USER_INSERT_SQL = "INSERT INTO users (user_id, username, password_hash, role, teacher_name, id_card_number) VALUES {values}"
+# 預先載入所有使用者與 (預覽時) 班級分配，按使用者名稱查詢新使用者的 ID，按使用者查詢目前的班級分配
+USER_PREFETCH_SQL = "SELECT user_id, username, id_card_number, role, teacher_name FROM users"
+TEACHER_CLASSES_PREFETCH_SQL = "SELECT user_id, class_id FROM teacher_classes"
+USER_ID_LOOKUP_SQL = "SELECT username, user_id FROM users WHERE username IN ({values})"
+TEACHER_CLASSES_LOOKUP_SQL = "SELECT user_id, class_id FROM teacher_classes WHERE user_id IN ({values})"
+USER_ROLES = ('admin', 'supervisor', 'teacher')
+
+
+class UserImportPlan:
+    """
+    在記憶體中將使用者行分類為新增或更新 (以使用者名稱判斷)，並預先檢查 ID 卡號碼的唯一性。
+    同一文件中重複的使用者名稱合併為一筆 (後面的行覆蓋前面的值)。
+    """
+
+    def __init__(self, existing_users, teacher_classes=()):
+        self.user_ids = {username: user_id for user_id, username, _, _, _ in existing_users}
+        self.card_owners = {id_card_number: username for _, username, id_card_number, _, _ in existing_users if id_card_number}
+        # 使用者名稱 -> 資料庫中目前的 (角色, 教師姓名, ID 卡號碼, 班級 ID 集合)，預覽時用於比較差異
+        classes_by_user = {}
+        for user_id, class_id in teacher_classes:
+            classes_by_user.setdefault(user_id, set()).add(class_id)
+        self.current = {username: (role, teacher_name, id_card_number, classes_by_user.get(user_id, set()))
+                        for user_id, username, id_card_number, role, teacher_name in existing_users}
+        self.rows = {} # 使用者名稱 -> 項目
+        self.errors = []
+
+    def add(self, username, password, role, teacher_name, id_card_number, class_ids):
+        """
+        加入一行，返回 (動作 'insert' / 'update', 名稱, 之前的值 (新增時為 None), 寫入的值)；
+        ID 卡號碼與其他使用者衝突時記錄錯誤並跳過該行 (返回 None)
+        """
+        if id_card_number and self.card_owners.get(id_card_number, username) != username:
+            self.errors.append(f"使用者 '{username}' 數據無效 (唯一性衝突): ID卡號碼 已被其他使用者使用")
+            return None
+        entry = self.rows.get(username)
+        if entry is None:
+            entry = self.rows[username] = {'label': f"使用者 '{username}'", 'imported': 0, 'updated': 0, 'id_card_number': None}
+            if username in self.user_ids:
+                entry['updated'] += 1
+                action, previous = 'update', self.current.get(username)
+            else:
+                entry['imported'] += 1
+                action, previous = 'insert', None
+        else:
+            # 同一文件中重複的使用者名稱：與前面的行比較
+            entry['updated'] += 1
+            action, previous = 'update', (entry['role'], entry['teacher_name'], entry['id_card_number'], entry['class_ids'])
+        if entry['id_card_number'] and self.card_owners.get(entry['id_card_number']) == username:
+            del self.card_owners[entry['id_card_number']] # 後面的行覆蓋前面的值，釋放前面佔用的 ID 卡號碼
+        if id_card_number:
+            self.card_owners[id_card_number] = username
+        entry.update(user_id=self.user_ids.get(username), username=username, password=password, role=role,
+                     teacher_name=teacher_name, id_card_number=id_card_number, class_ids=class_ids)
+        return action, entry['label'], previous, (role, teacher_name, id_card_number, class_ids)
+
+    def take_batch(self):
+        entries = list(self.rows.values())
+        self.rows = {}
+        return entries
+
+    def discard(self, entry):
+        """新使用者寫入失敗時，釋放它佔用的 ID 卡號碼"""
+        if entry['id_card_number'] and self.card_owners.get(entry['id_card_number']) == entry['username']:
+            del self.card_owners[entry['id_card_number']]
+
+
+def sync_teacher_classes(cursor, desired, chunk_size):
+    """
+    以差異方式更新 teacher_classes：desired 為 {user_id: 應有的班級 ID 集合}。
+    一次查詢讀取這些使用者目前的班級，只刪除多餘的關聯、插入缺少的關聯 (各自分批)。
+    """
+    if not desired:
+        return
+    user_ids = list(desired)
+    current = {user_id: set() for user_id in user_ids}
+    for chunk in _chunks(user_ids, chunk_size):
+        cursor.execute(TEACHER_CLASSES_LOOKUP_SQL.format(values=', '.join(['%s'] * len(chunk))), chunk)
+        for user_id, class_id in cursor.fetchall():
+            current[user_id].add(class_id)
+
+    to_delete = [(user_id, class_id) for user_id in user_ids for class_id in current[user_id] - desired[user_id]]
+    to_insert = [(user_id, class_id) for user_id in user_ids for class_id in desired[user_id] - current[user_id]]
+    for chunk in _chunks(to_delete, chunk_size):
+        cursor.execute(f"DELETE FROM teacher_classes WHERE (user_id, class_id) IN ({', '.join(['(%s, %s)'] * len(chunk))})",
+                       [value for pair in chunk for value in pair])
+    for chunk in _chunks(to_insert, chunk_size):
+        cursor.execute(f"INSERT INTO teacher_classes (user_id, class_id) VALUES {', '.join(['(%s, %s)'] * len(chunk))}",
+                       [value for pair in chunk for value in pair])
+
+
+def _flush_users(job, conn, cursor, plan):
+    """雜湊密碼後寫入並提交一批使用者，同時按差異更新這批教師的班級分配"""
+    entries = plan.take_batch()
+    chunk_size = config.CSV_IMPORT_CHUNK_SIZE
+
+    # 在進程池中平行計算這批使用者的密碼雜湊，完成後才開始寫入資料庫
+    for entry, hashed_password in zip(entries, hash_passwords(entry['password'] for entry in entries)):
+        entry['values'] = (entry['user_id'], entry['username'], hashed_password, entry['role'],
+                           entry['teacher_name'], entry['id_card_number'])
+
+    # 分批寫入：先更新既有使用者，再插入新使用者
+    written = []
+    write_errors = []
+    _write_import_batches(cursor, USER_UPSERT_SQL, [e for e in entries if e['user_id'] is not None],
+                          chunk_size, written, write_errors, '匯入使用者 CSV')
+    _write_import_batches(cursor, USER_INSERT_SQL, [e for e in entries if e['user_id'] is None],
+                          chunk_size, written, write_errors, '匯入使用者 CSV')
+
+    # 取得新使用者的 ID (多行 INSERT 只返回第一個自動編號，因此按使用者名稱查詢)
+    written_by_username = {entry['username']: entry for entry in written}
+    new_usernames = [entry['username'] for entry in written if entry['user_id'] is None]
+    for chunk in _chunks(new_usernames, chunk_size):
+        cursor.execute(USER_ID_LOOKUP_SQL.format(values=', '.join(['%s'] * len(chunk))), chunk)
+        for username, user_id in cursor.fetchall():
+            written_by_username[username]['user_id'] = user_id
+            plan.user_ids[username] = user_id # 之後的批次中重複的使用者名稱會被視為更新
+
+    # 按差異更新這批使用者的班級分配 (只有教師有分配班級)
+    sync_teacher_classes(cursor, {entry['user_id']: entry['class_ids'] for entry in written}, chunk_size)
+    if written:
+        # 教師姓名可能已更新；班級分配改變的使用者的權限快取
+        bump_data_versions(cursor, user_ids=[entry['user_id'] for entry in written if entry['user_id'] is not None])
+    conn.commit()
+    flush_invalidations()
+
+    for entry in entries:
+        if entry['username'] not in written_by_username and entry['user_id'] is None:
+            plan.discard(entry)
+    job.imported += sum(entry['imported'] for entry in written)
+    job.updated += sum(entry['updated'] for entry in written)
+    job.add_errors(plan.errors + write_errors)
+    plan.errors = []
+
+
+USER_DIFF_LABELS = ('角色', '教師姓名', 'ID卡號碼', '分配班級')
+
+
+def _run_user_import(job, conn):
+    cursor = conn.cursor()
+    try:
+        # 班級映射 (處理分配班級) 來自班級目錄；預先載入所有使用者
+        class_id_to_name, class_name_to_id = class_catalog.maps()
+        cursor.execute(USER_PREFETCH_SQL)
+        users = cursor.fetchall()
+        teacher_classes = ()
+        if job.dry_run:
+            # 預覽需要比較目前的班級分配 (正式匯入時由 sync_teacher_classes 按批次查詢)
+            cursor.execute(TEACHER_CLASSES_PREFETCH_SQL)
+            teacher_classes = cursor.fetchall()
+            conn.commit() # 預覽不寫入，結束讀取快照
+        plan = UserImportPlan(users, teacher_classes)
+
+        def describe(previous, current):
+            def shown(values):
+                role, teacher_name, id_card_number, class_ids = values
+                return role, teacher_name, id_card_number, ", ".join(sorted(class_id_to_name.get(c, str(c)) for c in class_ids))
+            changes = _describe_changes(USER_DIFF_LABELS, previous and shown(previous), shown(current))
+            if previous is not None:
+                changes.append("密碼: 將重設為 CSV 中的密碼")
+            return changes
+
+        raw, reader = _open_csv(job.path)
+        with raw:
+            columns = _read_header(reader, 'users')
+            pending = 0
+            for row in reader:
+                job.rows += 1
+                pending += 1
+                errors_before = len(plan.errors)
+                outcome = None
+                # 確保行數據長度足夠包含所有預期的欄位
+                if not row or len(row) < max(columns['username'], columns['password'], columns['role']) + 1:
+                    plan.errors.append(f"跳過無效行 (欄位不足): {row}")
+                else:
+                    username = row[columns['username']].strip()
+                    role = row[columns['role']].strip().lower() # 角色轉換為小寫
+                    if role not in USER_ROLES:
+                        plan.errors.append(f"使用者 '{username}' 的角色無效: {row}")
+                    else:
+                        # 教師的分配班級 (其他角色不分配班級)
+                        class_ids = set()
+                        assigned_classes_str = _cell(row, columns['assigned_classes'])
+                        if role == 'teacher' and assigned_classes_str:
+                            for class_name in (name.strip() for name in assigned_classes_str.split(',')):
+                                if not class_name:
+                                    continue
+                                if class_name in class_name_to_id:
+                                    class_ids.add(class_name_to_id[class_name])
+                                else:
+                                    plan.errors.append(f"使用者 '{username}' 分配的班級 '{class_name}' 不存在。")
+                        outcome = plan.add(username, row[columns['password']].strip(), role, _cell(row, columns['teacher_name']),
+                                           _cell(row, columns['id_card_number']), class_ids)
+                if job.dry_run:
+                    _record_row_diff(job, job.rows + 1, outcome, plan.errors[errors_before:], describe)
+
+                if pending >= _commit_rows(job):
+                    if not job.dry_run:
+                        _flush_users(job, conn, cursor, plan)
+                    job.bytes_read = raw.tell()
+                    pending = 0
+            if job.dry_run:
+                job.add_errors(plan.errors)
+            else:
+                _flush_users(job, conn, cursor, plan)
+    finally:
+        cursor.close()
+
+
+RUNNERS = {'students': _run_student_import, 'users': _run_user_import}
+
+
+def _run_job(app, job):
+    """背景執行緒的進入點：在應用程式上下文中執行匯入，結束時刪除暫存文件 (成功的預覽保留文件等待確認)"""
+    with app.app_context():
+        job.status = 'running'
+        conn = None
+        try:
+            conn = acquire_connection()
+            RUNNERS[job.kind](job, conn)
+            job.status = 'done'
+        except CSVImportError as e:
+            job.status = 'failed'
+            job.message = str(e)
+        except (mysql.connector.Error, UnicodeDecodeError, csv.Error) as err:
+            job.status = 'failed'
+            if job.single_batch:
+                job.message = f"匯入在第 {job.rows} 行附近中止，所有變更已回滾: {err}"
+            else:
+                job.message = f"匯入在第 {job.rows} 行附近中止 (之前已提交的批次會保留): {err}"
+            app.logger.error(f"匯入 CSV 失敗 ({job.kind}): {err}")
+        except Exception as e:
+            job.status = 'failed'
+            job.message = f"讀取或處理 CSV 文件時發生錯誤: {e}"
+            app.logger.exception(f"讀取或處理 CSV 文件時發生錯誤 ({job.kind})")
+        finally:
+            if conn is not None:
+                release_connection(conn) # 回滾未提交的批次
+            if job.kind == 'users' and not job.dry_run:
+                invalidate_user() # 匯入可能更新了多個使用者，清空整個使用者快取
+            if job.kind == 'students' and not job.dry_run:
+                invalidate_card_index() # 學生名單與卡號可能已改變
+            if not (job.dry_run and job.status == 'done'):
+                _remove_file(job.path)
+            job.finished_at = time.time()
+            _schedule_purge(job)
+
+
+def _start_job(job):
+    _register_job(job)
+    thread = threading.Thread(target=_run_job, args=(current_app._get_current_object(), job),
+                              name=f'csv-import-{job.id}', daemon=True)
+    thread.start()
+    return job
+
+
+def start_import_job(kind, upload, user_id, dry_run=False):
+    """
+    將上傳的文件分塊複製到暫存文件並檢查表頭，然後在背景執行緒中開始匯入 (dry_run 為 True 時只預覽)，返回 ImportJob。
+    表頭不正確時拋出 CSVImportError (不會建立任務)。
+    """
+    fd, path = tempfile.mkstemp(prefix=f'import_{kind}_', suffix='.csv')
+    try:
+        with os.fdopen(fd, 'wb') as f:
+            shutil.copyfileobj(upload.stream, f, 64 * 1024)
+        raw, reader = _open_csv(path)
+        with raw:
+            _read_header(reader, kind)
+    except (CSVImportError, UnicodeDecodeError, csv.Error, OSError):
+        os.remove(path)
+        raise
+
+    return _start_job(ImportJob(kind, user_id, path, dry_run=dry_run))
+
+
+def commit_preview_job(preview):
+    """
+    以預覽任務的暫存文件開始正式匯入 (所有行在一個事務中寫入)，返回新的 ImportJob。
+    寫入時會以最新的資料庫內容重新分類與檢查，預覽之後其他人修改的數據會以錯誤的形式報告。
+    預覽尚未完成或已經確認過時拋出 CSVImportError。
+    """
+    with _jobs_lock:
+        if not preview.dry_run or preview.status != 'done' or preview.committed_job_id is not None:
+            raise CSVImportError("此預覽無法確認 (尚未完成或已經匯入)")
+        job = ImportJob(preview.kind, preview.user_id, preview.path, single_batch=True)
+        preview.committed_job_id = job.id
+    return _start_job(job)
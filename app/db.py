@@ -0,0 +1,229 @@
+# app/db.py
+# 資料庫連接池與請求範圍連接管理
+import os
+import time
+import threading
+from collections import deque
+
+import mysql.connector
+from mysql.connector.errors import PoolError
+from flask import g, has_app_context
+
+import config
+from app.cache import flush_invalidations
+
+
+class PoolTimeout(PoolError):
+    """在 DB_POOL_TIMEOUT 秒內無法從連接池取得連接時拋出"""
+    pass
+
+
+class ConnectionPool:
+    """
+    簡單的執行緒安全連接池。
+    - 常駐 size 個閒置連接，尖峰時最多再額外開啟 max_overflow 個連接 (用完即關閉)。
+    - 連接全部被借出時，最多等待 timeout 秒，逾時拋出 PoolTimeout。
+    - 借出前會檢查連接是否過期 (recycle 秒) 或已斷線 (pre_ping)，避免拿到失效連接。
+    """
+    def __init__(self, size=5, max_overflow=10, timeout=10, recycle=3600, pre_ping=True, **connect_args):
+        self.size = size
+        self.max_overflow = max_overflow
+        self.timeout = timeout
+        self.recycle = recycle
+        self.pre_ping = pre_ping
+        self.connect_args = connect_args
+        self._idle = deque() # (連接, 建立時間) 的堆疊，後進先出以保持熱連接
+        self._checked_out = 0
+        self._cond = threading.Condition()
+
+    def _connect(self):
+        """
+        建立一個新的實體連接。
+        連接使用 READ COMMITTED：每個查詢讀取最新提交的數據，而不是請求中第一個查詢建立的快照。
+        共用快取 (app/cache.py) 在呼叫載入函式之前讀取標籤令牌，載入函式的查詢必須看到令牌讀取之前提交的所有寫入，
+        否則會以新的令牌快取舊的數據。需要一致性快照的讀取 (例如 CSV 匯出) 以
+        start_transaction(consistent_snapshot=True, isolation_level='REPEATABLE READ') 明確開始事務。
+        """
+        conn = mysql.connector.connect(**self.connect_args)
+        cursor = conn.cursor()
+        try:
+            cursor.execute("SET SESSION TRANSACTION ISOLATION LEVEL READ COMMITTED")
+        finally:
+            cursor.close()
+        conn._pool_created_at = time.monotonic()
+        return conn
+
+    def _is_usable(self, conn):
+        """檢查閒置連接是否仍然可用"""
+        if self.recycle and time.monotonic() - conn._pool_created_at > self.recycle:
+            return False
+        if self.pre_ping:
+            try:
+                conn.ping(reconnect=False)
+            except mysql.connector.Error:
+                return False
+        return True
+
+    def _discard(self, conn):
+        """關閉並丟棄一個連接，忽略關閉時的錯誤"""
+        try:
+            conn.close()
+        except mysql.connector.Error:
+            pass
+
+    def acquire(self):
+        """從連接池借出一個連接，必要時建立新連接或等待"""
+        deadline = time.monotonic() + self.timeout
+        with self._cond:
+            while True:
+                if self._idle:
+                    conn = self._idle.pop()
+                    self._checked_out += 1
+                    break
+                if self._checked_out < self.size + self.max_overflow:
+                    conn = None
+                    self._checked_out += 1
+                    break
+                remaining = deadline - time.monotonic()
+                if remaining <= 0:
+                    raise PoolTimeout(f"在 {self.timeout} 秒內無法取得資料庫連接 (連接池已滿)")
+                self._cond.wait(remaining)
+
+        # 驗證與建立連接都在鎖外進行，避免阻塞其他執行緒
+        if conn is not None and not self._is_usable(conn):
+            self._discard(conn)
+            conn = None
+        if conn is None:
+            try:
+                conn = self._connect()
+            except Exception:
+                with self._cond:
+                    self._checked_out -= 1
+                    self._cond.notify()
+                raise
+        return conn
+
+    def release(self, conn):
+        """歸還連接：回滾未提交的事務，超出常駐數量的連接直接關閉"""
+        keep = False
+        try:
+            if conn.is_connected():
+                conn.rollback() # 結束交易快照，避免下一個請求讀到舊數據
+                keep = True
+        except mysql.connector.Error:
+            keep = False
+
+        with self._cond:
+            self._checked_out -= 1
+            if keep and len(self._idle) < self.size:
+                self._idle.append(conn)
+                conn = None
+            self._cond.notify()
+        if conn is not None:
+            self._discard(conn)
+
+    def dispose(self):
+        """關閉所有閒置連接 (例如在 fork 之後或關閉應用程式時)"""
+        with self._cond:
+            idle = list(self._idle)
+            self._idle.clear()
+        for conn in idle:
+            self._discard(conn)
+
+    def status(self):
+        """返回連接池目前的使用狀況，方便監控"""
+        with self._cond:
+            return {'size': self.size, 'max_overflow': self.max_overflow,
+                    'idle': len(self._idle), 'checked_out': self._checked_out}
+
+
+class RequestConnection:
+    """
+    請求範圍內共用的連接代理。
+    路由中原有的 conn.close() 不會真正關閉連接，連接會在應用程式上下文結束時
+    由 close_db() 統一歸還到連接池。
+    """
+    def __init__(self, raw):
+        object.__setattr__(self, '_raw', raw)
+
+    def __getattr__(self, name):
+        return getattr(self._raw, name)
+
+    def __setattr__(self, name, value):
+        setattr(self._raw, name, value)
+
+    def close(self):
+        pass # 由 teardown 處理歸還
+
+    def commit(self):
+        self._raw.commit()
+        flush_invalidations() # 提交後才使寫入路徑記錄的快取標籤失效
+
+
+_pool = None
+_pool_pid = None
+_pool_lock = threading.Lock()
+
+
+def get_pool():
+    """返回當前進程的連接池 (延遲建立；fork 後的子進程會建立自己的連接池)"""
+    global _pool, _pool_pid
+    pid = os.getpid()
+    if _pool is None or _pool_pid != pid:
+        with _pool_lock:
+            if _pool is None or _pool_pid != pid:
+                _pool = ConnectionPool(
+                    size=config.DB_POOL_SIZE,
+                    max_overflow=config.DB_POOL_MAX_OVERFLOW,
+                    timeout=config.DB_POOL_TIMEOUT,
+                    recycle=config.DB_POOL_RECYCLE,
+                    pre_ping=config.DB_POOL_PRE_PING,
+                    host=config.MYSQL_HOST,
+                    user=config.MYSQL_USER,
+                    password=config.MYSQL_PASSWORD,
+                    database=config.MYSQL_DB,
+                    consume_results=True, # 同一連接在請求內重複使用，自動讀完未讀取的結果集
+                )
+                _pool_pid = pid
+    return _pool
+
+
+def get_request_connection():
+    """
+    返回當前應用程式上下文共用的連接，第一次呼叫時才從連接池借出。
+    不在應用程式上下文中時 (例如獨立腳本)，直接借出一個連接，呼叫者需自行 close()。
+    """
+    if not has_app_context():
+        return get_pool()._connect()
+    conn = g.get('_db_conn')
+    if conn is None:
+        conn = RequestConnection(get_pool().acquire())
+        g._db_conn = conn
+    return conn
+
+
+def close_db(exc=None):
+    """teardown 處理函式：將本次請求借出的連接歸還到連接池"""
+    conn = g.pop('_db_conn', None)
+    if conn is not None:
+        get_pool().release(conn._raw)
+    flush_invalidations()
+
+
+def init_app(app):
+    """在應用程式上註冊連接歸還處理函式"""
+    app.teardown_appcontext(close_db)
+
+
+def acquire_connection():
+    """
+    借出一個不綁定請求上下文的連接，例如串流回應在視圖函式返回後仍需讀取數據時使用。
+    呼叫者必須在使用完畢後呼叫 release_connection() 歸還。
+    """
+    return get_pool().acquire()
+
+
+def release_connection(conn):
+    """歸還 acquire_connection() 借出的連接 (會回滾未提交的事務)"""
+    get_pool().release(conn)
+    flush_invalidations()
@@ -13,6 +13,7 @@ from wtforms.validators import (
 from flask_wtf.file import FileField, FileAllowed
 import mysql.connector
 from app.__init__ import get_db # 導入資料庫連接函式
+from app.models import AWARD_PUNISH_TYPES, COMPETITION_RESULTS, ABSENCE_TYPES # 共用的記錄類型定義
 from flask import current_app # 導入 current_app 以使用 logger
 
 
@@ -416,7 +417,7 @@ class RecordAbsenceForm(FlaskForm):
     """記錄缺席表單"""
     absence_date = DateField('缺席日期', format='%Y-%m-%d', validators=[DataRequired()]) # 指定日期格式
     session_count = IntegerField('缺席節數', validators=[DataRequired(), NumberRange(min=1)])
-    absence_type = SelectField('缺席類型', choices=[('事假', '事假'), ('病假', '病假'), ('無故缺席', '無故缺席'), ('其他', '其他')], validators=[DataRequired()]) # 添加'其他'選項
+    absence_type = SelectField('缺席類型', choices=[(t, t) for t in ABSENCE_TYPES], validators=[DataRequired()]) # 添加'其他'選項
     reason = TextAreaField('原因 (可選)', validators=[Optional(), Length(max=500)]) # 添加長度限制
     proof = FileField('證明文件 (可選)', validators=[FileAllowed(['jpg', 'png', 'pdf', 'doc', 'docx'], '只允許圖片、PDF和Word文件!'), Optional()]) # 允許更多文件類型，並設定為 Optional
     submit = SubmitField('記錄缺席')
@@ -425,7 +426,7 @@ class EditAbsenceForm(FlaskForm):
     """修改缺席記錄表單"""
     absence_date = DateField('缺席日期', format='%Y-%m-%d', validators=[DataRequired()]) # 指定日期格式
     session_count = IntegerField('缺席節數', validators=[DataRequired(), NumberRange(min=1)])
-    absence_type = SelectField('缺席類型', choices=[('事假', '事假'), ('病假', '病假'), ('無故缺席', '無故缺席'), ('其他', '其他')], validators=[DataRequired()]) # 添加'其他'選項
+    absence_type = SelectField('缺席類型', choices=[(t, t) for t in ABSENCE_TYPES], validators=[DataRequired()]) # 添加'其他'選項
     reason = TextAreaField('原因 (可選)', validators=[Optional(), Length(max=500)]) # 添加長度限制
     proof = FileField('證明文件 (可選)', validators=[FileAllowed(['jpg', 'png', 'pdf', 'doc', 'docx'], '只允許圖片、PDF和Word文件!'), Optional()]) # 允許更多文件類型，並設定為 Optional
     # delete_proof = BooleanField('刪除現有證明') # 這個欄位通常直接在模板中使用 input type="checkbox" 來處理
@@ -435,7 +436,7 @@ class EditAbsenceForm(FlaskForm):
 class RecordAwardPunishForm(FlaskForm):
     """記錄獎懲表單"""
     record_date = DateField('記錄日期', format='%Y-%m-%d', validators=[DataRequired()]) # 指定日期格式
-    record_type = SelectField('獎懲類型', choices=[('表揚', '表揚'), ('優點', '優點'), ('小功', '小功'), ('大功', '大功'), ('警告', '警告'), ('缺點', '缺點'), ('小過', '小過'), ('大過', '大過')], validators=[DataRequired()])
+    record_type = SelectField('獎懲類型', choices=[(t, t) for t in AWARD_PUNISH_TYPES], validators=[DataRequired()])
     description = TextAreaField('描述', validators=[DataRequired(), Length(max=1000)]) # 添加長度限制
     proof = FileField('證明文件 (可選)', validators=[FileAllowed(['jpg', 'png', 'pdf', 'doc', 'docx'], '只允許圖片、PDF和Word文件!'), Optional()]) # 允許更多文件類型，並設定為 Optional
     submit = SubmitField('記錄獎懲')
@@ -443,7 +444,7 @@ class RecordAwardPunishForm(FlaskForm):
 class EditAwardPunishForm(FlaskForm):
     """修改獎懲記錄表單"""
     record_date = DateField('記錄日期', format='%Y-%m-%d', validators=[DataRequired()]) # 指定日期格式
-    record_type = SelectField('獎懲類型', choices=[('表揚', '表揚'), ('優點', '優點'), ('小功', '小功'), ('大功', '大功'), ('警告', '警告'), ('缺點', '缺點'), ('小過', '小過'), ('大過', '大過')], validators=[DataRequired()])
+    record_type = SelectField('獎懲類型', choices=[(t, t) for t in AWARD_PUNISH_TYPES], validators=[DataRequired()])
     description = TextAreaField('描述', validators=[DataRequired(), Length(max=1000)]) # 添加長度限制
     proof = FileField('證明文件 (可選)', validators=[FileAllowed(['jpg', 'png', 'pdf', 'doc', 'docx'], '只允許圖片、PDF和Word文件!'), Optional()]) # 允許更多文件類型，並設定為 Optional
     submit = SubmitField('更新記錄')
@@ -453,7 +454,7 @@ class RecordCompetitionForm(FlaskForm):
     """記錄參賽表單"""
     comp_date = DateField('參賽日期', format='%Y-%m-%d', validators=[DataRequired()]) # 指定日期格式
     comp_name = StringField('比賽名稱', validators=[DataRequired(), Length(max=255)])
-    result = SelectField('結果', choices=[('參與', '參與'), ('入圍', '入圍'), ('得獎', '得獎')], validators=[DataRequired()])
+    result = SelectField('結果', choices=[(r, r) for r in COMPETITION_RESULTS], validators=[DataRequired()])
     description = TextAreaField('描述/備註 (可選)', validators=[Optional(), Length(max=1000)]) # 添加長度限制
     proof = FileField('證明文件 (可選)', validators=[FileAllowed(['jpg', 'png', 'pdf', 'doc', 'docx'], '只允許圖片、PDF和Word文件!'), Optional()]) # 允許更多文件類型，並設定為 Optional
     submit = SubmitField('記錄參賽')
@@ -462,7 +463,7 @@ class EditCompetitionForm(FlaskForm):
     """修改參賽記錄表單"""
     comp_date = DateField('參賽日期', format='%Y-%m-%d', validators=[DataRequired()]) # 指定日期格式
     comp_name = StringField('比賽名稱', validators=[DataRequired(), Length(max=255)])
-    result = SelectField('結果', choices=[('參與', '參與'), ('入圍', '入圍'), ('得獎', '得獎')], validators=[DataRequired()])
+    result = SelectField('結果', choices=[(r, r) for r in COMPETITION_RESULTS], validators=[DataRequired()])
     description = TextAreaField('描述/備註 (可選)', validators=[Optional(), Length(max=1000)]) # 添加長度限制
     proof = FileField('證明文件 (可選)', validators=[FileAllowed(['jpg', 'png', 'pdf', 'doc', 'docx'], '只允許圖片、PDF和Word文件!'), Optional()]) # 允許更多文件類型，並設定為 Optional
     submit = SubmitField('更新記錄')
@@ -498,6 +499,29 @@ class EditIncompleteHomeworkForm(FlaskForm):
     submit = SubmitField('更新記錄')
 
 
+# 全班批量記錄表單
+class BatchRecordRowForm(FlaskForm):
+    """批量記錄中一個學生的一行 (用於 FieldList)"""
+    class Meta:
+        csrf = False # CSRF token 由外層表單提供
+
+    student_id = IntegerField('Student ID', validators=[InputRequired()])
+    late = BooleanField('遲到')
+    absence_sessions = IntegerField('缺席節數', validators=[Optional(), NumberRange(min=1)])
+    absence_type = SelectField('缺席類型', choices=[(t, t) for t in ABSENCE_TYPES], validators=[Optional()])
+    incomplete_homework = BooleanField('欠交功課')
+
+class BatchRecordForm(FlaskForm):
+    """全班批量記錄遲到、缺席與欠交功課 (所有學生共用日期與備註)"""
+    record_date = DateField('記錄日期', format='%Y-%m-%d', validators=[DataRequired()])
+    late_reason = StringField('遲到原因 (可選)', validators=[Optional(), Length(max=500)])
+    absence_reason = StringField('缺席原因 (可選)', validators=[Optional(), Length(max=500)])
+    homework_subject = StringField('欠交功課科目 (可選)', validators=[Optional(), Length(max=100)])
+    homework_description = StringField('欠交功課描述/備註 (可選)', validators=[Optional(), Length(max=500)])
+    rows = FieldList(FormField(BatchRecordRowForm), min_entries=0)
+    submit = SubmitField('提交全班記錄')
+
+
 # CSV 導入表單
 class CSVUploadForm(FlaskForm):
     """CSV 文件上傳表單"""
@@ -505,4 +529,5 @@ class CSVUploadForm(FlaskForm):
         DataRequired(),
         FileAllowed(['csv'], '只允許 CSV 文件!')
     ])
+    dry_run = BooleanField('先預覽變更 (不寫入資料庫，確認後再一次匯入)', default=True)
     submit = SubmitField('上傳並導入')
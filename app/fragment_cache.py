@@ -0,0 +1,54 @@
+# app/fragment_cache.py
+# 渲染結果片段快取
+#
+# 學生列表的表格與學生記錄頁面的內容每天只改變幾次，但每次請求都重新渲染。這裡將渲染好的片段保存在共用快取中：
+# - 模板中使用 {% cache 名稱, 標籤列表 %} ... {% endcache %}，例如
+#       {% cache 'roster_table:%s:%s'|format(class_id, term), ['class:%s'|format(class_id)] %} ... {% endcache %}
+# - 視圖中使用 cached_fragment(名稱, 標籤列表, 渲染函式)，例如學生記錄時間線每個分頁標籤的 JSON 內容。
+# 鍵包括使用者角色 (修改 / 刪除按鈕因角色而異)，per_user 為 True 時再加上使用者 ID (例如教師只能修改自己的記錄)，
+# 以及程式版本 (部署新模板後舊的片段自動失效)。標籤的令牌就是片段的資料版本：
+# 寫入記錄時 bump_data_versions() 使該學生與其班級的標籤失效 (提交後)，帶有這些標籤的片段在下一次讀取時重新渲染。
+# 片段內容只能依賴鍵中包含的值與標籤涵蓋的資料。
+from flask_login import current_user
+from jinja2 import nodes
+from jinja2.ext import Extension
+from markupsafe import Markup
+
+from app.cache import shared_cache
+from app.http_cache import code_fingerprint
+
+
+def fragment_key(name, per_user=False):
+    """片段在共用快取中的鍵"""
+    parts = ['fragment', code_fingerprint(), name, current_user.role]
+    if per_user:
+        parts.append(str(current_user.get_id()))
+    return ':'.join(parts)
+
+
+def cached_fragment(name, tags, render, per_user=False, ttl=None):
+    """返回快取的片段；未命中或標籤已失效時呼叫 render() 渲染並保存"""
+    return shared_cache.get_or_set(fragment_key(name, per_user), render, tags=list(tags), ttl=ttl)
+
+
+class FragmentCacheExtension(Extension):
+    """Jinja 擴展：{% cache 名稱[, 標籤列表] %} ... {% endcache %}"""
+    tags = {'cache'}
+
+    def parse(self, parser):
+        lineno = next(parser.stream).lineno
+        args = [parser.parse_expression()]
+        if parser.stream.skip_if('comma'):
+            args.append(parser.parse_expression())
+        else:
+            args.append(nodes.List([]))
+        body = parser.parse_statements(('name:endcache',), drop_needle=True)
+        return nodes.CallBlock(self.call_method('_render', args), [], [], body).set_lineno(lineno)
+
+    def _render(self, name, tags, caller):
+        return Markup(cached_fragment(name, tags, lambda: str(caller())))
+
+
+def init_app(app):
+    """在應用程式的 Jinja 環境中註冊 {% cache %} 標籤"""
+    app.jinja_env.add_extension(FragmentCacheExtension)
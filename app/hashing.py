@@ -0,0 +1,75 @@
+# app/hashing.py
+# 批量密碼雜湊 (CSV 匯入使用者時使用)
+#
+# werkzeug 預設的 scrypt 雜湊每個密碼需要數十毫秒的 CPU 時間，逐個在請求中計算時，
+# 匯入數百個帳號會佔用工作進程很長時間。這裡使用進程池將雜湊分散到所有 CPU 核心上計算。
+# 進程池在第一次使用時建立並在進程內重複使用 (fork 後的子進程會建立自己的進程池)。
+# 子進程以 forkserver 方式啟動 (不支援時使用 spawn)，避免在多執行緒的 Web 伺服器中 fork 帶來的鎖狀態問題：
+# 子進程從只導入了 werkzeug.security 的 forkserver 進程 fork 出來，不繼承 Web 進程的執行緒、連接池與鎖。
+# 注意：multiprocessing 仍會在每個子進程中以 __mp_main__ 名稱重新導入主腳本 (python run.py 時為 run.py)，
+# 主腳本中建立應用程式、連接資料庫或啟動伺服器的程式碼必須放在 if __name__ == '__main__' (或
+# if __name__ != '__mp_main__') 之下，見 run.py；使用 flask run 或 WSGI 伺服器時主腳本是它們自己的入口，不受影響。
+import multiprocessing
+import os
+import threading
+from concurrent.futures import ProcessPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
+
+from werkzeug.security import generate_password_hash
+
+import config
+
+
+_executor = None
+_executor_pid = None
+_executor_lock = threading.Lock()
+
+
+def _worker_count():
+    return config.PASSWORD_HASH_WORKERS or os.cpu_count() or 1
+
+
+def _mp_context():
+    """forkserver (Unix) 或 spawn (Windows) 的 multiprocessing 上下文"""
+    if 'forkserver' in multiprocessing.get_all_start_methods():
+        context = multiprocessing.get_context('forkserver')
+        context.set_forkserver_preload(['werkzeug.security'])
+        return context
+    return multiprocessing.get_context('spawn')
+
+
+def _get_executor():
+    """返回當前進程的雜湊進程池 (延遲建立)"""
+    global _executor, _executor_pid
+    pid = os.getpid()
+    if _executor is None or _executor_pid != pid:
+        with _executor_lock:
+            if _executor is None or _executor_pid != pid:
+                _executor = ProcessPoolExecutor(max_workers=_worker_count(),
+                                                mp_context=_mp_context())
+                _executor_pid = pid
+    return _executor
+
+
+def _reset_executor():
+    global _executor
+    with _executor_lock:
+        if _executor is not None:
+            _executor.shutdown(wait=False, cancel_futures=True)
+        _executor = None
+
+
+def hash_passwords(passwords):
+    """
+    返回與 passwords 順序相同的雜湊列表。
+    數量很少或只有一個 CPU 時直接在本進程計算；進程池無法使用時 (例如子進程被終止) 也退回逐個計算。
+    """
+    passwords = list(passwords)
+    if len(passwords) < 2 or _worker_count() < 2:
+        return [generate_password_hash(password) for password in passwords]
+    chunksize = max(len(passwords) // (_worker_count() * 4), 1)
+    try:
+        return list(_get_executor().map(generate_password_hash, passwords, chunksize=chunksize))
+    except (BrokenProcessPool, OSError):
+        _reset_executor() # 下次使用時重新建立進程池
+        return [generate_password_hash(password) for password in passwords]
@@ -0,0 +1,131 @@
+# app/http_cache.py
+# 讀取頁面的 HTTP 條件請求 (ETag / Last-Modified)
+#
+# 寫入路徑在同一事務中以 app.models.bump_data_versions() 遞增 data_versions 表中的版本 (學生、班級、班級目錄、使用者資料)。
+# 全校範圍的頁面 (主管查看所有記錄) 使用 (scope, None)：該範圍所有行的版本合計，而不是每個寫入事務都要鎖定的全校版本行。
+# 讀取頁面在執行查詢與渲染之前先以一個主鍵查詢讀取相關的版本，與使用者、角色、請求網址及程式版本一起組成 ETag；
+# 瀏覽器帶著相同的 If-None-Match (或不早於 Last-Modified 的 If-Modified-Since) 重新請求時直接返回 304，不執行頁面的查詢。
+# 使用方式 (權限檢查之後)：
+#     not_modified, validators = conditional_request([('class', class_id)])
+#     if not_modified:
+#         return not_modified
+#     ...
+#     return with_validators(render_template(...), validators)
+# 有待顯示的閃現訊息時不使用條件請求，否則訊息會留到下一個頁面才顯示。
+import hashlib
+import os
+from datetime import timezone
+
+import mysql.connector
+from flask import current_app, request, session, make_response
+from flask_login import current_user
+
+from app.__init__ import get_db
+
+
+_fingerprint = None
+
+
+def code_fingerprint():
+    """模板與程式檔案的修改時間和大小的雜湊：部署新版本後舊的 ETag 自動失效 (同一主機上的所有工作進程相同)"""
+    global _fingerprint
+    if _fingerprint is None:
+        app_folder = os.path.dirname(os.path.abspath(__file__))
+        digest = hashlib.sha1()
+        for folder, _, files in sorted(os.walk(app_folder)):
+            if '__pycache__' in folder:
+                continue
+            for name in sorted(files):
+                if name.endswith(('.py', '.html')):
+                    stat = os.stat(os.path.join(folder, name))
+                    digest.update(f"{folder}/{name}:{stat.st_mtime_ns}:{stat.st_size};".encode())
+        _fingerprint = digest.hexdigest()[:16]
+    return _fingerprint
+
+
+def read_data_versions(cursor, scopes):
+    """
+    以一個查詢讀取 [(scope, scope_id), ...] 的版本，返回 ({(scope, scope_id): version}, 最後更新時間或 None)。
+    scope_id 為 None 時讀取該範圍所有行的 (行數, 版本合計) (主鍵前綴的範圍掃描)：任何一行遞增都會改變合計。
+    """
+    exact = [scope for scope in scopes if scope[1] is not None]
+    selects = []
+    params = []
+    if exact:
+        selects.append(f"SELECT scope, scope_id, CAST(version AS CHAR), updated_at FROM data_versions"
+                       f" WHERE (scope, scope_id) IN ({', '.join(['(%s, %s)'] * len(exact))})")
+        params.extend(value for scope in exact for value in scope)
+    for scope, scope_id in scopes:
+        if scope_id is None:
+            selects.append("SELECT scope, NULL, CONCAT(COUNT(*), '.', SUM(version)), MAX(updated_at) FROM data_versions"
+                           " WHERE scope = %s GROUP BY scope")
+            params.append(scope)
+    cursor.execute(' UNION ALL '.join(selects), params)
+    versions = {}
+    last_modified = None
+    for scope, scope_id, version, updated_at in cursor.fetchall():
+        versions[(scope, scope_id)] = version
+        if last_modified is None or updated_at > last_modified:
+            last_modified = updated_at
+    return versions, last_modified
+
+
+def conditional_request(scopes, cursor=None, extra=()):
+    """
+    讀取頁面依賴的資料版本並與請求的驗證器比較 (必須在權限檢查之後呼叫)。
+    返回 (304 回應或 None, 驗證器)；驗證器交給 with_validators() 加到正常的回應上，無法使用條件請求時為 None。
+    cursor 可傳入路由已開啟的游標 (非字典游標)，否則使用請求的連接。
+    extra 為頁面內容依賴、但不在資料版本中的其他值 (例如依今天日期決定的目前學期)，一併加到 ETag 中。
+    """
+    if request.method != 'GET' or session.get('_flashes'):
+        return None, None
+    own_cursor = cursor is None
+    try:
+        if own_cursor:
+            conn = get_db()
+            if not conn:
+                return None, None
+            cursor = conn.cursor()
+        versions, last_modified = read_data_versions(cursor, scopes)
+    except mysql.connector.Error as err:
+        current_app.logger.error(f"資料庫錯誤 (讀取資料版本): {err}")
+        return None, None
+    finally:
+        if own_cursor and cursor is not None:
+            cursor.close()
+
+    key = '|'.join([
+        code_fingerprint(), str(current_user.get_id()), current_user.role, request.full_path,
+        *(f"{scope}:{scope_id}:{versions.get((scope, scope_id), 0)}" for scope, scope_id in scopes),
+        *(str(value) for value in extra),
+    ])
+    etag = hashlib.sha1(key.encode()).hexdigest()
+    if last_modified is not None:
+        # MySQL 返回不帶時區的時間 (資料庫連接的時區，預設與應用伺服器相同)
+        last_modified = last_modified.astimezone(timezone.utc)
+    validators = (etag, last_modified)
+
+    if request.if_none_match:
+        not_modified = request.if_none_match.contains_weak(etag)
+    else:
+        not_modified = bool(last_modified and request.if_modified_since
+                            and last_modified.replace(microsecond=0) <= request.if_modified_since)
+    if not not_modified:
+        return None, validators
+    return with_validators(current_app.response_class(status=304), validators), validators
+
+
+def with_validators(response, validators):
+    """
+    將驗證器加到回應上 (只加到 200 與 304 回應)：弱 ETag (頁面內容等價而非逐位元組相同)、Last-Modified，
+    以及 Cache-Control: private, no-cache (瀏覽器可以保存，但每次使用前都要重新驗證)。
+    """
+    response = make_response(response)
+    if validators is None or response.status_code not in (200, 304):
+        return response
+    etag, last_modified = validators
+    response.set_etag(etag, weak=True)
+    if last_modified is not None:
+        response.last_modified = last_modified
+    response.headers['Cache-Control'] = 'private, no-cache'
+    return response
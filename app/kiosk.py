@@ -0,0 +1,324 @@
+# app/kiosk.py
+# 校門刷卡登記遲到 (刷卡機模式)
+#
+# 早上在校門口需要幾分鐘內登記數百名遲到學生，每次刷卡應在幾毫秒內完成，因此刷卡請求不使用資料庫連接：
+# - ID 卡號碼 / 學生證號碼 -> 學生 的雜湊索引保存在進程記憶體中，以一次查詢建立。
+#   學生名單變更時 (新增 / 修改 / 刪除學生或班級、CSV 匯入) 由寫入路徑呼叫 invalidate_card_index() 標記過期，
+#   下一次刷卡時重新建立；另外每 KIOSK_INDEX_TTL 秒重新建立一次，以反映直接在資料庫中的修改。
+#   重新建立在鎖之外查詢資料庫，期間刷卡繼續使用舊的索引；本進程已登記但尚未被重新建立讀到的遲到會保留在新的索引中。
+# - 遲到記錄放入寫入佇列後立即返回。背景執行緒收集 KIOSK_FLUSH_INTERVAL 秒內 (最多 KIOSK_FLUSH_MAX_ROWS 筆) 的記錄，
+#   以一個多行 INSERT 寫入 late_records，再以 apply_bulk_record_changes() 分組更新 students.late_count 與統計摘要，一次提交。
+# 寫入失敗時只重試暫時性錯誤 (斷線、鎖等待逾時、死鎖、連接池已滿)，最多 KIOSK_WRITE_MAX_ATTEMPTS 次；
+# 其他錯誤或重試用完後改為逐行寫入，無法寫入的記錄計入 failed 並逐筆記錄在日誌中，佇列繼續處理之後的刷卡。
+# 注意：記錄在提交前只存在於記憶體中，進程異常終止時最多遺失最後一個間隔內的刷卡 (正常結束時會先寫入佇列中的記錄)；
+# 多進程部署時每個進程各有一份索引與佇列，同一學生在不同進程重複刷卡的檢查要等到索引重新建立後才生效。
+import atexit
+import os
+import queue
+import threading
+import time
+from datetime import date, datetime
+
+import mysql.connector
+from mysql.connector import errorcode
+from mysql.connector.errors import PoolError
+from flask import current_app
+
+import config
+from app.db import acquire_connection, release_connection
+from app.models import record_summary_deltas, apply_record_changes, apply_bulk_record_changes
+
+
+LATE_INSERT_SQL = "INSERT INTO late_records (student_id, late_date, reason, recorded_at, recorded_by_user_id) VALUES {values}"
+LATE_ROW_SQL = "(" + ", ".join(["%s"] * 5) + ")"
+# 卡號索引的兩個查詢 (flask db explain 也檢查)：有卡號的所有學生，以及今天已有遲到記錄的學生
+CARD_INDEX_SQL = """
+    SELECT s.student_id, s.student_number, s.name, c.class_name, s.id_card_number, s.student_id_number
+    FROM students s
+    JOIN classes c ON s.class_id = c.class_id
+    WHERE s.id_card_number IS NOT NULL OR s.student_id_number IS NOT NULL
+"""
+LATE_TODAY_SQL = "SELECT DISTINCT student_id FROM late_records WHERE late_date = %s"
+
+# 重試後可能成功的錯誤 (其他錯誤，例如 DataError、ProgrammingError，重試同一批記錄只會再次失敗)
+TRANSIENT_ERRNOS = {
+    errorcode.CR_CONN_HOST_ERROR, errorcode.CR_SERVER_GONE_ERROR, errorcode.CR_SERVER_LOST,
+    errorcode.ER_LOCK_WAIT_TIMEOUT, errorcode.ER_LOCK_DEADLOCK,
+}
+
+
+def _is_transient(err):
+    return isinstance(err, PoolError) or err.errno in TRANSIENT_ERRNOS
+
+
+# --- 卡號索引 ---
+class CardIndex:
+    """ID 卡號碼與學生證號碼到學生的記憶體索引，以及今天已登記遲到的學生"""
+
+    def __init__(self):
+        self._by_code = {} # 卡號 -> {'student_id', 'student_number', 'name', 'class_name'}
+        self._late_today = set() # 今天已有遲到記錄 (或已放入寫入佇列) 的學生 ID
+        # 本進程登記的遲到 (student_id, 日期) -> 寫入完成 (提交或放棄) 的時間，仍在寫入佇列中時為 None。
+        # 重新建立索引時，開始讀取資料庫之後才完成的登記仍需保留，否則這段時間內重複刷卡會再次登記
+        self._claims = {}
+        self._day = None
+        self._built_at = 0
+        self._stale = True
+        self._lock = threading.Lock()
+        self._refresh_lock = threading.Lock() # 同一時間只由一個執行緒重新建立
+
+    def invalidate(self):
+        self._stale = True
+
+    def _needs_refresh(self, today):
+        return self._stale or self._day != today or time.monotonic() - self._built_at > config.KIOSK_INDEX_TTL
+
+    def _refresh(self, today):
+        """
+        重新建立索引 (兩個查詢)。查詢在 _lock 之外執行，完成後在 _lock 內替換，期間其他刷卡繼續使用舊的索引；
+        只有索引還不是今天的 (第一次刷卡或日期改變) 時，刷卡才會等待重新建立完成。
+        """
+        if not self._refresh_lock.acquire(blocking=self._day != today):
+            return # 其他執行緒正在重新建立
+        try:
+            if not self._needs_refresh(today):
+                return
+            self._stale = False # 建立期間再次失效時，下一次刷卡會再重新建立
+            started = time.monotonic()
+            try:
+                conn = acquire_connection()
+                try:
+                    cursor = conn.cursor()
+                    try:
+                        cursor.execute(CARD_INDEX_SQL)
+                        by_code = {}
+                        for student_id, student_number, name, class_name, id_card_number, student_id_number in cursor.fetchall():
+                            student = {'student_id': student_id, 'student_number': student_number, 'name': name, 'class_name': class_name}
+                            if student_id_number:
+                                by_code[student_id_number] = student
+                            if id_card_number:
+                                by_code[id_card_number] = student # 兩種號碼相同時以 ID 卡號碼為準
+                        cursor.execute(LATE_TODAY_SQL, (today,))
+                        late_today = {student_id for (student_id,) in cursor.fetchall()}
+                    finally:
+                        cursor.close()
+                finally:
+                    release_connection(conn)
+            except mysql.connector.Error:
+                self._stale = True
+                raise
+            with self._lock:
+                # 開始讀取之前已完成寫入的登記已包含在查詢結果中，其餘 (仍在佇列中或之後才提交) 需要保留
+                self._claims = {key: settled_at for key, settled_at in self._claims.items()
+                                if key[1] == today and (settled_at is None or settled_at >= started)}
+                late_today.update(student_id for student_id, _ in self._claims)
+                self._by_code = by_code
+                self._late_today = late_today
+                self._day = today
+                self._built_at = time.monotonic()
+        finally:
+            self._refresh_lock.release()
+
+    def claim(self, code, today):
+        """
+        查找卡號並標記該學生今天已登記遲到，返回 (結果, 學生)：
+        結果為 'recorded' (需要寫入記錄)、'duplicate' (今天已登記) 或 'unknown' (找不到卡號，學生為 None)。
+        """
+        if self._needs_refresh(today):
+            self._refresh(today)
+        with self._lock:
+            student = self._by_code.get(code)
+            if student is None:
+                return 'unknown', None
+            if student['student_id'] in self._late_today:
+                return 'duplicate', student
+            self._late_today.add(student['student_id'])
+            self._claims[(student['student_id'], today)] = None
+            return 'recorded', student
+
+    def settle(self, rows):
+        """寫入佇列提交 (或放棄) rows 後呼叫，記錄完成時間 (之後開始的重新建立會從資料庫讀到這些記錄)"""
+        now = time.monotonic()
+        with self._lock:
+            for row in rows:
+                key = (row[0], row[1])
+                if key in self._claims:
+                    self._claims[key] = now
+
+    def status(self):
+        return {'codes': len(self._by_code), 'late_today': len(self._late_today), 'stale': self._stale}
+
+
+card_index = CardIndex()
+
+
+def invalidate_card_index():
+    """學生名單或卡號變更後呼叫，讓下一次刷卡重新建立卡號索引"""
+    card_index.invalidate()
+
+
+# --- 寫入佇列 ---
+class LateWriteQueue:
+    """遲到記錄的延遲寫入佇列：背景執行緒分組寫入並提交"""
+
+    def __init__(self):
+        self._queue = queue.Queue()
+        self._pending = [] # 背景執行緒已取出但尚未提交的記錄
+        self._lock = threading.Lock()
+        self._thread = None
+        self._thread_pid = None
+        self._app = None
+        self.committed = 0
+        self.failed = 0
+        self.last_error = None
+
+    def submit(self, row):
+        """放入一筆記錄 (student_id, 日期, 原因, 登記時間, 記錄者 ID)，必要時啟動背景執行緒"""
+        self._ensure_thread()
+        self._queue.put(row)
+
+    def _ensure_thread(self):
+        pid = os.getpid()
+        if self._thread is None or self._thread_pid != pid or not self._thread.is_alive():
+            with self._lock:
+                if self._thread is None or self._thread_pid != pid or not self._thread.is_alive():
+                    self._app = current_app._get_current_object()
+                    self._thread = threading.Thread(target=self._run, name='kiosk-late-writer', daemon=True)
+                    self._thread_pid = pid
+                    self._thread.start()
+
+    def _take(self):
+        """等待第一筆記錄，然後在 KIOSK_FLUSH_INTERVAL 秒內收集更多記錄 (最多 KIOSK_FLUSH_MAX_ROWS 筆)"""
+        rows = [self._queue.get()]
+        deadline = time.monotonic() + config.KIOSK_FLUSH_INTERVAL
+        while len(rows) < config.KIOSK_FLUSH_MAX_ROWS:
+            remaining = deadline - time.monotonic()
+            if remaining <= 0:
+                break
+            try:
+                rows.append(self._queue.get(timeout=remaining))
+            except queue.Empty:
+                break
+        return rows
+
+    def _run(self):
+        while True:
+            rows = self._take()
+            with self._lock:
+                self._pending = rows
+            self._flush(rows)
+            with self._lock:
+                self._pending = []
+
+    def _flush(self, rows):
+        """
+        寫入一批記錄：暫時性錯誤最多嘗試 KIOSK_WRITE_MAX_ATTEMPTS 次 (每次等待時間遞增)，
+        其他錯誤 (例如學生在刷卡後被刪除) 或重試用完後改為逐行寫入，只跳過出錯的記錄。
+        """
+        for attempt in range(1, config.KIOSK_WRITE_MAX_ATTEMPTS + 1):
+            try:
+                self._write(rows)
+                return
+            except mysql.connector.Error as err:
+                self.last_error = str(err)
+                if not _is_transient(err) or attempt == config.KIOSK_WRITE_MAX_ATTEMPTS:
+                    self._app.logger.error(f"資料庫錯誤 (刷卡登記遲到，{len(rows)} 筆改為逐行寫入): {err}")
+                    break
+                self._app.logger.warning(f"資料庫錯誤 (刷卡登記遲到，{len(rows)} 筆將重試，第 {attempt} 次): {err}")
+                time.sleep(max(config.KIOSK_FLUSH_INTERVAL, 1) * attempt)
+        self._write_each(rows)
+
+    def _write(self, rows):
+        """以一個多行 INSERT 與一次分組的計數器更新寫入一批記錄並提交 (出錯時回滾並拋出)"""
+        conn = acquire_connection()
+        try:
+            cursor = conn.cursor()
+            try:
+                cursor.execute(LATE_INSERT_SQL.format(values=", ".join([LATE_ROW_SQL] * len(rows))),
+                               [value for row in rows for value in row])
+                changes = {}
+                for student_id, late_date, _, _, _ in rows:
+                    changes.setdefault(student_id, []).append((late_date, record_summary_deltas('late')))
+                apply_bulk_record_changes(cursor, changes)
+                conn.commit()
+                self.committed += len(rows)
+                card_index.settle(rows)
+            finally:
+                cursor.close()
+        finally:
+            release_connection(conn) # 未提交的事務在歸還時回滾
+
+    def _write_each(self, rows):
+        """逐行寫入並提交，無法寫入的記錄以 _fail() 記錄"""
+        try:
+            conn = acquire_connection()
+        except mysql.connector.Error as err:
+            self._fail(rows, err)
+            return
+        try:
+            cursor = conn.cursor()
+            try:
+                for row in rows:
+                    try:
+                        cursor.execute(LATE_INSERT_SQL.format(values=LATE_ROW_SQL), row)
+                        apply_record_changes(cursor, row[0], [(row[1], record_summary_deltas('late'))])
+                        conn.commit()
+                        self.committed += 1
+                        card_index.settle([row])
+                    except mysql.connector.Error as err:
+                        try:
+                            conn.rollback()
+                        except mysql.connector.Error:
+                            pass
+                        self._fail([row], err)
+            finally:
+                cursor.close()
+        finally:
+            release_connection(conn)
+
+    def _fail(self, rows, err):
+        """計入無法寫入的記錄，並逐筆記錄在日誌中 (可據此手動補登)"""
+        self.failed += len(rows)
+        self.last_error = str(err)
+        card_index.settle(rows) # 沒有寫入的記錄不會出現在資料庫中，之後重新建立索引時該學生可以再次刷卡登記
+        for student_id, late_date, _, recorded_at, user_id in rows:
+            self._app.logger.error(f"刷卡登記遲到未能寫入 (學生 {student_id}，{late_date}，登記時間 {recorded_at}，"
+                                   f"記錄者 {user_id}): {err}")
+
+    def drain(self):
+        """在目前執行緒中寫入佇列中剩餘的記錄 (進程結束時呼叫)"""
+        rows = []
+        while True:
+            try:
+                rows.append(self._queue.get_nowait())
+            except queue.Empty:
+                break
+        if rows and self._app is not None:
+            self._flush(rows)
+
+    def status(self):
+        with self._lock:
+            pending = len(self._pending)
+        return {'queued': self._queue.qsize() + pending, 'committed': self.committed,
+                'failed': self.failed, 'last_error': self.last_error}
+
+
+late_queue = LateWriteQueue()
+atexit.register(late_queue.drain)
+
+
+def register_late_scan(code, user_id, reason=None):
+    """
+    處理一次刷卡：在記憶體索引中查找學生並將遲到記錄放入寫入佇列，返回 (結果, 學生)。
+    結果見 CardIndex.claim()；只有索引需要重新建立時才會查詢資料庫 (可能拋出 mysql.connector.Error)。
+    """
+    today = date.today()
+    result, student = card_index.claim(code, today)
+    if result == 'recorded':
+        late_queue.submit((student['student_id'], today, reason, datetime.now().replace(microsecond=0), user_id))
+    return result, student
+
+
+def kiosk_status():
+    """卡號索引與寫入佇列的狀態 (JSON 監控使用)"""
+    return {'index': card_index.status(), 'queue': late_queue.status()}
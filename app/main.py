@@ -1,15 +1,19 @@
 import os
 import csv
 import io # To write CSV to an in-memory file
-from flask import render_template, request, redirect, url_for, flash, Blueprint, current_app, send_from_directory, abort, Response
+from flask import render_template, request, redirect, url_for, flash, Blueprint, current_app, send_from_directory, abort, Response, jsonify
 from flask_login import login_user, logout_user, login_required, current_user
+from flask_wtf.csrf import generate_csrf, validate_csrf # 刷卡登記的 JSON 請求以 X-CSRFToken 標頭驗證
+from wtforms import ValidationError
 from werkzeug.security import generate_password_hash, check_password_hash
 from werkzeug.utils import secure_filename
+import config
 from config import allowed_file # 導入 allowed_file 函式
 from app.__init__ import get_db # 導入資料庫連接函式
+from app.cache import invalidate_user, shared_cache, TTLCache # 導入使用者快取失效函式與共用快取
 from app.models import User # 導入 User 模型
 import mysql.connector # 導入 MySQL 連接庫
-from datetime import datetime
+from datetime import date, datetime
 # 導入所有需要的表單類
 from app.forms import (
     LoginForm, AddUserForm, EditUserForm, AddStudentForm, EditStudentForm,
@@ -18,16 +22,161 @@ from app.forms import (
     RecordAwardPunishForm, EditAwardPunishForm,
     RecordCompetitionForm, EditCompetitionForm,
     RecordLateForm, EditLateForm,
-    RecordIncompleteHomeworkForm, EditIncompleteHomeworkForm
+    RecordIncompleteHomeworkForm, EditIncompleteHomeworkForm,
+    BatchRecordForm
 )
 
 # 導入相應的資料庫模型
 # 請確保這些模型在您的 app.models 檔案中已定義
 from app.models import Student, SchoolClass, Absence, AwardPunishment, Competition, LateRecord, IncompleteHomeworkRecord
+from app.models import AWARD_PUNISH_TYPES, COMPETITION_RESULTS, ABSENCE_TYPES # 共用的記錄類型定義
+from app.models import record_summary_deltas, apply_record_changes, apply_bulk_record_changes # 學生計數器與統計摘要的增量更新
+from app.kiosk import register_late_scan, invalidate_card_index # 校門刷卡登記遲到
+from app.record_ingest import RecordIngestError, ingest_records, read_rows, detect_format # 記錄批量匯入
+from app.http_cache import conditional_request, with_validators # 讀取頁面的 ETag / 304
+from app.fragment_cache import cached_fragment # 渲染結果片段快取
+from app.class_catalog import get_classes, get_class_name # 進程內的班級目錄
+from app.models import (
+    SUMMARY_ALL_TERMS, AWARD_PUNISH_SUMMARY_COLUMNS, COMPETITION_SUMMARY_COLUMNS,
+    summary_select_sql, recent_terms, term_label, term_date_range
+)
 
 
 main_bp = Blueprint('main', __name__) # 主要應用功能路由
 
+# 學生記錄頁面 (view_records) 的時間線：五類記錄以共同欄位投影後用一個 UNION ALL 查詢合併，
+# 按 (日期, recorded_at, 類別, 主鍵) 降序排列並以鍵集分頁 (見 student_timeline 路由)。
+# 每個分支各自按 (student_id, 日期, recorded_at) 複合索引倒序讀取並限制行數，外層只需合併最多 5 × limit 行；
+# flask db explain 也檢查這個查詢 (見 app/query_plans.py)。
+# 類別鍵不含底線，因為分頁游標以底線分隔各部分。
+STUDENT_TIMELINE_SOURCES = {
+    'absence': {
+        'table': 'absences', 'id': 'absence_id', 'date': 'absence_date', 'label': '缺席',
+        'category': 'type', 'title': None, 'detail': 'reason', 'session_count': 'session_count', 'upload_path': 'upload_path',
+        'edit_endpoint': 'main.edit_absence',
+    },
+    'award': {
+        'table': 'awards_punishments', 'id': 'record_id', 'date': 'record_date', 'label': '獎懲',
+        'category': 'type', 'title': None, 'detail': 'description', 'session_count': None, 'upload_path': 'upload_path',
+        'edit_endpoint': 'main.edit_award_punishment',
+    },
+    'competition': {
+        'table': 'competitions', 'id': 'comp_record_id', 'date': 'comp_date', 'label': '參賽',
+        'category': 'result', 'title': 'comp_name', 'detail': 'description', 'session_count': None, 'upload_path': 'upload_path',
+        'edit_endpoint': 'main.edit_competition',
+    },
+    'late': {
+        'table': 'late_records', 'id': 'late_id', 'date': 'late_date', 'label': '遲到',
+        'category': None, 'title': None, 'detail': 'reason', 'session_count': None, 'upload_path': None,
+        'edit_endpoint': 'main.edit_late_record',
+    },
+    'homework': {
+        'table': 'incomplete_homework_records', 'id': 'incomplete_hw_id', 'date': 'record_date', 'label': '欠交功課',
+        'category': 'subject', 'title': None, 'detail': 'description', 'session_count': None, 'upload_path': None,
+        'edit_endpoint': 'main.edit_incomplete_homework_record',
+    },
+}
+
+
+def build_student_timeline_query(student_id, kinds, date_from, date_to, after, limit):
+    """
+    生成學生時間線的查詢語句與參數。
+    kinds 為要包含的類別鍵列表，date_from / date_to 為日期範圍 (None 表示不限)，
+    after 為 _parse_timeline_cursor() 返回的游標 (或 None)。
+    """
+    branches = []
+    params = []
+    for kind in kinds:
+        spec = STUDENT_TIMELINE_SOURCES[kind]
+        projection = [f"'{kind}' AS kind", f"{spec['id']} AS record_id", f"{spec['date']} AS record_date", "recorded_at"]
+        for column in ('category', 'title', 'detail', 'session_count', 'upload_path'):
+            projection.append(f"{spec[column]} AS {column}" if spec[column] else f"NULL AS {column}")
+        projection.append("recorded_by_user_id")
+
+        conditions = ["student_id = %s"]
+        branch_params = [student_id]
+        if date_from:
+            conditions.append(f"{spec['date']} >= %s")
+            branch_params.append(date_from)
+        if date_to:
+            conditions.append(f"{spec['date']} <= %s")
+            branch_params.append(date_to)
+        if after:
+            # 類別在分支內是常數，因此游標條件可以在這裡化簡為只涉及索引欄位 (與主鍵) 的比較
+            after_date, after_recorded_at, after_kind, after_id = after
+            if kind == after_kind:
+                conditions.append(f"({spec['date']} < %s OR ({spec['date']} = %s AND (recorded_at < %s"
+                                  f" OR (recorded_at = %s AND {spec['id']} < %s))))")
+                branch_params.extend([after_date, after_date, after_recorded_at, after_recorded_at, after_id])
+            else:
+                # 排序在游標類別之後的類別包含相同 (日期, recorded_at) 的記錄，之前的則不包含
+                operator = '<=' if kind < after_kind else '<'
+                conditions.append(f"({spec['date']} < %s OR ({spec['date']} = %s AND recorded_at {operator} %s))")
+                branch_params.extend([after_date, after_date, after_recorded_at])
+
+        branches.append(
+            f"(SELECT {', '.join(projection)} FROM {spec['table']} WHERE {' AND '.join(conditions)}"
+            f" ORDER BY {spec['date']} DESC, recorded_at DESC, {spec['id']} DESC LIMIT %s)"
+        )
+        params.extend(branch_params)
+        params.append(limit)
+
+    sql = f"""
+            SELECT t.*, u.teacher_name AS recorder_name
+            FROM ({' UNION ALL '.join(branches)}
+                  ORDER BY record_date DESC, recorded_at DESC, kind DESC, record_id DESC LIMIT %s) t
+            LEFT JOIN users u ON u.user_id = t.recorded_by_user_id
+            ORDER BY t.record_date DESC, t.recorded_at DESC, t.kind DESC, t.record_id DESC
+        """
+    return sql, (*params, limit)
+
+
+def _parse_timeline_cursor(value):
+    """解析 '日期_記錄時間_類別_主鍵' 形式的時間線游標，格式無效時返回 None (視為第一頁)"""
+    try:
+        date_part, recorded_at_part, kind, id_part = value.split('_')
+        if kind not in STUDENT_TIMELINE_SOURCES:
+            return None
+        return (datetime.strptime(date_part, '%Y-%m-%d').date(),
+                datetime.strptime(recorded_at_part, '%Y-%m-%d %H:%M:%S'),
+                kind, int(id_part))
+    except (AttributeError, ValueError):
+        return None
+
+
+def _can_view_class(class_id):
+    """教師只能查看自己負責班級的學生與記錄，主管和管理員可以查看所有班級"""
+    if current_user.is_admin() or current_user.is_supervisor():
+        return True
+    return current_user.is_teacher() and class_id in current_user.assigned_class_ids
+
+
+def build_class_roster_query(class_id, term):
+    """
+    班級學生名單查詢的語句與參數 (flask db explain 也使用這個函式)。
+    全部學期的遲到、欠交功課次數與點數從 students 表讀取，所選學期的從 student_summary 讀取。
+    """
+    summary_columns = summary_select_sql(students_alias='s' if term == SUMMARY_ALL_TERMS else None)
+    sql = f"""
+            SELECT s.student_id, s.student_number, s.name, s.id_card_number, s.student_id_number, {summary_columns}
+            FROM students s
+            LEFT JOIN student_summary ss ON ss.student_id = s.student_id AND ss.term = %s
+            WHERE s.class_id = %s
+            ORDER BY s.student_number, s.name
+        """
+    return sql, (term, class_id)
+
+
+def load_class_roster(cursor, class_id, term):
+    """
+    班級學生名單與所選學期的統計摘要 (字典列表)，student_list 與 students_json 共用。
+    結果保存在共用快取中 (標籤 class:<id>)，班級或其學生的任何寫入都會使其失效；cursor 必須是字典游標。
+    """
+    def load():
+        cursor.execute(*build_class_roster_query(class_id, term))
+        return cursor.fetchall()
+    return shared_cache.get_or_set(f"roster:{class_id}:{term}", load, tags=[f"class:{class_id}"])
+
 # --- 主要應用功能 (Main) 藍圖路由 ---
 
 @main_bp.route('/')
@@ -48,22 +197,13 @@ def dashboard():
         # 獲取主管的使用者名稱（可能是老師姓名）
         # 使用 User 模型中已有的 teacher_name 屬性
         supervisor_name = current_user.teacher_name if current_user.teacher_name else current_user.username
-        # 主管通常可以看到所有班級的匯總數據或入口連結
-        conn = get_db()
+        # 主管通常可以看到所有班級的匯總數據或入口連結 (從班級目錄讀取，不查詢資料庫)
         classes = []
-        if conn:
-             cursor = conn.cursor(dictionary=True)
-             try:
-                  # 主管通常可以看到所有班級
-                  cursor.execute("SELECT class_id, class_name FROM classes ORDER BY class_name")
-                  classes = cursor.fetchall()
-             except mysql.connector.Error as err:
-                  flash(f"資料庫錯誤: {err}", 'danger')
-                  current_app.logger.error(f"資料庫錯誤 (主管儀表板獲取班級): {err}")
-             finally:
-                  if conn and conn.is_connected():
-                       cursor.close()
-                       conn.close()
+        try:
+             classes = get_classes()
+        except mysql.connector.Error as err:
+             flash(f"資料庫錯誤: {err}", 'danger')
+             current_app.logger.error(f"資料庫錯誤 (主管儀表板獲取班級): {err}")
 
         return render_template('supervisor_dashboard.html', title='主管儀表板', supervisor_name=supervisor_name, classes=classes)
     elif current_user.is_teacher():
@@ -84,56 +224,37 @@ def student_list(class_id):
     """顯示特定班級的學生列表"""
     # 檢查使用者是否有權限查看此班級的學生列表
     # 教師只能查看自己負責的班級，主管和管理員可以查看所有班級
+    if not _can_view_class(class_id):
+        flash('您無權查看此班級', 'danger')
+        return redirect(url_for('main.dashboard'))
+    # 班級的資料版本未改變時直接返回 304，不查詢學生名單 (學期選項隨今天的日期改變，目前學期也加到 ETag 中)
+    not_modified, validators = conditional_request([('class', class_id)], extra=[recent_terms()[0]])
+    if not_modified:
+        return not_modified
+
     conn = get_db()
     class_name = None
     students = []
+    # 統計的學期範圍：預設為全部學期，也可以選擇最近幾個學期之一
+    term_options = [SUMMARY_ALL_TERMS] + recent_terms()
+    term = request.args.get('term', SUMMARY_ALL_TERMS)
+    if term not in term_options:
+        term = SUMMARY_ALL_TERMS
 
     if conn:
         cursor = conn.cursor(dictionary=True)
         try:
-            # 獲取班級名稱
-            cursor.execute("SELECT class_id, class_name FROM classes WHERE class_id = %s", (class_id,))
-            class_data = cursor.fetchone()
-            if class_data:
-                class_name = class_data['class_name']
-            else:
+            # 獲取班級名稱 (班級目錄)
+            class_name = get_class_name(class_id)
+            if class_name is None:
                  flash('找不到該班級', 'danger')
                  if conn and conn.is_connected():
                       cursor.close()
                       conn.close()
                  return redirect(url_for('main.dashboard'))
 
-            # 檢查權限
-            has_permission = False
-            if current_user.is_admin() or current_user.is_supervisor():
-                 has_permission = True
-            elif current_user.is_teacher():
-                 # 檢查教師是否負責此班級
-                 # 使用 User 模型中實現的方法
-                 if any(c['class_id'] == class_id for c in current_user.assigned_classes):
-                      has_permission = True
-
-
-            if not has_permission:
-                 flash('您無權查看此班級', 'danger')
-                 if conn and conn.is_connected():
-                      cursor.close()
-                      conn.close()
-                 return redirect(url_for('main.dashboard'))
-
-
-            # 獲取班級學生列表，包括所有計數和點數
-            cursor.execute("""
-                SELECT student_id, student_number, name, late_count, incomplete_homework_count, violation_points, award_points, id_card_number, student_id_number
-                FROM students
-                WHERE class_id = %s
-                ORDER BY student_number, name
-            """, (class_id,))
-            students = cursor.fetchall()
-
-            # For CSV export, we might need more detailed record counts per student
-            # This could be optimized with JOINs or separate queries if needed for display
-            # For now, we fetch totals and get details for CSV export separately if requested
+            # 獲取班級學生列表，所選學期的計數和點數從 student_summary 讀取一行 (主鍵查找)，經共用快取
+            students = load_class_roster(cursor, class_id, term)
 
         except mysql.connector.Error as err:
             flash(f"資料庫錯誤: {err}", 'danger')
@@ -144,8 +265,47 @@ def student_list(class_id):
                  conn.close()
 
 
-    # Passing class_data object for consistency with other edit forms if needed later
-    return render_template('student_list.html', title=f'{class_name} 學生列表', students=students, class_id=class_id, class_name=class_name, class_data=class_data)
+    return with_validators(render_template('student_list.html', title=f'{class_name} 學生列表', students=students, class_id=class_id, class_name=class_name,
+                           term=term, term_options=[(t, term_label(t)) for t in term_options]), validators)
+
+# 班級學生名單 JSON (儀表板的班級切換使用) 的欄位，學生以與欄位順序相同的陣列表示，減少傳輸量
+ROSTER_JSON_FIELDS = ('student_id', 'student_number', 'name', 'absence_sessions', 'late_count',
+                      'incomplete_homework_count', 'violation_points', 'award_points')
+
+@main_bp.route('/class/<int:class_id>/students_json')
+@login_required
+def students_json(class_id):
+    """
+    班級學生名單 (JSON)，由 static/js/script.js 在客戶端渲染與排序。
+    回應帶有以班級資料版本組成的 ETag：客戶端以 If-None-Match 重新驗證，名單未改變時只讀取版本就返回 304。
+    """
+    term = request.args.get('term', SUMMARY_ALL_TERMS)
+    if term != SUMMARY_ALL_TERMS and term not in recent_terms():
+        return jsonify(error='無效的學期'), 400
+    if not _can_view_class(class_id):
+        return jsonify(error='您無權查看此班級'), 403
+    not_modified, validators = conditional_request([('class', class_id)])
+    if not_modified:
+        return not_modified
+
+    conn = get_db()
+    if not conn:
+        return jsonify(error='無法連接到資料庫'), 503
+    cursor = conn.cursor(dictionary=True)
+    try:
+        class_name = get_class_name(class_id)
+        if class_name is None:
+            return jsonify(error='找不到該班級'), 404
+        students = [[row[field] for field in ROSTER_JSON_FIELDS] for row in load_class_roster(cursor, class_id, term)]
+    except mysql.connector.Error as err:
+        current_app.logger.error(f"資料庫錯誤 (班級學生名單 JSON): {err}")
+        return jsonify(error='資料庫錯誤，請稍後再試'), 503
+    finally:
+        cursor.close()
+        conn.close()
+
+    return with_validators(jsonify(class_id=class_id, class_name=class_name, term=term,
+                                   fields=ROSTER_JSON_FIELDS, students=students), validators)
 
 @main_bp.route('/class/<int:class_id>/students/export/csv')
 @login_required
@@ -159,12 +319,9 @@ def export_student_list_csv(class_id):
     if conn:
         cursor = conn.cursor(dictionary=True)
         try:
-            # 獲取班級名稱
-            cursor.execute("SELECT class_name FROM classes WHERE class_id = %s", (class_id,))
-            class_info = cursor.fetchone()
-            if class_info:
-                 class_name = class_info['class_name']
-            else:
+            # 獲取班級名稱 (班級目錄)
+            class_name = get_class_name(class_id)
+            if class_name is None:
                  flash('找不到該班級', 'danger')
                  if conn and conn.is_connected():
                       cursor.close()
@@ -179,7 +336,7 @@ def export_student_list_csv(class_id):
             elif current_user.is_teacher():
                  # 檢查教師是否負責此班級
                  # 使用 User 模型中實現的方法
-                 if any(c['class_id'] == class_id for c in current_user.assigned_classes):
+                 if class_id in current_user.assigned_class_ids:
                       has_permission = True
 
             if not has_permission:
@@ -189,36 +346,25 @@ def export_student_list_csv(class_id):
                       conn.close()
                  return redirect(url_for('main.dashboard'))
 
-            # 獲取班級所有學生數據，包括所有計數和點數
-            cursor.execute("""
-                SELECT student_id, student_number, name, late_count, incomplete_homework_count, violation_points, award_points, id_card_number, student_id_number
-                FROM students
-                WHERE class_id = %s
-                ORDER BY student_number, name
-            """, (class_id,))
+            # 以一次查詢取得班級所有學生數據，各獎懲類型、參賽結果的次數從 student_summary 的全部學期行讀取
+            # (遲到、欠交功課次數與點數從 students 表讀取，與其他頁面相同)
+            cursor.execute(f"""
+                SELECT s.student_id, s.student_number, s.name, s.id_card_number, s.student_id_number, {summary_select_sql(students_alias='s')}
+                FROM students s
+                LEFT JOIN student_summary ss ON ss.student_id = s.student_id AND ss.term = %s
+                WHERE s.class_id = %s
+                ORDER BY s.student_number, s.name
+            """, (SUMMARY_ALL_TERMS, class_id))
             students = cursor.fetchall()
 
-            # 對於每個學生，獲取詳細的獎懲、參賽等記錄計數
+            # 將摘要欄位轉換為以類型名稱為鍵的計數
             detailed_students_data = []
             for student in students:
-                 student_details = student.copy() # 複製學生基本信息
-                 student_id = student['student_id']
-
-                 # 獲取詳細的獎懲計數
-                 award_punish_counts = {}
-                 award_punish_types = ['表揚', '優點', '小功', '大功', '警告', '缺點', '小過', '大過']
-                 for ap_type in award_punish_types:
-                      cursor.execute("SELECT COUNT(*) AS count FROM awards_punishments WHERE student_id = %s AND type = %s", (student_id, ap_type))
-                      award_punish_counts[ap_type] = cursor.fetchone()['count']
-                 student_details.update(award_punish_counts) # 將計數添加到學生數據中
-
-                 # 獲取詳細的參賽計數
-                 comp_counts = {}
-                 comp_results = ['參與', '入圍', '得獎']
-                 for comp_result in comp_results:
-                      cursor.execute("SELECT COUNT(*) AS count FROM competitions WHERE student_id = %s AND result = %s", (student_id, comp_result))
-                      comp_counts[comp_result] = cursor.fetchone()['count']
-                 student_details.update(comp_counts) # 將計數添加到學生數據中
+                 student_details = dict(student) # 學生基本信息與計數
+                 for ap_type, column in AWARD_PUNISH_SUMMARY_COLUMNS.items():
+                      student_details[ap_type] = int(student[column])
+                 for comp_result, column in COMPETITION_SUMMARY_COLUMNS.items():
+                      student_details[comp_result] = int(student[column])
 
                  # 總缺席節數已在 students 表中
                  # 總遲到次數已在 students 表中
@@ -252,9 +398,8 @@ def export_student_list_csv(class_id):
     header = [
         '學生ID', '學號', '姓名', 'ID卡號碼', '學生證號碼',
         '總遲到次數', '總欠交功課次數', '總違規點數', '總獎勵點數',
-        '表揚次數', '優點次數', '小功次數', '大功次數',
-        '警告次數', '缺點次數', '小過次數', '大過次數',
-        '參賽次數 (參與)', '參賽次數 (入圍)', '參賽次數 (得獎)'
+        *[f'{ap_type}次數' for ap_type in AWARD_PUNISH_TYPES],
+        *[f'參賽次數 ({comp_result})' for comp_result in COMPETITION_RESULTS]
         # 總缺席節數已在學生基本信息中
     ]
     writer.writerow(header)
@@ -271,9 +416,8 @@ def export_student_list_csv(class_id):
             student.get('incomplete_homework_count', 0),
             student.get('violation_points', 0),
             student.get('award_points', 0),
-            student.get('表揚', 0), student.get('優點', 0), student.get('小功', 0), student.get('大功', 0),
-            student.get('警告', 0), student.get('缺點', 0), student.get('小過', 0), student.get('大過', 0),
-            student.get('參與', 0), student.get('入圍', 0), student.get('得獎', 0)
+            *[student.get(ap_type, 0) for ap_type in AWARD_PUNISH_TYPES],
+            *[student.get(comp_result, 0) for comp_result in COMPETITION_RESULTS]
         ]
         writer.writerow(row)
 
@@ -286,69 +430,42 @@ def export_student_list_csv(class_id):
 @main_bp.route('/student/<int:student_id>/records')
 @login_required
 def view_records(student_id):
-    """查看特定學生的所有記錄"""
-    # 檢查使用者是否有權限查看此學生的記錄
-    # 教師只能查看自己班級學生的記錄，主管和管理員可以查看所有學生的記錄
+    """
+    查看特定學生的記錄。
+    這裡只載入學生資訊與統計數據；各類記錄由頁面上的分頁標籤從 student_timeline 按需載入 (預設為目前學期)。
+    """
     conn = get_db()
     student = None
-    absences = []
-    awards_punishments = []
-    competitions = []
-    late_records = [] # 新增：遲到記錄列表
-    incomplete_homework_records = [] # 新增：欠交功課記錄列表
+    validators = None
 
     if conn:
         cursor = conn.cursor(dictionary=True)
         try:
-            # 獲取學生資訊
-            cursor.execute("SELECT s.student_id, s.student_number, s.name, c.class_name, c.class_id FROM students s JOIN classes c ON s.class_id = c.class_id WHERE s.student_id = %s", (student_id,))
-            student = cursor.fetchone()
-
-            if student:
-                # 檢查權限
-                has_permission = False
-                if current_user.is_admin() or current_user.is_supervisor():
-                     has_permission = True
-                elif current_user.is_teacher():
-                     # 檢查教師是否負責此學生所在的班級
-                     # 使用 User 模型中實現的方法
-                     if any(c['class_id'] == student['class_id'] for c in current_user.assigned_classes):
-                          has_permission = True
-
-                if not has_permission:
-                     flash('您無權查看此學生的記錄', 'danger')
-                     if conn and conn.is_connected():
-                          cursor.close()
-                          conn.close()
-                     return redirect(url_for('main.dashboard'))
-
-                # 獲取缺席記錄
-                cursor.execute("SELECT * FROM absences WHERE student_id = %s ORDER BY absence_date DESC, recorded_at DESC", (student_id,)) # 添加 recorded_at 排序
-                absences = cursor.fetchall()
-
-                # 獲取獎懲記錄
-                cursor.execute("SELECT * FROM awards_punishments WHERE student_id = %s ORDER BY record_date DESC, recorded_at DESC", (student_id,)) # 添加 recorded_at 排序
-                awards_punishments = cursor.fetchall()
-
-                # 獲取參賽記錄
-                cursor.execute("SELECT * FROM competitions WHERE student_id = %s ORDER BY comp_date DESC, recorded_at DESC", (student_id,)) # 添加 recorded_at 排序
-                competitions = cursor.fetchall()
-
-                # 獲取遲到記錄
-                cursor.execute("SELECT * FROM late_records WHERE student_id = %s ORDER BY late_date DESC, recorded_at DESC", (student_id,)) # 添加 recorded_at 排序
-                late_records = cursor.fetchall()
-
-                # 獲取欠交功課記錄
-                cursor.execute("SELECT * FROM incomplete_homework_records WHERE student_id = %s ORDER BY record_date DESC, recorded_at DESC", (student_id,)) # 添加 recorded_at 排序
-                incomplete_homework_records = cursor.fetchall()
-
-
-            else:
+            # 獲取學生資訊與全部學期的統計摘要 (共用快取，標籤 student:<id>；班級改名時也會遞增學生的版本)
+            def load_student():
+                cursor.execute("""
+                    SELECT s.student_id, s.student_number, s.name, c.class_name, c.class_id,
+                           s.id_card_number, s.student_id_number,
+                           s.late_count, s.incomplete_homework_count, s.violation_points, s.award_points,
+                           COALESCE(ss.absence_sessions, 0) AS total_absences_sessions
+                    FROM students s
+                    JOIN classes c ON s.class_id = c.class_id
+                    LEFT JOIN student_summary ss ON ss.student_id = s.student_id AND ss.term = %s
+                    WHERE s.student_id = %s
+                """, (SUMMARY_ALL_TERMS, student_id))
+                return cursor.fetchone()
+            student = shared_cache.get_or_set(f"student_summary:{student_id}", load_student, tags=[f"student:{student_id}"])
+
+            if not student:
                 flash('找不到該學生', 'danger')
-                if conn and conn.is_connected():
-                     cursor.close()
-                     conn.close()
-                return redirect(url_for('main.dashboard'))
+            elif not _can_view_class(student['class_id']):
+                flash('您無權查看此學生的記錄', 'danger')
+                student = None
+            else:
+                # 學期分頁隨今天的日期改變，目前學期也加到 ETag 中
+                not_modified, validators = conditional_request([('student', student_id)], extra=[recent_terms()[0]])
+                if not_modified:
+                    return not_modified
 
         except mysql.connector.Error as err:
             flash(f"資料庫錯誤: {err}", 'danger')
@@ -359,12 +476,98 @@ def view_records(student_id):
                  conn.close()
 
     if not student:
-         return redirect(url_for('main.dashboard')) # 如果找不到學生，重定向
+         return redirect(url_for('main.dashboard')) # 如果找不到學生或無權查看，重定向
 
-    return render_template('view_records.html', title=f'{student["name"]} 的記錄', student=student,
-                           absences=absences, awards_punishments=awards_punishments,
-                           competitions=competitions, late_records=late_records, # 傳遞新增的記錄列表
-                           incomplete_homework_records=incomplete_homework_records)
+    terms = recent_terms()
+    return with_validators(render_template('view_records.html', title=f'{student["name"]} 的記錄', student=student,
+                           kinds=[(kind, spec['label']) for kind, spec in STUDENT_TIMELINE_SOURCES.items()],
+                           current_term=terms[0],
+                           term_options=[(t, term_label(t)) for t in terms + [SUMMARY_ALL_TERMS]]), validators)
+
+@main_bp.route('/student/<int:student_id>/timeline')
+@login_required
+def student_timeline(student_id):
+    """
+    學生記錄時間線 (JSON)：五類記錄合併後按日期降序排列，每頁 STUDENT_TIMELINE_PER_PAGE 筆。
+    查詢參數：kind (只包含一類記錄)、term (學期，'all' 為全部)、date_from / date_to (覆蓋學期的日期範圍)、
+    after (上一頁返回的 next_cursor)。
+    """
+    per_page = config.STUDENT_TIMELINE_PER_PAGE
+    kind = request.args.get('kind', '').strip()
+    kinds = [kind] if kind in STUDENT_TIMELINE_SOURCES else list(STUDENT_TIMELINE_SOURCES)
+
+    date_from = date_to = None
+    term = request.args.get('term', '').strip()
+    if term and term != SUMMARY_ALL_TERMS:
+        try:
+            date_from, date_to = term_date_range(term)
+        except ValueError:
+            return jsonify(error='無效的學期'), 400
+    try:
+        if request.args.get('date_from'):
+            date_from = datetime.strptime(request.args['date_from'], '%Y-%m-%d').date()
+        if request.args.get('date_to'):
+            date_to = datetime.strptime(request.args['date_to'], '%Y-%m-%d').date()
+    except ValueError:
+        return jsonify(error='日期格式應為 YYYY-MM-DD'), 400
+    after = _parse_timeline_cursor(request.args.get('after'))
+
+    conn = get_db()
+    if not conn:
+        return jsonify(error='無法連接到資料庫'), 503
+    cursor = conn.cursor(dictionary=True)
+    try:
+        cursor.execute("SELECT class_id FROM students WHERE student_id = %s", (student_id,))
+        student = cursor.fetchone()
+        if not student:
+            return jsonify(error='找不到該學生'), 404
+        if not _can_view_class(student['class_id']):
+            return jsonify(error='您無權查看此學生的記錄'), 403
+        # 學生的記錄與記錄人姓名未改變時直接返回 304，不執行時間線查詢
+        not_modified, validators = conditional_request([('student', student_id), ('users', 0)])
+        if not_modified:
+            return not_modified
+
+        def render():
+            # 多取一筆用於判斷是否還有下一頁
+            sql, params = build_student_timeline_query(student_id, kinds, date_from, date_to, after, per_page + 1)
+            cursor.execute(sql, params)
+            rows = cursor.fetchall()
+            next_cursor = None
+            if len(rows) > per_page:
+                rows = rows[:per_page]
+                last = rows[-1]
+                next_cursor = f"{last['record_date']:%Y-%m-%d}_{last['recorded_at']:%Y-%m-%d %H:%M:%S}_{last['kind']}_{last['record_id']}"
+
+            # 只允許記錄者本人、主管或管理員修改記錄
+            can_edit_all = current_user.is_supervisor() or current_user.is_admin()
+            records = []
+            for row in rows:
+                spec = STUDENT_TIMELINE_SOURCES[row['kind']]
+                can_edit = can_edit_all or str(row['recorded_by_user_id']) == str(current_user.get_id())
+                records.append({
+                    'kind': row['kind'], 'kind_label': spec['label'], 'id': row['record_id'],
+                    'date': f"{row['record_date']:%Y-%m-%d}", 'recorded_at': f"{row['recorded_at']:%Y-%m-%d %H:%M}",
+                    'category': row['category'], 'title': row['title'], 'detail': row['detail'],
+                    'session_count': row['session_count'], 'recorder_name': row['recorder_name'],
+                    'upload_url': url_for('main.uploaded_file', filename=row['upload_path']) if row['upload_path'] else None,
+                    'edit_url': url_for(spec['edit_endpoint'], **{spec['id']: row['record_id']}) if can_edit else None,
+                })
+            return {'records': records, 'next_cursor': next_cursor}
+
+        # 每個分頁標籤 (記錄類型、日期範圍與游標) 的內容按角色快取；教師只能修改自己的記錄，因此教師按使用者快取
+        page = cached_fragment(
+            f"timeline:{student_id}:{','.join(kinds)}:{date_from}:{date_to}:{request.args.get('after', '')}",
+            [f"student:{student_id}", 'users'], render, per_user=current_user.is_teacher()
+        )
+    except mysql.connector.Error as err:
+        current_app.logger.error(f"資料庫錯誤 (學生記錄時間線): {err}")
+        return jsonify(error='資料庫錯誤，請稍後再試'), 503
+    finally:
+        cursor.close()
+        conn.close()
+
+    return with_validators(jsonify(records=page['records'], next_cursor=page['next_cursor']), validators)
 
 
 # --- 記錄表單路由 (GET 顯示表單, POST 處理提交) ---
@@ -389,7 +592,7 @@ def record_absence(student_id):
                       has_permission = True
                  elif current_user.is_teacher():
                       # 使用 User 模型中實現的方法
-                      if any(c['class_id'] == student['class_id'] for c in current_user.assigned_classes):
+                      if student['class_id'] in current_user.assigned_class_ids:
                            has_permission = True
 
                  if not has_permission:
@@ -464,6 +667,8 @@ def record_absence(student_id):
                     "INSERT INTO absences (student_id, absence_date, session_count, type, reason, upload_path, recorded_by_user_id) VALUES (%s, %s, %s, %s, %s, %s, %s)",
                     (student_id, absence_date, session_count, absence_type, reason, upload_path, current_user.get_id()) # 使用 current_user.get_id() 獲取使用者 ID
                 )
+                # 更新學生統計摘要 (與插入記錄在同一個事務中提交)
+                apply_record_changes(cursor, student_id, [(absence_date, record_summary_deltas('absence', session_count=session_count))])
                 conn.commit()
                 flash('缺席記錄已成功添加', 'success')
                 # 重定向到學生記錄查看頁面
@@ -503,7 +708,7 @@ def record_award_punish(student_id):
                       has_permission = True
                  elif current_user.is_teacher():
                       # 使用 User 模型中實現的方法
-                      if any(c['class_id'] == student['class_id'] for c in current_user.assigned_classes):
+                      if student['class_id'] in current_user.assigned_class_ids:
                            has_permission = True
 
                  if not has_permission:
@@ -573,17 +778,10 @@ def record_award_punish(student_id):
                     "INSERT INTO awards_punishments (student_id, record_date, type, description, upload_path, recorded_by_user_id) VALUES (%s, %s, %s, %s, %s, %s)",
                     (student_id, record_date, record_type, description, upload_path, current_user.get_id())
                 )
-                conn.commit()
 
-                # 更新學生獎勵/違規點數
-                if record_type in ['優點', '小功', '大功']:
-                     points = {'優點': 1, '小功': 3, '大功': 9}.get(record_type, 0)
-                     cursor.execute("UPDATE students SET award_points = award_points + %s WHERE student_id = %s", (points, student_id))
-                     conn.commit()
-                elif record_type in ['警告', '缺點', '小過', '大過']:
-                     points = {'警告': 0, '缺點': 1, '小過': 3, '大過': 9}.get(record_type, 0) # 警告通常不計點數
-                     cursor.execute("UPDATE students SET violation_points = violation_points + %s WHERE student_id = %s", (points, student_id))
-                     conn.commit()
+                # 更新學生獎勵/違規點數與統計摘要 (與插入記錄在同一個事務中提交)
+                apply_record_changes(cursor, student_id, [(record_date, record_summary_deltas('award_punish', record_type))])
+                conn.commit()
 
 
                 flash('獎懲記錄已成功添加', 'success')
@@ -622,7 +820,7 @@ def record_competition(student_id):
                       has_permission = True
                  elif current_user.is_teacher():
                       # 使用 User 模型中實現的方法
-                      if any(c['class_id'] == student['class_id'] for c in current_user.assigned_classes):
+                      if student['class_id'] in current_user.assigned_class_ids:
                            has_permission = True
 
                  if not has_permission:
@@ -692,6 +890,8 @@ def record_competition(student_id):
                     "INSERT INTO competitions (student_id, comp_date, comp_name, result, description, upload_path, recorded_by_user_id) VALUES (%s, %s, %s, %s, %s, %s, %s)",
                     (student_id, comp_date, comp_name, result, description, upload_path, current_user.get_id())
                 )
+                # 更新學生統計摘要 (與插入記錄在同一個事務中提交)
+                apply_record_changes(cursor, student_id, [(comp_date, record_summary_deltas('competition', result))])
                 conn.commit()
                 flash('參賽記錄已成功添加', 'success')
                 return redirect(url_for('main.view_records', student_id=student_id))
@@ -731,7 +931,7 @@ def record_late(student_id):
                       has_permission = True
                  elif current_user.is_teacher():
                       # 使用 User 模型中實現的方法
-                      if any(c['class_id'] == student['class_id'] for c in current_user.assigned_classes):
+                      if student['class_id'] in current_user.assigned_class_ids:
                            has_permission = True
 
                  if not has_permission:
@@ -771,11 +971,11 @@ def record_late(student_id):
                     "INSERT INTO late_records (student_id, late_date, reason, recorded_by_user_id) VALUES (%s, %s, %s, %s)",
                     (student_id, late_date, reason, current_user.get_id())
                 )
-                conn.commit()
 
-                # 更新學生遲到計數
-                cursor.execute("UPDATE students SET late_count = late_count + 1 WHERE student_id = %s", (student_id,))
+                # 更新學生遲到計數與統計摘要 (與插入記錄在同一個事務中提交)
+                apply_record_changes(cursor, student_id, [(late_date, record_summary_deltas('late'))])
                 conn.commit()
+                invalidate_card_index() # 刷卡登記的「今天已遲到」名單需要重新讀取
 
                 flash('遲到記錄已成功添加', 'success')
                 return redirect(url_for('main.view_records', student_id=student_id))
@@ -813,7 +1013,7 @@ def record_incomplete_homework(student_id):
                       has_permission = True
                  elif current_user.is_teacher():
                       # 使用 User 模型中實現的方法
-                      if any(c['class_id'] == student['class_id'] for c in current_user.assigned_classes):
+                      if student['class_id'] in current_user.assigned_class_ids:
                            has_permission = True
 
                  if not has_permission:
@@ -854,10 +1054,9 @@ def record_incomplete_homework(student_id):
                     "INSERT INTO incomplete_homework_records (student_id, record_date, subject, description, recorded_by_user_id) VALUES (%s, %s, %s, %s, %s)",
                     (student_id, record_date, subject, description, current_user.get_id())
                 )
-                conn.commit()
 
-                # 更新學生欠交功課計數
-                cursor.execute("UPDATE students SET incomplete_homework_count = incomplete_homework_count + 1 WHERE student_id = %s", (student_id,))
+                # 更新學生欠交功課計數與統計摘要 (與插入記錄在同一個事務中提交)
+                apply_record_changes(cursor, student_id, [(record_date, record_summary_deltas('incomplete_homework'))])
                 conn.commit()
 
                 flash('欠交功課記錄已成功添加', 'success')
@@ -876,6 +1075,254 @@ def record_incomplete_homework(student_id):
     return render_template('record_incomplete_homework.html', title=f'記錄 {student["name"]} 欠交功課', student=student, form=form)
 
 
+# --- 全班批量記錄 ---
+# 批量記錄的插入語句 ({values} 由 _insert_many 填入多行 VALUES)
+BATCH_RECORD_INSERTS = {
+    'late': "INSERT INTO late_records (student_id, late_date, reason, recorded_by_user_id) VALUES {values}",
+    'absence': "INSERT INTO absences (student_id, absence_date, session_count, type, reason, recorded_by_user_id) VALUES {values}",
+    'incomplete_homework': "INSERT INTO incomplete_homework_records (student_id, record_date, subject, description, recorded_by_user_id) VALUES {values}",
+}
+
+
+def _insert_many(cursor, sql, rows):
+    """以一個多行 INSERT 插入 rows (每行的欄位數相同)；rows 為空時不執行"""
+    if not rows:
+        return
+    row_sql = "(" + ", ".join(["%s"] * len(rows[0])) + ")"
+    cursor.execute(sql.format(values=", ".join([row_sql] * len(rows))), [value for row in rows for value in row])
+
+
+@main_bp.route('/class/<int:class_id>/batch_record', methods=['GET', 'POST'])
+@login_required
+def batch_record(class_id):
+    """全班批量記錄遲到、缺席與欠交功課 (一次提交，在一個事務中寫入)"""
+    form = BatchRecordForm()
+
+    conn = get_db()
+    class_name = None
+    students = []
+    if conn:
+        cursor = conn.cursor(dictionary=True)
+        try:
+            # 班級名稱 (班級目錄)
+            found_class_name = get_class_name(class_id)
+            if found_class_name is None:
+                flash('找不到該班級', 'danger')
+                return redirect(url_for('main.dashboard'))
+
+            # 檢查權限：教師只能為自己負責的班級記錄
+            if not (current_user.is_admin() or current_user.is_supervisor() or class_id in current_user.assigned_class_ids):
+                flash('您無權為此班級記錄', 'danger')
+                return redirect(url_for('main.dashboard'))
+
+            class_name = found_class_name
+            cursor.execute("SELECT student_id, student_number, name FROM students WHERE class_id = %s ORDER BY student_number, name", (class_id,))
+            students = cursor.fetchall()
+        except mysql.connector.Error as err:
+            flash(f"資料庫錯誤: {err}", 'danger')
+            current_app.logger.error(f"資料庫錯誤 (批量記錄 - 獲取學生): {err}")
+        finally:
+            if conn and conn.is_connected():
+                cursor.close()
+                conn.close()
+
+    if class_name is None:
+        return redirect(url_for('main.dashboard'))
+
+    students_by_id = {student['student_id']: student for student in students}
+    if request.method == 'GET':
+        form.record_date.data = date.today()
+        for student in students:
+            form.rows.append_entry({'student_id': student['student_id']})
+
+    if form.validate_on_submit():
+        record_date = form.record_date.data
+        user_id = current_user.get_id()
+        rows = {kind: [] for kind in BATCH_RECORD_INSERTS}
+        changes = {} # student_id -> [(日期, deltas), ...]
+        seen = set()
+        for row in form.rows:
+            student_id = row.student_id.data
+            if student_id not in students_by_id:
+                continue # 忽略不屬於此班級的學生 (例如提交前已轉班)
+            if student_id in seen:
+                continue # 同一學生只記錄一次 (被修改或重複加入的表單行)
+            seen.add(student_id)
+            if row.late.data:
+                rows['late'].append((student_id, record_date, form.late_reason.data, user_id))
+                changes.setdefault(student_id, []).append((record_date, record_summary_deltas('late')))
+            if row.absence_sessions.data:
+                rows['absence'].append((student_id, record_date, row.absence_sessions.data, row.absence_type.data,
+                                        form.absence_reason.data, user_id))
+                changes.setdefault(student_id, []).append(
+                    (record_date, record_summary_deltas('absence', session_count=row.absence_sessions.data)))
+            if row.incomplete_homework.data:
+                rows['incomplete_homework'].append((student_id, record_date, form.homework_subject.data,
+                                                    form.homework_description.data, user_id))
+                changes.setdefault(student_id, []).append((record_date, record_summary_deltas('incomplete_homework')))
+
+        if not changes:
+            flash('沒有勾選任何記錄', 'warning')
+        else:
+            conn = get_db()
+            if conn:
+                cursor = conn.cursor()
+                try:
+                    # 每種記錄一個多行 INSERT，所有學生的計數器與統計摘要以分組的 UPDATE 更新，一次提交
+                    for kind, sql in BATCH_RECORD_INSERTS.items():
+                        _insert_many(cursor, sql, rows[kind])
+                    apply_bulk_record_changes(cursor, changes)
+                    conn.commit()
+                    if rows['late']:
+                        invalidate_card_index() # 刷卡登記的「今天已遲到」名單需要重新讀取
+                    flash(f"已記錄遲到 {len(rows['late'])} 筆、缺席 {len(rows['absence'])} 筆、欠交功課 {len(rows['incomplete_homework'])} 筆", 'success')
+                    return redirect(url_for('main.student_list', class_id=class_id))
+                except mysql.connector.Error as err:
+                    conn.rollback()
+                    flash(f"資料庫錯誤: {err}", 'danger')
+                    current_app.logger.error(f"資料庫錯誤 (批量記錄): {err}")
+                finally:
+                    if conn and conn.is_connected():
+                        cursor.close()
+                        conn.close()
+            else:
+                flash('無法連接到資料庫', 'danger')
+
+    # 表單的每一行與對應的學生 (用於顯示學號與姓名)
+    roster = [(row, students_by_id[row.student_id.data]) for row in form.rows if row.student_id.data in students_by_id]
+    return render_template('batch_record.html', title=f'{class_name} 批量記錄', class_id=class_id, class_name=class_name,
+                           form=form, roster=roster)
+
+
+# --- 校門刷卡登記遲到 ---
+# 刷卡請求只使用記憶體中的卡號索引與寫入佇列 (見 app/kiosk.py)，不會借出資料庫連接
+@main_bp.route('/kiosk/late')
+@login_required
+def kiosk_late():
+    """校門刷卡登記遲到頁面 (主管與管理員)"""
+    if not (current_user.is_admin() or current_user.is_supervisor()):
+        flash('您無權使用刷卡登記', 'danger')
+        return redirect(url_for('main.dashboard'))
+    return render_template('kiosk_late.html', title='刷卡登記遲到', csrf_token=generate_csrf())
+
+@main_bp.route('/kiosk/late/scan', methods=['POST'])
+@login_required
+def kiosk_late_scan():
+    """
+    處理一次刷卡：code 為 ID 卡號碼或學生證號碼。
+    只接受 JSON 請求主體，並需要 X-CSRFToken 標頭 (刷卡頁面提供)；其他網站的表單無法設定此標頭。
+    """
+    if not (current_user.is_admin() or current_user.is_supervisor()):
+        return jsonify(error='您無權使用刷卡登記'), 403
+    try:
+        validate_csrf(request.headers.get('X-CSRFToken'), time_limit=config.KIOSK_CSRF_TIME_LIMIT)
+    except ValidationError:
+        return jsonify(error='CSRF token 無效或已過期，請重新載入頁面'), 400
+    data = request.get_json(silent=True) if request.is_json else None
+    if not isinstance(data, dict):
+        return jsonify(error='請求內容必須是 JSON'), 415
+    code = (data.get('code') or '').strip()
+    if not code:
+        return jsonify(error='請刷卡或輸入卡號'), 400
+    try:
+        result, student = register_late_scan(code, current_user.get_id(), (data.get('reason') or '').strip() or None)
+    except mysql.connector.Error as err:
+        current_app.logger.error(f"資料庫錯誤 (刷卡登記 - 建立卡號索引): {err}")
+        return jsonify(error='資料庫錯誤，請稍後再試'), 503
+    if result == 'unknown':
+        return jsonify(status=result, code=code, error='找不到此卡號的學生'), 404
+    return jsonify(status=result, code=code, student=student)
+
+
+# --- 記錄批量匯入 API ---
+# 認證失敗次數 (以用戶端位址為鍵，每個工作進程各自計算)：達到 INGEST_AUTH_MAX_FAILURES 次後在 INGEST_AUTH_LOCKOUT 秒內拒絕認證，
+# 每次失敗重新計時，避免以大量請求猜測密碼 (每次檢查密碼都要計算一次 scrypt)
+_ingest_auth_failures = TTLCache(maxsize=4096, ttl=config.INGEST_AUTH_LOCKOUT)
+
+
+class IngestAuthThrottled(Exception):
+    """用戶端的認證失敗次數過多"""
+    pass
+
+
+def _ingest_api_user():
+    """
+    返回匯入 API 的使用者：只接受 HTTP Basic 認證 (供讀卡機等系統呼叫)，不使用瀏覽器的登入 session，
+    因此其他網站無法借用已登入使用者的 cookie 提交記錄 (跨站請求偽造)。
+    只有主管與管理員可以使用，否則返回 None；失敗次數過多時拋出 IngestAuthThrottled。
+    """
+    auth = request.authorization
+    if not (auth and auth.type == 'basic' and auth.username and auth.password):
+        return None
+    client = request.remote_addr
+    failures = _ingest_auth_failures.get(client, 0)
+    if failures >= config.INGEST_AUTH_MAX_FAILURES:
+        raise IngestAuthThrottled()
+
+    user = None
+    conn = get_db()
+    if conn:
+        cursor = conn.cursor(dictionary=True)
+        try:
+            cursor.execute("SELECT * FROM users WHERE username = %s", (auth.username,))
+            user_data = cursor.fetchone()
+        finally:
+            cursor.close()
+        if user_data and check_password_hash(user_data['password_hash'], auth.password):
+            user = User(user_data)
+    if user is None:
+        _ingest_auth_failures.set(client, failures + 1)
+        return None
+    if not (user.is_admin() or user.is_supervisor()):
+        return None
+    return user
+
+@main_bp.route('/api/records/<kind>/ingest', methods=['POST'])
+def ingest_records_api(kind):
+    """
+    批量匯入記錄 (JSON 回應)。請求內容為 CSV 或 JSON Lines：以 multipart 的 file 欄位上傳，或直接作為請求主體
+    (按 Content-Type 判斷格式，也可以用查詢參數 format=csv|jsonl 指定)。
+    需要以 HTTP Basic 認證提供主管或管理員的帳號密碼 (登入 session 不適用於此 API)。
+    """
+    try:
+        user = _ingest_api_user()
+    except IngestAuthThrottled:
+        return jsonify(error='認證失敗次數過多，請稍後再試'), 429, {'Retry-After': str(config.INGEST_AUTH_LOCKOUT)}
+    except mysql.connector.Error as err:
+        current_app.logger.error(f"資料庫錯誤 (記錄批量匯入 - 認證): {err}")
+        return jsonify(error='資料庫錯誤，請稍後再試'), 503
+    if user is None:
+        # 不返回 WWW-Authenticate，避免瀏覽器提示輸入並記住帳號密碼 (記住的帳號密碼會隨跨站請求自動送出)
+        return jsonify(error='需要以 HTTP Basic 認證提供主管或管理員帳號'), 401
+
+    upload = request.files.get('file')
+    if upload:
+        stream = upload.stream
+        fmt = request.args.get('format') or detect_format(upload.filename, upload.content_type)
+    else:
+        stream = io.BufferedReader(request.stream)
+        fmt = request.args.get('format') or detect_format(content_type=request.content_type)
+    if fmt is None:
+        return jsonify(error='無法判斷格式，請使用 Content-Type (text/csv、application/x-ndjson) 或 format 參數'), 400
+
+    conn = get_db()
+    if not conn:
+        return jsonify(error='無法連接到資料庫'), 503
+    try:
+        result = ingest_records(conn, kind, read_rows(stream, fmt), user.get_id())
+    except RecordIngestError as e:
+        return jsonify(error=str(e)), 400
+    except (UnicodeDecodeError, csv.Error) as e:
+        return jsonify(error=f"讀取文件時發生錯誤: {e}"), 400
+    except mysql.connector.Error as err:
+        current_app.logger.error(f"資料庫錯誤 (記錄批量匯入): {err}")
+        return jsonify(error=f"資料庫錯誤，沒有記錄被匯入: {err}"), 500
+
+    errors = [{'line': line_no, 'error': message} for line_no, message in result['errors']]
+    return jsonify(kind=kind, received=result['received'], inserted=result['inserted'], duplicates=result['duplicates'],
+                   error_count=len(errors), errors=errors[:config.IMPORT_JOB_MAX_ERRORS])
+
+
 # --- 修改記錄路由 (GET 顯示表單, POST 處理提交) ---
 
 @main_bp.route('/absence/<int:absence_id>/edit', methods=['GET', 'POST'])
@@ -900,7 +1347,7 @@ def edit_absence(absence_id):
                      has_permission = True
                 elif current_user.is_teacher():
                      # 使用 User 模型中實現的方法
-                     if any(c['class_id'] == absence['class_id'] for c in current_user.assigned_classes):
+                     if absence['class_id'] in current_user.assigned_class_ids:
                           has_permission = True
 
                 if not has_permission:
@@ -1000,11 +1447,24 @@ def edit_absence(absence_id):
         if conn:
             cursor = conn.cursor()
             try:
+                # 鎖定記錄並讀取目前的日期與節數，用於計算統計摘要的變化
+                cursor.execute("SELECT absence_date, session_count FROM absences WHERE absence_id = %s FOR UPDATE", (absence_id,))
+                locked_record = cursor.fetchone()
+                if not locked_record:
+                     conn.rollback()
+                     flash('找不到該缺席記錄', 'danger')
+                     return redirect(url_for('main.view_records', student_id=absence['student_id']))
+                old_date, old_session_count = locked_record
+
                 # 更新缺席記錄到資料庫
                 cursor.execute(
                     "UPDATE absences SET absence_date = %s, session_count = %s, type = %s, reason = %s, upload_path = %s WHERE absence_id = %s",
                     (absence_date, session_count, absence_type, reason, upload_path, absence_id)
                 )
+                apply_record_changes(cursor, absence['student_id'], [
+                    (old_date, record_summary_deltas('absence', session_count=old_session_count, sign=-1)),
+                    (absence_date, record_summary_deltas('absence', session_count=session_count)),
+                ])
                 conn.commit()
                 flash('缺席記錄已成功更新', 'success')
                 # 重定向到學生記錄查看頁面
@@ -1046,7 +1506,7 @@ def edit_award_punishment(record_id):
                       has_permission = True
                  elif current_user.is_teacher():
                       # 使用 User 模型中實現的方法
-                      if any(c['class_id'] == award_punishment['class_id'] for c in current_user.assigned_classes):
+                      if award_punishment['class_id'] in current_user.assigned_class_ids:
                            has_permission = True
 
                  if not has_permission:
@@ -1133,38 +1593,27 @@ def edit_award_punishment(record_id):
         if conn:
             cursor = conn.cursor()
             try:
-                # 在更新前，需要先撤銷舊記錄對點數的影響 (如果需要的話)
-                # 然後根據新的記錄類型重新計算並應用點數變化。
-                # 這樣才能正確反映點數的變化。
-
-                # 撤銷舊點數影響
-                old_type = award_punishment['type']
-                old_student_id = award_punishment['student_id']
-                if old_type in ['優點', '小功', '大功']:
-                     old_points = {'優點': 1, '小功': 3, '大功': 9}.get(old_type, 0)
-                     cursor.execute("UPDATE students SET award_points = award_points - %s WHERE student_id = %s", (old_points, old_student_id))
-                     conn.commit()
-                elif old_type in ['警告', '缺點', '小過', '大過']:
-                     old_points = {'警告': 0, '缺點': 1, '小過': 3, '大過': 9}.get(old_type, 0)
-                     cursor.execute("UPDATE students SET violation_points = violation_points - %s WHERE student_id = %s", (old_points, old_student_id))
-                     conn.commit()
+                # 鎖定記錄並重新讀取目前的日期與類型，避免與同時進行的修改/刪除重複計算點數
+                cursor.execute("SELECT record_date, type FROM awards_punishments WHERE record_id = %s FOR UPDATE", (record_id,))
+                locked_record = cursor.fetchone()
+                if not locked_record:
+                     conn.rollback()
+                     flash('找不到該獎懲記錄', 'danger')
+                     return redirect(url_for('main.view_records', student_id=award_punishment['student_id']))
+                old_date, old_type = locked_record
 
                 # 更新記錄內容
                 cursor.execute(
                     "UPDATE awards_punishments SET record_date = %s, type = %s, description = %s, upload_path = %s WHERE record_id = %s",
                     (record_date, record_type, description, upload_path, record_id)
                 )
-                conn.commit()
 
-                # 應用新點數影響
-                if record_type in ['優點', '小功', '大功']:
-                     new_points = {'優點': 1, '小功': 3, '大功': 9}.get(record_type, 0)
-                     cursor.execute("UPDATE students SET award_points = award_points + %s WHERE student_id = %s", (new_points, award_punishment['student_id']))
-                     conn.commit()
-                elif record_type in ['警告', '缺點', '小過', '大過']:
-                     new_points = {'警告': 0, '缺點': 1, '小過': 3, '大過': 9}.get(record_type, 0)
-                     cursor.execute("UPDATE students SET violation_points = violation_points + %s WHERE student_id = %s", (new_points, award_punishment['student_id']))
-                     conn.commit()
+                # 撤銷舊值並套用新值：students 上的點數只以淨變化更新一次 (類型未改變時不更新)
+                apply_record_changes(cursor, award_punishment['student_id'], [
+                    (old_date, record_summary_deltas('award_punish', old_type, sign=-1)),
+                    (record_date, record_summary_deltas('award_punish', record_type)),
+                ])
+                conn.commit()
 
 
                 flash('獎懲記錄已成功更新', 'success')
@@ -1206,7 +1655,7 @@ def edit_competition(comp_record_id):
                       has_permission = True
                  elif current_user.is_teacher():
                       # 使用 User 模型中實現的方法
-                      if any(c['class_id'] == competition['class_id'] for c in current_user.assigned_classes):
+                      if competition['class_id'] in current_user.assigned_class_ids:
                            has_permission = True
 
                  if not has_permission:
@@ -1296,10 +1745,23 @@ def edit_competition(comp_record_id):
         if conn:
             cursor = conn.cursor()
             try:
+                # 鎖定記錄並讀取目前的日期與結果，用於計算統計摘要的變化
+                cursor.execute("SELECT comp_date, result FROM competitions WHERE comp_record_id = %s FOR UPDATE", (comp_record_id,))
+                locked_record = cursor.fetchone()
+                if not locked_record:
+                     conn.rollback()
+                     flash('找不到該參賽記錄', 'danger')
+                     return redirect(url_for('main.view_records', student_id=competition['student_id']))
+                old_date, old_result = locked_record
+
                 cursor.execute(
                     "UPDATE competitions SET comp_date = %s, comp_name = %s, result = %s, description = %s, upload_path = %s WHERE comp_record_id = %s",
                     (comp_date, comp_name, result, description, upload_path, comp_record_id)
                 )
+                apply_record_changes(cursor, competition['student_id'], [
+                    (old_date, record_summary_deltas('competition', old_result, sign=-1)),
+                    (comp_date, record_summary_deltas('competition', result)),
+                ])
                 conn.commit()
                 flash('參賽記錄已成功更新', 'success')
                 return redirect(url_for('main.view_records', student_id=competition['student_id']))
@@ -1338,7 +1800,7 @@ def edit_late_record(late_id):
                       has_permission = True
                  elif current_user.is_teacher():
                       # 使用 User 模型中實現的方法
-                      if any(c['class_id'] == late_record['class_id'] for c in current_user.assigned_classes):
+                      if late_record['class_id'] in current_user.assigned_class_ids:
                            has_permission = True
 
                  if not has_permission:
@@ -1378,11 +1840,25 @@ def edit_late_record(late_id):
         if conn:
             cursor = conn.cursor()
             try:
+                # 鎖定記錄並讀取目前的日期 (日期改到另一個學期時需要移動學期統計)
+                cursor.execute("SELECT late_date FROM late_records WHERE late_id = %s FOR UPDATE", (late_id,))
+                locked_record = cursor.fetchone()
+                if not locked_record:
+                     conn.rollback()
+                     flash('找不到該遲到記錄', 'danger')
+                     return redirect(url_for('main.view_records', student_id=late_record['student_id']))
+                old_date = locked_record[0]
+
                 cursor.execute(
                     "UPDATE late_records SET late_date = %s, reason = %s WHERE late_id = %s",
                     (late_date, reason, late_id)
                 )
+                apply_record_changes(cursor, late_record['student_id'], [
+                    (old_date, record_summary_deltas('late', sign=-1)),
+                    (late_date, record_summary_deltas('late')),
+                ])
                 conn.commit()
+                invalidate_card_index() # 刷卡登記的「今天已遲到」名單需要重新讀取
                 flash('遲到記錄已成功更新', 'success')
                 return redirect(url_for('main.view_records', student_id=late_record['student_id']))
             except mysql.connector.Error as err:
@@ -1420,7 +1896,7 @@ def edit_incomplete_homework_record(incomplete_hw_id):
                       has_permission = True
                  elif current_user.is_teacher():
                       # 使用 User 模型中實現的方法
-                      if any(c['class_id'] == incomplete_homework_record['class_id'] for c in current_user.assigned_classes):
+                      if incomplete_homework_record['class_id'] in current_user.assigned_class_ids:
                            has_permission = True
 
                  if not has_permission:
@@ -1462,10 +1938,23 @@ def edit_incomplete_homework_record(incomplete_hw_id):
         if conn:
             cursor = conn.cursor()
             try:
+                # 鎖定記錄並讀取目前的日期 (日期改到另一個學期時需要移動學期統計)
+                cursor.execute("SELECT record_date FROM incomplete_homework_records WHERE incomplete_hw_id = %s FOR UPDATE", (incomplete_hw_id,))
+                locked_record = cursor.fetchone()
+                if not locked_record:
+                     conn.rollback()
+                     flash('找不到該欠交功課記錄', 'danger')
+                     return redirect(url_for('main.view_records', student_id=incomplete_homework_record['student_id']))
+                old_date = locked_record[0]
+
                 cursor.execute(
                     "UPDATE incomplete_homework_records SET record_date = %s, subject = %s, description = %s WHERE incomplete_hw_id = %s",
                     (record_date, subject, description, incomplete_hw_id)
                 )
+                apply_record_changes(cursor, incomplete_homework_record['student_id'], [
+                    (old_date, record_summary_deltas('incomplete_homework', sign=-1)),
+                    (record_date, record_summary_deltas('incomplete_homework')),
+                ])
                 conn.commit()
                 flash('欠交功課記錄已成功更新', 'success')
                 return redirect(url_for('main.view_records', student_id=incomplete_homework_record['student_id']))
@@ -1496,7 +1985,7 @@ def delete_absence(absence_id):
     if conn:
         cursor = conn.cursor(dictionary=True)
         try:
-            cursor.execute("SELECT absence_id, student_id, upload_path, s.class_id FROM absences a JOIN students s ON a.student_id = s.student_id WHERE absence_id = %s", (absence_id,))
+            cursor.execute("SELECT a.absence_id, a.student_id, a.absence_date, a.session_count, a.upload_path, s.class_id FROM absences a JOIN students s ON a.student_id = s.student_id WHERE a.absence_id = %s FOR UPDATE", (absence_id,))
             absence = cursor.fetchone()
 
             if absence:
@@ -1508,7 +1997,7 @@ def delete_absence(absence_id):
                       has_permission = True
                  elif current_user.is_teacher():
                       # 使用 User 模型中實現的方法
-                      if any(c['class_id'] == absence['class_id'] for c in current_user.assigned_classes):
+                      if absence['class_id'] in current_user.assigned_class_ids:
                            has_permission = True
 
                  if not has_permission:
@@ -1518,7 +2007,14 @@ def delete_absence(absence_id):
                            conn.close()
                       return redirect(url_for('main.dashboard'))
 
-                 # 刪除相關文件 (如果存在)
+                 # 刪除資料庫記錄
+                 cursor.execute("DELETE FROM absences WHERE absence_id = %s", (absence_id,))
+                 apply_record_changes(cursor, student_id, [
+                     (absence['absence_date'], record_summary_deltas('absence', session_count=absence['session_count'], sign=-1))
+                 ])
+                 conn.commit()
+
+                 # 資料庫記錄刪除並提交後，再刪除相關文件 (如果存在)
                  if absence['upload_path']:
                       file_path = os.path.join(current_app.config['UPLOAD_FOLDER'], absence['upload_path'])
                       if os.path.exists(file_path):
@@ -1528,11 +2024,6 @@ def delete_absence(absence_id):
                            except OSError as e:
                                 flash(f"刪除相關證明文件失敗: {e}", 'danger')
                                 current_app.logger.error(f"刪除相關證明文件失敗: {e}")
-
-
-                 # 刪除資料庫記錄
-                 cursor.execute("DELETE FROM absences WHERE absence_id = %s", (absence_id,))
-                 conn.commit()
                  flash('缺席記錄已成功刪除', 'success')
                  # 重定向到原學生的記錄頁面
                  return redirect(url_for('main.view_records', student_id=student_id))
@@ -1567,7 +2058,7 @@ def delete_award_punishment(record_id):
     if conn:
         cursor = conn.cursor(dictionary=True)
         try:
-            cursor.execute("SELECT record_id, student_id, upload_path, type, s.class_id FROM awards_punishments ap JOIN students s ON ap.student_id = s.student_id WHERE record_id = %s", (record_id,))
+            cursor.execute("SELECT ap.record_id, ap.student_id, ap.record_date, ap.upload_path, ap.type, s.class_id FROM awards_punishments ap JOIN students s ON ap.student_id = s.student_id WHERE ap.record_id = %s FOR UPDATE", (record_id,))
             award_punishment = cursor.fetchone()
 
             if award_punishment:
@@ -1579,7 +2070,7 @@ def delete_award_punishment(record_id):
                       has_permission = True
                  elif current_user.is_teacher():
                       # 使用 User 模型中實現的方法
-                      if any(c['class_id'] == award_punishment['class_id'] for c in current_user.assigned_classes):
+                      if award_punishment['class_id'] in current_user.assigned_class_ids:
                            has_permission = True
 
                  if not has_permission:
@@ -1589,19 +2080,14 @@ def delete_award_punishment(record_id):
                            conn.close()
                       return redirect(url_for('main.dashboard'))
 
-                 # 在刪除記錄前，撤銷對學生點數的影響
-                 record_type = award_punishment['type']
-                 if record_type in ['優點', '小功', '大功']:
-                      points = {'優點': 1, '小功': 3, '大功': 9}.get(record_type, 0)
-                      cursor.execute("UPDATE students SET award_points = award_points - %s WHERE student_id = %s", (points, student_id))
-                      conn.commit()
-                 elif record_type in ['警告', '缺點', '小過', '大過']:
-                      points = {'警告': 0, '缺點': 1, '小過': 3, '大過': 9}.get(record_type, 0)
-                      cursor.execute("UPDATE students SET violation_points = violation_points - %s WHERE student_id = %s", (points, student_id))
-                      conn.commit()
-
+                 # 刪除資料庫記錄，並在同一個事務中撤銷對學生點數的影響
+                 cursor.execute("DELETE FROM awards_punishments WHERE record_id = %s", (record_id,))
+                 apply_record_changes(cursor, student_id, [
+                     (award_punishment['record_date'], record_summary_deltas('award_punish', award_punishment['type'], sign=-1))
+                 ])
+                 conn.commit()
 
-                 # 刪除相關文件 (如果存在)
+                 # 資料庫記錄刪除並提交後，再刪除相關文件 (如果存在)
                  if award_punishment['upload_path']:
                       file_path = os.path.join(current_app.config['UPLOAD_FOLDER'], award_punishment['upload_path'])
                       if os.path.exists(file_path):
@@ -1611,10 +2097,6 @@ def delete_award_punishment(record_id):
                            except OSError as e:
                                 flash(f"刪除相關證明文件失敗: {e}", 'danger')
                                 current_app.logger.error(f"刪除相關證明文件失敗: {e}")
-
-                 # 刪除資料庫記錄
-                 cursor.execute("DELETE FROM awards_punishments WHERE record_id = %s", (record_id,))
-                 conn.commit()
                  flash('獎懲記錄已成功刪除', 'success')
                  return redirect(url_for('main.view_records', student_id=student_id))
 
@@ -1646,7 +2128,7 @@ def delete_competition(comp_record_id):
     if conn:
         cursor = conn.cursor(dictionary=True)
         try:
-            cursor.execute("SELECT comp_record_id, student_id, upload_path, s.class_id FROM competitions c JOIN students s ON c.student_id = s.student_id WHERE comp_record_id = %s", (comp_record_id,))
+            cursor.execute("SELECT c.comp_record_id, c.student_id, c.comp_date, c.result, c.upload_path, s.class_id FROM competitions c JOIN students s ON c.student_id = s.student_id WHERE c.comp_record_id = %s FOR UPDATE", (comp_record_id,))
             competition = cursor.fetchone()
 
             if competition:
@@ -1658,7 +2140,7 @@ def delete_competition(comp_record_id):
                       has_permission = True
                  elif current_user.is_teacher():
                       # 使用 User 模型中實現的方法
-                      if any(c['class_id'] == competition['class_id'] for c in current_user.assigned_classes):
+                      if competition['class_id'] in current_user.assigned_class_ids:
                            has_permission = True
 
                  if not has_permission:
@@ -1668,7 +2150,14 @@ def delete_competition(comp_record_id):
                            conn.close()
                       return redirect(url_for('main.dashboard'))
 
-                 # 刪除相關文件 (如果存在)
+                 # 刪除資料庫記錄
+                 cursor.execute("DELETE FROM competitions WHERE comp_record_id = %s", (comp_record_id,))
+                 apply_record_changes(cursor, student_id, [
+                     (competition['comp_date'], record_summary_deltas('competition', competition['result'], sign=-1))
+                 ])
+                 conn.commit()
+
+                 # 資料庫記錄刪除並提交後，再刪除相關文件 (如果存在)
                  if competition['upload_path']:
                       file_path = os.path.join(current_app.config['UPLOAD_FOLDER'], competition['upload_path'])
                       if os.path.exists(file_path):
@@ -1678,10 +2167,6 @@ def delete_competition(comp_record_id):
                            except OSError as e:
                                 flash(f"刪除相關證明文件失敗: {e}", 'danger')
                                 current_app.logger.error(f"刪除相關證明文件失敗: {e}")
-
-                 # 刪除資料庫記錄
-                 cursor.execute("DELETE FROM competitions WHERE comp_record_id = %s", (comp_record_id,))
-                 conn.commit()
                  flash('參賽記錄已成功刪除', 'success')
                  return redirect(url_for('main.view_records', student_id=student_id))
 
@@ -1713,7 +2198,7 @@ def delete_late_record(late_id):
     if conn:
         cursor = conn.cursor(dictionary=True)
         try:
-            cursor.execute("SELECT lr.late_id, lr.student_id, s.class_id FROM late_records lr JOIN students s ON lr.student_id = s.student_id WHERE lr.late_id = %s", (late_id,))
+            cursor.execute("SELECT lr.late_id, lr.student_id, lr.late_date, s.class_id FROM late_records lr JOIN students s ON lr.student_id = s.student_id WHERE lr.late_id = %s FOR UPDATE", (late_id,))
             late_record = cursor.fetchone()
 
             if late_record:
@@ -1725,7 +2210,7 @@ def delete_late_record(late_id):
                       has_permission = True
                  elif current_user.is_teacher():
                       # 使用 User 模型中實現的方法
-                      if any(c['class_id'] == late_record['class_id'] for c in current_user.assigned_classes):
+                      if late_record['class_id'] in current_user.assigned_class_ids:
                            has_permission = True
 
                  if not has_permission:
@@ -1737,11 +2222,11 @@ def delete_late_record(late_id):
 
                  # 刪除資料庫記錄
                  cursor.execute("DELETE FROM late_records WHERE late_id = %s", (late_id,))
-                 conn.commit()
 
-                 # 更新學生遲到計數 (減少1)
-                 cursor.execute("UPDATE students SET late_count = late_count - 1 WHERE student_id = %s", (student_id,))
+                 # 更新學生遲到計數 (減少1) 與統計摘要，與刪除記錄在同一個事務中提交
+                 apply_record_changes(cursor, student_id, [(late_record['late_date'], record_summary_deltas('late', sign=-1))])
                  conn.commit()
+                 invalidate_card_index() # 刷卡登記的「今天已遲到」名單需要重新讀取
 
                  flash('遲到記錄已成功刪除', 'success')
                  return redirect(url_for('main.view_records', student_id=student_id))
@@ -1774,7 +2259,7 @@ def delete_incomplete_homework_record(incomplete_hw_id):
     if conn:
         cursor = conn.cursor(dictionary=True)
         try:
-            cursor.execute("SELECT ihr.incomplete_hw_id, ihr.student_id, s.class_id FROM incomplete_homework_records ihr JOIN students s ON ihr.student_id = s.student_id WHERE incomplete_hw_id = %s", (incomplete_hw_id,))
+            cursor.execute("SELECT ihr.incomplete_hw_id, ihr.student_id, ihr.record_date, s.class_id FROM incomplete_homework_records ihr JOIN students s ON ihr.student_id = s.student_id WHERE ihr.incomplete_hw_id = %s FOR UPDATE", (incomplete_hw_id,))
             incomplete_homework_record = cursor.fetchone()
 
             if incomplete_homework_record:
@@ -1786,7 +2271,7 @@ def delete_incomplete_homework_record(incomplete_hw_id):
                       has_permission = True
                  elif current_user.is_teacher():
                       # 使用 User 模型中實現的方法
-                      if any(c['class_id'] == incomplete_homework_record['class_id'] for c in current_user.assigned_classes):
+                      if incomplete_homework_record['class_id'] in current_user.assigned_class_ids:
                            has_permission = True
 
                  if not has_permission:
@@ -1798,10 +2283,11 @@ def delete_incomplete_homework_record(incomplete_hw_id):
 
                  # 刪除資料庫記錄
                  cursor.execute("DELETE FROM incomplete_homework_records WHERE incomplete_hw_id = %s", (incomplete_hw_id,))
-                 conn.commit()
 
-                 # 更新學生欠交功課計數 (減少1)
-                 cursor.execute("UPDATE students SET incomplete_homework_count = incomplete_homework_count - 1 WHERE student_id = %s", (student_id,))
+                 # 更新學生欠交功課計數 (減少1) 與統計摘要，與刪除記錄在同一個事務中提交
+                 apply_record_changes(cursor, student_id, [
+                     (incomplete_homework_record['record_date'], record_summary_deltas('incomplete_homework', sign=-1))
+                 ])
                  conn.commit()
 
                  flash('欠交功課記錄已成功刪除', 'success')
@@ -1838,43 +2324,10 @@ def uploaded_file(filename):
         abort(404)
         return # abort 已經會終止請求，這裡的 return 只是為了明確流程
 
-    conn = get_db()
-    has_permission = False
-
-    if conn:
-        cursor = conn.cursor()
-        try:
-            # 檢查使用者是否有權限訪問這個班級的文件
-            if current_user.is_admin() or current_user.is_supervisor():
-                 has_permission = True
-            elif current_user.is_teacher():
-                 # 檢查教師是否負責此班級
-                 # 使用 User 模型中實現的方法
-                 if any(c['class_id'] == class_id for c in current_user.assigned_classes):
-                      has_permission = True
-
-            # 可以選擇添加一個額外的檢查，確保文件路徑存在於資料庫的某個記錄中
-            # 這可以防止使用者猜測文件路徑來訪問未經授權的文件
-            # 例如：
-            # cursor.execute("SELECT 1 FROM absences WHERE upload_path = %s AND student_id IN (SELECT student_id FROM students WHERE class_id = %s)", (filename, class_id))
-            # if cursor.fetchone():
-            #     # 文件路徑存在且屬於該班級，進一步檢查使用者權限
-            #     # (權限檢查已經在上面實現)
-            #     pass
-            # else:
-            #     # 文件路徑不存在於資料庫中，或者不屬於該班級
-            #     has_permission = False # 如果文件路徑不存在於資料庫中，無論角色是什麼都拒絕訪問
-
-        except mysql.connector.Error as err:
-             current_app.logger.error(f"資料庫錯誤 (檢查文件訪問權限): {err}")
-             # 發生資料庫錯誤時，出於安全考慮，預設為無權限
-             has_permission = False
-        finally:
-             if conn and conn.is_connected():
-                  cursor.close()
-                  conn.close()
-
-    if not has_permission:
+    # 檢查使用者是否有權限訪問這個班級的文件 (教師只能訪問自己負責班級的文件)
+    # 可以選擇添加一個額外的檢查，確保文件路徑存在於資料庫的某個記錄中，防止使用者猜測文件路徑；
+    # 例如查詢 absences 等表中 upload_path = filename 的記錄是否屬於該班級
+    if not _can_view_class(class_id):
         # 如果沒有權限，返回 403 Forbidden
         abort(403)
         return # abort 已經會終止請求，這裡的 return 只是為了明確流程
@@ -1882,11 +2335,18 @@ def uploaded_file(filename):
     try:
         # 使用 send_from_directory 安全地提供文件
         # directory 應該是 UPLOAD_FOLDER 的根目錄， filename 則是相對於該目錄的路徑 (包含 class_id)
-        return send_from_directory(current_app.config['UPLOAD_FOLDER'], filename)
+        # 上傳的文件名包含上傳時間且不會被修改，因此使用強 ETag (由文件的修改時間、大小與名稱生成) 並允許瀏覽器長時間保存；
+        # 證明文件只應保存在使用者自己的瀏覽器中，不能由共用的代理伺服器快取 (private)
+        response = send_from_directory(current_app.config['UPLOAD_FOLDER'], filename,
+                                       max_age=config.UPLOAD_CACHE_MAX_AGE, etag=True, conditional=True)
     except FileNotFoundError:
         # 如果文件不存在，返回 404
         abort(404)
         return # abort 已經會終止請求，這裡的 return 只是為了明確流程
+    response.cache_control.public = False
+    response.cache_control.private = True
+    response.cache_control.immutable = True
+    return response
 
 # 修改密碼路由 (使用者自己修改) - 保留此路由，但從 header 移除連結
 @main_bp.route('/account/change_password', methods=['GET', 'POST'])
@@ -1915,6 +2375,7 @@ def change_password():
                           hashed_password = generate_password_hash(new_password)
                           cursor.execute("UPDATE users SET password_hash = %s WHERE user_id = %s", (hashed_password, current_user.get_id()))
                           conn.commit()
+                          invalidate_user(current_user.get_id()) # 快取中的舊密碼雜湊立即失效
                           flash('您的密碼已成功修改', 'success')
                           # 修改密碼後通常建議重新登入
                           logout_user()
@@ -1953,6 +2414,184 @@ def account_info():
 
 # --- 新增的主管查看所有記錄的路由 ---
 
+# 主管頁面的資料版本：所有班級版本的合計 (記錄寫入遞增學生所屬班級)、班級目錄與使用者資料 (見 app/http_cache.py)
+SUPERVISOR_PAGE_SCOPES = [('class', None), ('classes', 0), ('users', 0)]
+
+# 主管查看所有記錄頁面的查詢定義
+# 每種記錄只選取模板顯示的欄位；text_columns 中的長文字欄位只取前 RECORD_TEXT_PREVIEW_LENGTH 個字元
+# 分頁使用鍵集 (keyset) 分頁：按 (日期, recorded_at, 主鍵) 降序排列，下一頁從上一頁最後一筆記錄之後繼續，
+# 不使用 OFFSET，因此每一頁的查詢成本相同，與翻到第幾頁無關
+SUPERVISOR_RECORD_VIEWS = {
+    'absences': {
+        'table': 'absences', 'alias': 'a', 'id': 'absence_id', 'date': 'absence_date',
+        'columns': ['session_count', 'type', 'upload_path'], 'text_columns': ['reason'],
+        'type_column': 'type', 'type_label': '缺席類型', 'type_options': ABSENCE_TYPES, 'label': '缺席',
+    },
+    'awards_punishments': {
+        'table': 'awards_punishments', 'alias': 'ap', 'id': 'record_id', 'date': 'record_date',
+        'columns': ['type', 'upload_path'], 'text_columns': ['description'],
+        'type_column': 'type', 'type_label': '獎懲類型', 'type_options': AWARD_PUNISH_TYPES, 'label': '獎懲',
+    },
+    'competitions': {
+        'table': 'competitions', 'alias': 'comp', 'id': 'comp_record_id', 'date': 'comp_date',
+        'columns': ['comp_name', 'result', 'upload_path'], 'text_columns': [],
+        'type_column': 'result', 'type_label': '結果', 'type_options': COMPETITION_RESULTS, 'label': '參賽',
+    },
+    'lates': {
+        'table': 'late_records', 'alias': 'lr', 'id': 'late_id', 'date': 'late_date',
+        'columns': [], 'text_columns': ['reason'],
+        'type_column': None, 'type_label': None, 'type_options': [], 'label': '遲到',
+    },
+    'incomplete_homeworks': {
+        'table': 'incomplete_homework_records', 'alias': 'ihr', 'id': 'incomplete_hw_id', 'date': 'record_date',
+        'columns': ['subject'], 'text_columns': [],
+        'type_column': None, 'type_label': None, 'type_options': [], 'label': '欠交功課',
+    },
+}
+
+
+def _parse_record_cursor(value):
+    """解析 '日期_記錄時間_主鍵' 形式的分頁游標，格式無效時返回 None (視為第一頁)"""
+    try:
+        date_part, recorded_at_part, id_part = value.split('_')
+        return (datetime.strptime(date_part, '%Y-%m-%d').date(),
+                datetime.strptime(recorded_at_part, '%Y-%m-%d %H:%M:%S'),
+                int(id_part))
+    except (AttributeError, ValueError):
+        return None
+
+
+def _read_record_filters(spec):
+    """從查詢參數讀取篩選條件，忽略格式無效的值；返回只包含有效條件的字典 (用於生成分頁連結)"""
+    filters = {}
+    for key in ('date_from', 'date_to'):
+        value = request.args.get(key, '').strip()
+        try:
+            datetime.strptime(value, '%Y-%m-%d')
+            filters[key] = value
+        except ValueError:
+            pass
+    class_id = request.args.get('class_id', type=int)
+    if class_id:
+        filters['class_id'] = class_id
+    record_type = request.args.get('type', '').strip()
+    if record_type and record_type in spec['type_options']:
+        filters['type'] = record_type
+    student = request.args.get('student', '').strip()[:50]
+    if student:
+        filters['student'] = student
+    return filters
+
+
+def build_supervisor_records_query(view_name, filters, after, limit):
+    """
+    生成主管查看所有記錄頁面的查詢語句與參數。
+    filters 為 _read_record_filters() 返回的篩選條件，after 為 _parse_record_cursor() 返回的游標 (或 None)。
+    flask db explain 也使用這個函式檢查查詢計劃，確保檢查的查詢與頁面實際執行的一致。
+    """
+    spec = SUPERVISOR_RECORD_VIEWS[view_name]
+    alias = spec['alias']
+    id_column = f"{alias}.{spec['id']}"
+    date_column = f"{alias}.{spec['date']}"
+    preview_length = config.RECORD_TEXT_PREVIEW_LENGTH
+
+    # 只選取顯示需要的欄位；長文字多取一個字元，用於判斷是否需要加上省略號
+    select_columns = [id_column, f"{alias}.student_id", date_column, f"{alias}.recorded_at"]
+    select_columns += [f"{alias}.{column}" for column in spec['columns']]
+    select_columns += [f"LEFT({alias}.{column}, {preview_length + 1}) AS {column}" for column in spec['text_columns']]
+    select_columns += ["s.name AS student_name", "c.class_name"]
+
+    conditions = []
+    params = []
+    if 'date_from' in filters:
+        conditions.append(f"{date_column} >= %s")
+        params.append(filters['date_from'])
+    if 'date_to' in filters:
+        conditions.append(f"{date_column} <= %s")
+        params.append(filters['date_to'])
+    if 'class_id' in filters:
+        conditions.append("s.class_id = %s")
+        params.append(filters['class_id'])
+    if 'type' in filters:
+        conditions.append(f"{alias}.{spec['type_column']} = %s")
+        params.append(filters['type'])
+    if 'student' in filters:
+        # 學號完全相符，或姓名以輸入內容開頭
+        escaped = filters['student'].replace('\\', '\\\\').replace('%', '\\%').replace('_', '\\_')
+        conditions.append("(s.student_number = %s OR s.name LIKE %s)")
+        params.extend([filters['student'], f"{escaped}%"])
+    if after:
+        # 展開的行比較 (date, recorded_at, id) < 游標，讓 MySQL 可以使用索引範圍掃描
+        conditions.append(
+            f"({date_column} < %s OR ({date_column} = %s AND ({alias}.recorded_at < %s"
+            f" OR ({alias}.recorded_at = %s AND {id_column} < %s))))"
+        )
+        after_date, after_recorded_at, after_id = after
+        params.extend([after_date, after_date, after_recorded_at, after_recorded_at, after_id])
+
+    where_sql = f"WHERE {' AND '.join(conditions)}" if conditions else ""
+    sql = f"""
+            SELECT {', '.join(select_columns)}
+            FROM {spec['table']} {alias}
+            JOIN students s ON {alias}.student_id = s.student_id
+            JOIN classes c ON s.class_id = c.class_id
+            {where_sql}
+            ORDER BY {date_column} DESC, {alias}.recorded_at DESC, {id_column} DESC
+            LIMIT %s
+        """
+    return sql, (*params, limit)
+
+
+def _query_supervisor_records(view_name):
+    """
+    按篩選條件和分頁游標查詢一頁記錄。
+    返回模板所需的數據：records、classes、filters、next_cursor 等。
+    """
+    spec = SUPERVISOR_RECORD_VIEWS[view_name]
+    preview_length = config.RECORD_TEXT_PREVIEW_LENGTH
+    per_page = config.SUPERVISOR_RECORDS_PER_PAGE
+
+    filters = _read_record_filters(spec)
+    after = _parse_record_cursor(request.args.get('after'))
+    page = {
+        'records': [], 'classes': [], 'filters': filters, 'next_cursor': None, 'is_first_page': after is None,
+        'type_label': spec['type_label'], 'type_options': spec['type_options'],
+    }
+    # 多取一筆用於判斷是否還有下一頁
+    sql, params = build_supervisor_records_query(view_name, filters, after, per_page + 1)
+
+    conn = get_db()
+    if not conn:
+        flash('無法連接到資料庫', 'danger')
+        return page
+    cursor = conn.cursor(dictionary=True)
+    try:
+        page['classes'] = get_classes()
+
+        cursor.execute(sql, params)
+        records = cursor.fetchall()
+
+        if len(records) > per_page:
+            records = records[:per_page]
+            last = records[-1]
+            page['next_cursor'] = (f"{last[spec['date']]:%Y-%m-%d}_{last['recorded_at']:%Y-%m-%d %H:%M:%S}"
+                                   f"_{last[spec['id']]}")
+        for record in records:
+            for column in spec['text_columns']:
+                if record[column] and len(record[column]) > preview_length:
+                    record[column] = record[column][:preview_length] + '…'
+        page['records'] = records
+
+    except mysql.connector.Error as err:
+        flash(f"資料庫錯誤: {err}", 'danger')
+        current_app.logger.error(f"資料庫錯誤 (主管查看所有{spec['label']}): {err}")
+    finally:
+        if conn and conn.is_connected():
+             cursor.close()
+             conn.close()
+
+    return page
+
 @main_bp.route('/supervisor/absences')
 @login_required
 def view_all_absences():
@@ -1962,31 +2601,14 @@ def view_all_absences():
         flash('您沒有權限訪問此頁面。', 'danger')
         return redirect(url_for('main.index')) # 或其他無權限頁面
 
-    conn = get_db()
-    all_absences = []
-    if conn:
-        cursor = conn.cursor(dictionary=True)
-        try:
-            # 查詢所有缺席記錄，並關聯學生和班級信息以便顯示
-            cursor.execute("""
-                SELECT a.*, s.student_number, s.name AS student_name, c.class_name
-                FROM absences a
-                JOIN students s ON a.student_id = s.student_id
-                JOIN classes c ON s.class_id = c.class_id
-                ORDER BY a.absence_date DESC, a.recorded_at DESC
-            """)
-            all_absences = cursor.fetchall()
-
-        except mysql.connector.Error as err:
-            flash(f"資料庫錯誤: {err}", 'danger')
-            current_app.logger.error(f"資料庫錯誤 (主管查看所有缺席): {err}")
-        finally:
-            if conn and conn.is_connected():
-                 cursor.close()
-                 conn.close()
+    # 資料版本未改變時直接返回 304 (版本與請求網址一起組成 ETag，因此每組篩選條件與分頁各自驗證)
+    not_modified, validators = conditional_request(SUPERVISOR_PAGE_SCOPES)
+    if not_modified:
+        return not_modified
 
+    page = _query_supervisor_records('absences')
     # 渲染模板並傳遞數據
-    return render_template('view_all_absences.html', title='所有缺席記錄', absences=all_absences)
+    return with_validators(render_template('view_all_absences.html', title='所有缺席記錄', absences=page['records'], page=page), validators)
 
 @main_bp.route('/supervisor/awards_punishments')
 @login_required
@@ -1997,31 +2619,13 @@ def view_all_awards_punishments():
         flash('您沒有權限訪問此頁面。', 'danger')
         return redirect(url_for('main.index'))
 
-    conn = get_db()
-    all_awards_punishments = []
-    if conn:
-        cursor = conn.cursor(dictionary=True)
-        try:
-            # 查詢所有獎懲記錄，並關聯學生和班級信息以便顯示
-            cursor.execute("""
-                SELECT ap.*, s.student_number, s.name AS student_name, c.class_name
-                FROM awards_punishments ap
-                JOIN students s ON ap.student_id = s.student_id
-                JOIN classes c ON s.class_id = c.class_id
-                ORDER BY ap.record_date DESC, ap.recorded_at DESC
-            """)
-            all_awards_punishments = cursor.fetchall()
-
-        except mysql.connector.Error as err:
-            flash(f"資料庫錯誤: {err}", 'danger')
-            current_app.logger.error(f"資料庫錯誤 (主管查看所有獎懲): {err}")
-        finally:
-            if conn and conn.is_connected():
-                 cursor.close()
-                 conn.close()
+    not_modified, validators = conditional_request(SUPERVISOR_PAGE_SCOPES)
+    if not_modified:
+        return not_modified
 
+    page = _query_supervisor_records('awards_punishments')
     # 渲染模板並傳遞數據
-    return render_template('view_all_awards_punishments.html', title='所有獎懲記錄', awards_punishments=all_awards_punishments)
+    return with_validators(render_template('view_all_awards_punishments.html', title='所有獎懲記錄', awards_punishments=page['records'], page=page), validators)
 
 @main_bp.route('/supervisor/competitions')
 @login_required
@@ -2032,31 +2636,13 @@ def view_all_competitions():
         flash('您沒有權限訪問此頁面。', 'danger')
         return redirect(url_for('main.index'))
 
-    conn = get_db()
-    all_competitions = []
-    if conn:
-        cursor = conn.cursor(dictionary=True)
-        try:
-            # 查詢所有參賽記錄，並關聯學生和班級信息以便顯示
-            cursor.execute("""
-                SELECT comp.*, s.student_number, s.name AS student_name, c.class_name
-                FROM competitions comp
-                JOIN students s ON comp.student_id = s.student_id
-                JOIN classes c ON s.class_id = c.class_id
-                ORDER BY comp.comp_date DESC, comp.recorded_at DESC
-            """)
-            all_competitions = cursor.fetchall()
-
-        except mysql.connector.Error as err:
-            flash(f"資料庫錯誤: {err}", 'danger')
-            current_app.logger.error(f"資料庫錯誤 (主管查看所有參賽): {err}")
-        finally:
-            if conn and conn.is_connected():
-                 cursor.close()
-                 conn.close()
+    not_modified, validators = conditional_request(SUPERVISOR_PAGE_SCOPES)
+    if not_modified:
+        return not_modified
 
+    page = _query_supervisor_records('competitions')
     # 渲染模板並傳遞數據
-    return render_template('view_all_competitions.html', title='所有參賽記錄', competitions=all_competitions)
+    return with_validators(render_template('view_all_competitions.html', title='所有參賽記錄', competitions=page['records'], page=page), validators)
 
 @main_bp.route('/supervisor/lates')
 @login_required
@@ -2067,31 +2653,13 @@ def view_all_lates():
         flash('您沒有權限訪問此頁面。', 'danger')
         return redirect(url_for('main.index'))
 
-    conn = get_db()
-    all_lates = []
-    if conn:
-        cursor = conn.cursor(dictionary=True)
-        try:
-            # 查詢所有遲到記錄，並關聯學生和班級信息以便顯示
-            cursor.execute("""
-                SELECT lr.*, s.student_number, s.name AS student_name, c.class_name
-                FROM late_records lr
-                JOIN students s ON lr.student_id = s.student_id
-                JOIN classes c ON s.class_id = c.class_id
-                ORDER BY lr.late_date DESC, lr.recorded_at DESC
-            """)
-            all_lates = cursor.fetchall()
-
-        except mysql.connector.Error as err:
-            flash(f"資料庫錯誤: {err}", 'danger')
-            current_app.logger.error(f"資料庫錯誤 (主管查看所有遲到): {err}")
-        finally:
-            if conn and conn.is_connected():
-                 cursor.close()
-                 conn.close()
+    not_modified, validators = conditional_request(SUPERVISOR_PAGE_SCOPES)
+    if not_modified:
+        return not_modified
 
+    page = _query_supervisor_records('lates')
     # 渲染模板並傳遞數據
-    return render_template('view_all_lates.html', title='所有遲到記錄', lates=all_lates)
+    return with_validators(render_template('view_all_lates.html', title='所有遲到記錄', lates=page['records'], page=page), validators)
 
 @main_bp.route('/supervisor/incomplete_homeworks')
 @login_required
@@ -2102,31 +2670,13 @@ def view_all_incomplete_homeworks():
         flash('您沒有權限訪問此頁面。', 'danger')
         return redirect(url_for('main.index'))
 
-    conn = get_db()
-    all_incomplete_homeworks = []
-    if conn:
-        cursor = conn.cursor(dictionary=True)
-        try:
-            # 查詢所有欠交功課記錄，並關聯學生和班級信息以便顯示
-            cursor.execute("""
-                SELECT ihr.*, s.student_number, s.name AS student_name, c.class_name
-                FROM incomplete_homework_records ihr
-                JOIN students s ON ihr.student_id = s.student_id
-                JOIN classes c ON s.class_id = c.class_id
-                ORDER BY ihr.record_date DESC, ihr.recorded_at DESC
-            """)
-            all_incomplete_homeworks = cursor.fetchall()
-
-        except mysql.connector.Error as err:
-            flash(f"資料庫錯誤: {err}", 'danger')
-            current_app.logger.error(f"資料庫錯誤 (主管查看所有欠交功課): {err}")
-        finally:
-            if conn and conn.is_connected():
-                 cursor.close()
-                 conn.close()
+    not_modified, validators = conditional_request(SUPERVISOR_PAGE_SCOPES)
+    if not_modified:
+        return not_modified
 
+    page = _query_supervisor_records('incomplete_homeworks')
     # 渲染模板並傳遞數據
-    return render_template('view_all_incomplete_homeworks.html', title='所有欠交功課記錄', incomplete_homeworks=all_incomplete_homeworks)
+    return with_validators(render_template('view_all_incomplete_homeworks.html', title='所有欠交功課記錄', incomplete_homeworks=page['records'], page=page), validators)
 
 
 @main_bp.route('/supervisor/classes')
@@ -2137,26 +2687,19 @@ def view_all_classes():
     if not current_user.is_supervisor():
         flash('您沒有權限訪問此頁面。', 'danger')
         return redirect(url_for('main.index'))
+    not_modified, validators = conditional_request(SUPERVISOR_PAGE_SCOPES)
+    if not_modified:
+        return not_modified
 
-    conn = get_db()
     all_classes = []
-    if conn:
-        cursor = conn.cursor(dictionary=True)
-        try:
-            # 查詢所有班級
-            cursor.execute("SELECT class_id, class_name FROM classes ORDER BY class_name")
-            all_classes = cursor.fetchall()
-
-        except mysql.connector.Error as err:
-            flash(f"資料庫錯誤: {err}", 'danger')
-            current_app.logger.error(f"資料庫錯誤 (主管查看所有班級): {err}")
-        finally:
-            if conn and conn.is_connected():
-                 cursor.close()
-                 conn.close()
+    try:
+        all_classes = get_classes()
+    except mysql.connector.Error as err:
+        flash(f"資料庫錯誤: {err}", 'danger')
+        current_app.logger.error(f"資料庫錯誤 (主管查看所有班級): {err}")
 
     # 渲染模板並傳遞數據
-    return render_template('view_all_classes.html', title='所有班級列表', classes=all_classes)
+    return with_validators(render_template('view_all_classes.html', title='所有班級列表', classes=all_classes), validators)
 
 
 # 錯誤處理路由
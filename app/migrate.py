@@ -0,0 +1,273 @@
+# app/migrate.py
+# 版本化的資料庫遷移 (schema migration)
+#
+# 遷移文件放在 config.MIGRATIONS_FOLDER，檔名格式為 "<版本號>_<說明>.sql"，例如 0002_add_record_indexes.sql，
+# 按版本號順序執行。已套用的版本記錄在 schema_version 表中，每個版本只會執行一次。
+#
+# 注意：MySQL 的 DDL 語句會隱式提交，無法在事務中回滾。一個遷移文件執行到一半失敗時，
+# 前面已執行的語句不會被撤銷，版本也不會被記錄；因此一個遷移文件最好只包含一個 DDL 語句
+# (多個索引可以寫在同一個 ALTER TABLE 中)，或確保語句可以安全地重複執行。
+#
+# 線上 (online) 變更：為大表新增索引或欄位時，在語句中指定演算法與鎖定模式，例如
+#     ALTER TABLE absences ADD INDEX idx_x (student_id), ALGORITHM=INPLACE, LOCK=NONE;
+# 如果 MySQL 無法以指定的方式執行，會直接報錯而不是退回到複製整張表並鎖表，遷移會停止並顯示錯誤。
+import os
+import re
+
+import click
+import mysql.connector
+from flask.cli import AppGroup
+
+import config
+
+
+MIGRATION_FILENAME = re.compile(r'^(\d+)_([\w-]+)\.sql$')
+MIGRATION_LOCK_NAME = 'school_records_migrate' # GET_LOCK 名稱，防止多個進程同時執行遷移
+
+
+class MigrationError(Exception):
+    """遷移文件無效或執行失敗時拋出"""
+    pass
+
+
+def split_sql(script):
+    """
+    將 SQL 腳本分割為單獨的語句。
+    會略過註釋 (--、#、/* */)，並正確處理字串與識別符中的分號。
+    """
+    statements = []
+    current = []
+    i = 0
+    length = len(script)
+    while i < length:
+        ch = script[i]
+        if ch in ("'", '"', '`'):
+            # 複製整個帶引號的字串或識別符 (支援反斜線跳脫與重複引號)
+            j = i + 1
+            while j < length:
+                if script[j] == '\\' and ch != '`':
+                    j += 2
+                    continue
+                if script[j] == ch:
+                    if j + 1 < length and script[j + 1] == ch:
+                        j += 2
+                        continue
+                    break
+                j += 1
+            current.append(script[i:j + 1])
+            i = j + 1
+        elif script.startswith('--', i) or ch == '#':
+            end = script.find('\n', i)
+            i = length if end == -1 else end # 保留換行符
+        elif script.startswith('/*', i):
+            end = script.find('*/', i + 2)
+            i = length if end == -1 else end + 2
+        elif ch == ';':
+            statement = ''.join(current).strip()
+            if statement:
+                statements.append(statement)
+            current = []
+            i += 1
+        else:
+            current.append(ch)
+            i += 1
+    statement = ''.join(current).strip()
+    if statement:
+        statements.append(statement)
+    return statements
+
+
+def discover_migrations(folder=None):
+    """返回按版本號排序的遷移列表 [(版本號, 名稱, 文件路徑), ...]"""
+    folder = folder or config.MIGRATIONS_FOLDER
+    migrations = {}
+    for filename in os.listdir(folder):
+        match = MIGRATION_FILENAME.match(filename)
+        if not match:
+            continue
+        version = int(match.group(1))
+        if version in migrations:
+            raise MigrationError(f"遷移版本 {version} 重複：{migrations[version][1]} 與 {filename}")
+        migrations[version] = (version, filename, os.path.join(folder, filename))
+    return [migrations[version] for version in sorted(migrations)]
+
+
+def latest_version(folder=None):
+    """返回遷移文件中的最新版本號 (沒有遷移文件時為 0)"""
+    migrations = discover_migrations(folder)
+    return migrations[-1][0] if migrations else 0
+
+
+def _connect(database=None):
+    """建立遷移專用的連接 (不經過連接池，DDL 不應佔用請求使用的連接)"""
+    connect_args = dict(host=config.MYSQL_HOST, user=config.MYSQL_USER, password=config.MYSQL_PASSWORD)
+    if database:
+        connect_args['database'] = database
+    return mysql.connector.connect(**connect_args)
+
+
+def _ensure_version_table(cursor):
+    cursor.execute("""
+        CREATE TABLE IF NOT EXISTS schema_version (
+            version INT PRIMARY KEY,
+            name VARCHAR(255) NOT NULL,
+            applied_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
+        )
+    """)
+
+
+def current_version(cursor):
+    """返回資料庫目前的遷移版本；schema_version 表不存在時返回 0"""
+    try:
+        cursor.execute("SELECT MAX(version) FROM schema_version")
+    except mysql.connector.errors.ProgrammingError as err:
+        if err.errno == 1146: # ER_NO_SUCH_TABLE
+            return 0
+        raise
+    row = cursor.fetchone()
+    return (row[0] or 0) if row else 0
+
+
+def upgrade(target=None, echo=print):
+    """
+    執行所有尚未套用的遷移 (或執行到 target 版本為止)。
+    資料庫不存在時會先建立。返回套用的版本號列表。
+    """
+    migrations = discover_migrations()
+
+    conn = _connect()
+    try:
+        cursor = conn.cursor()
+        cursor.execute(f"CREATE DATABASE IF NOT EXISTS `{config.MYSQL_DB}` "
+                       "CHARACTER SET utf8mb4 COLLATE utf8mb4_unicode_ci")
+        conn.database = config.MYSQL_DB
+
+        # 同一時間只允許一個進程執行遷移
+        cursor.execute("SELECT GET_LOCK(%s, %s)", (MIGRATION_LOCK_NAME, config.MIGRATION_LOCK_TIMEOUT))
+        if cursor.fetchone()[0] != 1:
+            raise MigrationError("無法取得遷移鎖，可能有其他進程正在執行遷移")
+        try:
+            # 限制等待 metadata lock 的時間，避免 ALTER TABLE 長時間排隊並阻塞後續的讀寫查詢
+            cursor.execute("SET SESSION lock_wait_timeout = %s", (config.MIGRATION_LOCK_WAIT_TIMEOUT,))
+            _ensure_version_table(cursor)
+            version = current_version(cursor)
+
+            applied = []
+            for migration_version, filename, path in migrations:
+                if migration_version <= version:
+                    continue
+                if target is not None and migration_version > target:
+                    break
+                echo(f"套用遷移 {filename} ...")
+                with open(path, 'r', encoding='utf-8') as f:
+                    statements = split_sql(f.read())
+                for statement in statements:
+                    try:
+                        cursor.execute(statement)
+                        if cursor.with_rows:
+                            cursor.fetchall()
+                    except mysql.connector.Error as err:
+                        conn.rollback()
+                        raise MigrationError(f"遷移 {filename} 執行失敗: {err}\n語句: {statement[:200]}") from err
+                cursor.execute("INSERT INTO schema_version (version, name) VALUES (%s, %s)",
+                               (migration_version, filename))
+                conn.commit()
+                applied.append(migration_version)
+            return applied
+        finally:
+            cursor.execute("SELECT RELEASE_LOCK(%s)", (MIGRATION_LOCK_NAME,))
+            cursor.fetchall()
+    finally:
+        conn.close()
+
+
+def check_schema_version(app):
+    """
+    應用程式啟動時的版本檢查：只執行一個 SELECT MAX(version) 查詢，
+    資料庫版本落後於遷移文件時記錄警告 (不會自動執行遷移)。
+    """
+    try:
+        expected = latest_version()
+        conn = _connect(config.MYSQL_DB)
+    except (OSError, MigrationError, mysql.connector.Error) as err:
+        app.logger.warning(f"無法檢查資料庫遷移版本: {err}")
+        return
+    try:
+        cursor = conn.cursor()
+        version = current_version(cursor)
+        cursor.close()
+    except mysql.connector.Error as err:
+        app.logger.warning(f"無法檢查資料庫遷移版本: {err}")
+        return
+    finally:
+        conn.close()
+    if version < expected:
+        app.logger.warning(f"資料庫版本 {version} 落後於最新遷移版本 {expected}，請執行 'flask db upgrade'")
+
+
+# --- flask db 命令 ---
+db_cli = AppGroup('db', help='資料庫遷移命令')
+
+
+@db_cli.command('upgrade')
+@click.option('--target', type=int, default=None, help='只遷移到指定版本')
+def upgrade_command(target):
+    """套用所有尚未執行的遷移"""
+    try:
+        applied = upgrade(target=target, echo=click.echo)
+    except MigrationError as err:
+        raise click.ClickException(str(err))
+    except mysql.connector.Error as err:
+        raise click.ClickException(f"資料庫錯誤: {err}")
+    if applied:
+        click.echo(f"已套用 {len(applied)} 個遷移，目前版本 {applied[-1]}")
+    else:
+        click.echo("資料庫已是最新版本")
+
+
+@db_cli.command('current')
+def current_command():
+    """顯示資料庫目前的遷移版本與尚未套用的遷移"""
+    try:
+        conn = _connect(config.MYSQL_DB)
+        try:
+            cursor = conn.cursor()
+            version = current_version(cursor)
+            cursor.close()
+        finally:
+            conn.close()
+    except mysql.connector.Error as err:
+        raise click.ClickException(f"資料庫錯誤: {err}")
+    click.echo(f"目前版本: {version}")
+    for migration_version, filename, _ in discover_migrations():
+        if migration_version > version:
+            click.echo(f"  未套用: {filename}")
+
+
+@db_cli.command('explain')
+@click.option('--verbose', '-v', is_flag=True, help='顯示每個查詢的 EXPLAIN 結果')
+def explain_command(verbose):
+    """檢查熱點查詢的執行計劃，出現全表掃描或 filesort 時以非零狀態結束"""
+    from app.query_plans import explain_hot_queries
+    try:
+        conn = _connect(config.MYSQL_DB)
+        try:
+            results = explain_hot_queries(conn)
+        finally:
+            conn.close()
+    except mysql.connector.Error as err:
+        raise click.ClickException(f"資料庫錯誤: {err}")
+
+    failed = 0
+    for name, problems, plan in results:
+        click.echo(f"{'FAIL' if problems else 'ok  '} {name}")
+        for problem in problems:
+            click.echo(f"       {problem}")
+        if verbose:
+            for row in plan:
+                click.echo(f"       table={row.get('table')} type={row.get('type')} key={row.get('key')} "
+                           f"rows={row.get('rows')} extra={row.get('Extra')}")
+        failed += bool(problems)
+    if failed:
+        raise click.ClickException(f"{failed} 個查詢的執行計劃有問題")
+    click.echo(f"全部 {len(results)} 個查詢的執行計劃正常")
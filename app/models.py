@@ -2,7 +2,11 @@
 from flask_login import UserMixin
 from werkzeug.security import generate_password_hash, check_password_hash # 導入 generate_password_hash
 import mysql.connector
+from collections import defaultdict
+from datetime import date, timedelta
 from app.__init__ import get_db # 導入資料庫連接函式
+from app.class_catalog import get_class_name # 進程內的班級目錄
+from app.cache import shared_cache, queue_invalidation # 共用快取與提交後的標籤失效
 from flask import current_app # 導入 current_app 以使用 logger
 
 # Flask-Login 需要一個 user_loader 函數 (通常放在 __init__.py 或其他應用程式初始化的地方)
@@ -27,6 +31,261 @@ from flask import current_app # 導入 current_app 以使用 logger
 #     return None
 
 
+# --- 共用的記錄類型定義 ---
+# 表單選項、CSV 匯出與統計查詢都從這裡讀取，確保各處的類型列表保持一致
+# 獎懲類型 (順序即表單選項與 CSV 欄位的順序)
+AWARD_PUNISH_TYPES = ['表揚', '優點', '小功', '大功', '警告', '缺點', '小過', '大過']
+# 參賽結果 (與 competitions.result 的 ENUM 一致)
+COMPETITION_RESULTS = ['參與', '入圍', '得獎']
+# 缺席類型
+ABSENCE_TYPES = ['事假', '病假', '無故缺席', '其他']
+
+# 獎懲類型對學生點數的影響：獎勵類型計入 award_points，懲罰類型計入 violation_points
+# (表揚不計點數；警告通常不計點數)
+AWARD_POINTS = {'優點': 1, '小功': 3, '大功': 9}
+VIOLATION_POINTS = {'警告': 0, '缺點': 1, '小過': 3, '大過': 9}
+# students 表上由記錄寫入路徑維護的計數欄位
+STUDENT_COUNTER_COLUMNS = ('late_count', 'incomplete_homework_count', 'violation_points', 'award_points')
+
+
+def apply_student_counter_deltas(cursor, student_id, **deltas):
+    """
+    以一個 UPDATE 套用學生計數器 (late_count、incomplete_homework_count、violation_points、award_points)
+    的淨變化，變化為 0 的欄位會被略過。在呼叫者的事務中執行，不會提交。
+    """
+    unknown = set(deltas) - set(STUDENT_COUNTER_COLUMNS)
+    if unknown:
+        raise ValueError(f"未知的計數欄位: {', '.join(sorted(unknown))}")
+    deltas = {column: delta for column, delta in deltas.items() if delta}
+    if not deltas:
+        return
+    assignments = ', '.join(f"{column} = {column} + %s" for column in deltas)
+    cursor.execute(f"UPDATE students SET {assignments} WHERE student_id = %s", (*deltas.values(), student_id))
+
+
+# --- 學生統計摘要 (student_summary 表) ---
+# 每個學生每個學期一行，另有 term = 'all' 的一行為全部學期的合計。
+# 由記錄的新增/修改/刪除路徑以 apply_record_changes() 增量維護，列表與 CSV 匯出直接讀取，不需掃描記錄表。
+SUMMARY_ALL_TERMS = 'all'
+# 學期劃分：9 月開始上學期 (學年以開始的年份表示)，2 月開始下學期
+# 注意：migrations/0007_create_student_summary.sql 的回填語句使用相同的規則
+SCHOOL_YEAR_START_MONTH = 9
+SECOND_TERM_START_MONTH = 2
+
+# 各獎懲類型 / 參賽結果對應的摘要欄位
+AWARD_PUNISH_SUMMARY_COLUMNS = dict(zip(AWARD_PUNISH_TYPES, [
+    'ap_commendation', 'ap_merit', 'ap_minor_merit', 'ap_major_merit',
+    'ap_warning', 'ap_demerit', 'ap_minor_demerit', 'ap_major_demerit',
+]))
+COMPETITION_SUMMARY_COLUMNS = dict(zip(COMPETITION_RESULTS, ['comp_participated', 'comp_finalist', 'comp_awarded']))
+STUDENT_SUMMARY_COLUMNS = (
+    ('absence_sessions',) + STUDENT_COUNTER_COLUMNS
+    + tuple(AWARD_PUNISH_SUMMARY_COLUMNS.values()) + tuple(COMPETITION_SUMMARY_COLUMNS.values())
+)
+
+
+def term_for_date(record_date):
+    """返回日期所屬的學期，例如 2024-10-01 -> '2024-1' (2024-25 學年上學期)，2025-03-01 -> '2024-2'"""
+    if record_date.month >= SCHOOL_YEAR_START_MONTH:
+        return f"{record_date.year}-1"
+    if record_date.month < SECOND_TERM_START_MONTH:
+        return f"{record_date.year - 1}-1"
+    return f"{record_date.year - 1}-2"
+
+
+def term_label(term):
+    """返回學期的顯示名稱，例如 '2024-1' -> '2024-25 上學期'"""
+    if term == SUMMARY_ALL_TERMS:
+        return '全部學期'
+    year, half = term.split('-')
+    return f"{year}-{(int(year) + 1) % 100:02d} {'上' if half == '1' else '下'}學期"
+
+
+def term_date_range(term):
+    """返回學期的日期範圍 (開始日期, 結束日期)，例如 '2024-1' -> (2024-09-01, 2025-01-31)"""
+    year, half = (int(part) for part in term.split('-'))
+    if half == 1:
+        return date(year, SCHOOL_YEAR_START_MONTH, 1), date(year + 1, SECOND_TERM_START_MONTH, 1) - timedelta(days=1)
+    return date(year + 1, SECOND_TERM_START_MONTH, 1), date(year + 1, SCHOOL_YEAR_START_MONTH, 1) - timedelta(days=1)
+
+
+def recent_terms(count=6, today=None):
+    """返回包括目前學期在內最近 count 個學期 (由新到舊)"""
+    term = term_for_date(today or date.today())
+    terms = []
+    for _ in range(count):
+        terms.append(term)
+        year, half = term.split('-')
+        term = f"{year}-1" if half == '2' else f"{int(year) - 1}-2"
+    return terms
+
+
+def summary_select_sql(alias='ss', students_alias=None):
+    """
+    SELECT 清單中讀取所有摘要欄位的片段 (沒有摘要行的學生以 0 表示，配合 LEFT JOIN 使用)。
+    讀取全部學期時傳入 students_alias：STUDENT_COUNTER_COLUMNS 的總數改從 students 表讀取，
+    與學生記錄頁面、管理學生列表和 CSV 匯出使用同一個來源，避免同一學生在不同頁面顯示不同的數字。
+    """
+    return ', '.join(
+        f"{students_alias}.{column} AS {column}" if students_alias and column in STUDENT_COUNTER_COLUMNS
+        else f"COALESCE({alias}.{column}, 0) AS {column}"
+        for column in STUDENT_SUMMARY_COLUMNS
+    )
+
+
+def record_summary_deltas(kind, record_type=None, session_count=0, sign=1):
+    """
+    返回一筆記錄對摘要欄位的貢獻。刪除或撤銷舊值時 sign 為 -1。
+    kind: 'absence'、'award_punish'、'competition'、'late' 或 'incomplete_homework'；
+    record_type 為獎懲類型或參賽結果，session_count 為缺席節數。
+    """
+    if kind == 'absence':
+        return {'absence_sessions': sign * (session_count or 0)}
+    if kind == 'award_punish':
+        deltas = {
+            'award_points': sign * AWARD_POINTS.get(record_type, 0),
+            'violation_points': sign * VIOLATION_POINTS.get(record_type, 0),
+        }
+        if record_type in AWARD_PUNISH_SUMMARY_COLUMNS:
+            deltas[AWARD_PUNISH_SUMMARY_COLUMNS[record_type]] = sign
+        return deltas
+    if kind == 'competition':
+        return {COMPETITION_SUMMARY_COLUMNS[record_type]: sign} if record_type in COMPETITION_SUMMARY_COLUMNS else {}
+    if kind == 'late':
+        return {'late_count': sign}
+    if kind == 'incomplete_homework':
+        return {'incomplete_homework_count': sign}
+    raise ValueError(f"未知的記錄種類: {kind}")
+
+
+def apply_record_changes(cursor, student_id, changes):
+    """
+    套用一次記錄變更對學生統計的影響，在呼叫者的事務中執行，不會提交。
+    changes 為 [(記錄日期, record_summary_deltas(...)), ...]；修改記錄時傳入舊值 (sign=-1) 與新值兩項。
+    - students 上的計數器以一個 UPDATE 套用所有變更的淨值
+    - student_summary 的全部學期行與各學期行以一個 INSERT ... ON DUPLICATE KEY UPDATE 套用
+    - 學生與所屬班級的資料版本以 bump_data_versions() 遞增
+    """
+    counter_totals = defaultdict(int)
+    for record_date, deltas in changes:
+        for column, delta in deltas.items():
+            if column in STUDENT_COUNTER_COLUMNS:
+                counter_totals[column] += delta
+    apply_student_counter_deltas(cursor, student_id, **counter_totals)
+    _apply_summary_changes(cursor, {student_id: changes})
+    bump_data_versions(cursor, student_ids=[student_id])
+
+
+def apply_bulk_record_changes(cursor, changes_by_student):
+    """
+    與 apply_record_changes 相同，但一次處理多個學生 (例如全班批量記錄)：
+    changes_by_student 為 {student_id: [(記錄日期, deltas), ...]}。
+    所有學生的計數器以一個按 student_id 分組的 UPDATE 套用，摘要行以一個多行 INSERT ... ON DUPLICATE KEY UPDATE 套用。
+    """
+    counter_totals = defaultdict(lambda: defaultdict(int))
+    for student_id, changes in changes_by_student.items():
+        for record_date, deltas in changes:
+            for column, delta in deltas.items():
+                if column in STUDENT_COUNTER_COLUMNS:
+                    counter_totals[student_id][column] += delta
+
+    assignments = []
+    params = []
+    for column in STUDENT_COUNTER_COLUMNS:
+        cases = [(student_id, totals[column]) for student_id, totals in counter_totals.items() if totals.get(column)]
+        if cases:
+            assignments.append(f"{column} = {column} + CASE student_id {' '.join(['WHEN %s THEN %s'] * len(cases))} ELSE 0 END")
+            params.extend(value for case in cases for value in case)
+    if assignments:
+        # 按主鍵順序更新，與其他批量寫入以相同順序取得行鎖
+        student_ids = sorted(counter_totals)
+        cursor.execute(
+            f"UPDATE students SET {', '.join(assignments)} WHERE student_id IN ({', '.join(['%s'] * len(student_ids))})",
+            params + student_ids
+        )
+    _apply_summary_changes(cursor, changes_by_student)
+    bump_data_versions(cursor, student_ids=changes_by_student)
+
+
+def _apply_summary_changes(cursor, changes_by_student):
+    """將記錄變更按學生與學期 (及全部學期) 加總，以一個多行 INSERT ... ON DUPLICATE KEY UPDATE 套用到 student_summary"""
+    rows = []
+    for student_id, changes in sorted(changes_by_student.items()):
+        term_totals = defaultdict(lambda: defaultdict(int))
+        for record_date, deltas in changes:
+            for column, delta in deltas.items():
+                for term in (SUMMARY_ALL_TERMS, term_for_date(record_date)):
+                    term_totals[term][column] += delta
+        rows.extend((student_id, term, totals) for term, totals in term_totals.items() if any(totals.values()))
+    if not rows:
+        return
+    columns = ', '.join(STUDENT_SUMMARY_COLUMNS)
+    placeholders = ', '.join(['%s'] * (len(STUDENT_SUMMARY_COLUMNS) + 2))
+    updates = ', '.join(f"{column} = {column} + VALUES({column})" for column in STUDENT_SUMMARY_COLUMNS)
+    params = []
+    for student_id, term, totals in rows:
+        params.extend([student_id, term, *(totals.get(column, 0) for column in STUDENT_SUMMARY_COLUMNS)])
+    cursor.execute(
+        f"INSERT INTO student_summary (student_id, term, {columns}) VALUES "
+        f"{', '.join(f'({placeholders})' for _ in rows)} ON DUPLICATE KEY UPDATE {updates}",
+        params
+    )
+
+
+def bump_data_versions(cursor, student_ids=(), class_ids=(), cascade_classes=False, users=False, class_catalog=False,
+                       user_ids=()):
+    """
+    遞增 data_versions 中的資料版本，在呼叫者的事務中執行，不會提交 (讀取頁面以版本判斷是否返回 304，見 app/http_cache.py)。
+    - student_ids 中的學生及其所屬班級 (班級學生列表顯示學生的計數)；學生已被刪除時請改為傳入 class_ids
+    - class_ids 中的班級；cascade_classes 為 True 時一併遞增這些班級的所有學生 (例如班級改名，學生記錄頁面顯示班級名稱)
+    - users 為 True 或傳入 user_ids 時遞增使用者資料版本 ('users', 0) (記錄時間線顯示記錄人姓名)
+    - class_catalog 為 True 時遞增班級目錄版本 ('classes', 0) (新增 / 修改 / 刪除班級，見 app/class_catalog.py)
+    遞增的每個版本同時記錄為共用快取的標籤 ('student:<id>'、'class:<id>'、'users'、'classes'，user_ids 為 'user:<id>')，
+    在事務提交後失效 (見 app/cache.py)。
+    沒有每個事務都遞增的全校版本行 (會讓所有寫入在這一行的鎖上排隊)；全校範圍的頁面使用所有班級版本的合計
+    (記錄的每次寫入都會遞增學生所屬的班級)。
+    """
+    student_ids = sorted(set(student_ids))
+    class_ids = sorted(set(class_ids))
+    user_ids = sorted(set(user_ids))
+    selects = []
+    params = []
+    if users or user_ids:
+        selects.append("SELECT 'users' AS scope, 0 AS scope_id")
+    if class_catalog:
+        selects.append("SELECT 'classes' AS scope, 0 AS scope_id")
+    for student_id in student_ids:
+        selects.append("SELECT 'student' AS scope, %s AS scope_id")
+        params.append(student_id)
+    for class_id in class_ids:
+        selects.append("SELECT 'class' AS scope, %s AS scope_id")
+        params.append(class_id)
+    if student_ids:
+        selects.append(f"SELECT 'class' AS scope, class_id AS scope_id FROM students WHERE student_id IN ({', '.join(['%s'] * len(student_ids))})")
+        params.extend(student_ids)
+    if cascade_classes and class_ids:
+        selects.append(f"SELECT 'student' AS scope, student_id AS scope_id FROM students WHERE class_id IN ({', '.join(['%s'] * len(class_ids))})")
+        params.extend(class_ids)
+    if not selects:
+        return
+    # 先取得受影響的版本 (包括學生所屬的班級)，再按主鍵順序插入，與其他寫入事務以相同順序取得行鎖
+    cursor.execute(f"SELECT DISTINCT scope, scope_id FROM ({' UNION ALL '.join(selects)}) AS changed ORDER BY scope, scope_id", params)
+    scopes = [tuple(row.values()) if isinstance(row, dict) else tuple(row) for row in cursor.fetchall()]
+    if not scopes:
+        return
+    cursor.execute(
+        f"INSERT INTO data_versions (scope, scope_id) VALUES {', '.join(['(%s, %s)'] * len(scopes))}"
+        f" ON DUPLICATE KEY UPDATE version = version + 1",
+        [value for scope in scopes for value in scope]
+    )
+    queue_invalidation([f"{scope}:{scope_id}" if scope in ('student', 'class') else scope for scope, scope_id in scopes]
+                       + [f"user:{user_id}" for user_id in user_ids])
+
+
+# 教師負責的班級 ID (User.assigned_classes 使用；flask db explain 也檢查這個查詢)
+TEACHER_CLASSES_SQL = "SELECT class_id FROM teacher_classes WHERE user_id = %s"
+
+
 # User 類別繼承自 Flask-Login 的 UserMixin，提供了使用者物件所需的基本屬性和方法
 class User(UserMixin):
     """
@@ -47,9 +306,9 @@ class User(UserMixin):
         self.teacher_name = user_data.get('teacher_name') # 使用 get 以處理可能為 None 的情況
         self.id_card_number = user_data.get('id_card_number') # 使用 get 以處理可能為 None 的情況
 
-        # 如果需要，可以在這裡加載或初始化與使用者相關的其他數據
-        # 例如：教師負責的班級
-        # self.assigned_classes = self._load_assigned_classes()
+        # 教師負責的班級在第一次訪問 assigned_classes 時才從資料庫加載，並快取在物件上
+        self._assigned_classes = None
+        self._assigned_class_ids = None
 
 
     def __repr__(self):
@@ -83,31 +342,58 @@ class User(UserMixin):
         """
         如果使用者是教師，返回其負責的班級列表；否則返回空列表。
         返回的列表中的每個元素是包含 class_id 和 class_name 的字典。
-        這個屬性會在每次訪問時執行資料庫查詢，如果需要頻繁訪問，可以考慮在加載用戶時緩存。
+        結果快取在物件上：user_loader 每個請求建立一個新的 User 物件，因此每個請求最多查詢一次。
+        """
+        if not self.is_teacher():
+            return [] # 如果不是教師，返回空列表
+        if self._assigned_classes is None:
+            classes = self._load_assigned_classes()
+            if classes is None:
+                return [] # 查詢失敗時不快取，下次訪問再重試
+            self._assigned_classes = classes
+        return self._assigned_classes
+
+    @property
+    def assigned_class_ids(self):
+        """教師負責的班級 ID 集合 (frozenset)，用於 O(1) 的權限檢查"""
+        if self._assigned_class_ids is None:
+            classes = self.assigned_classes
+            if self._assigned_classes is None:
+                return frozenset() # 非教師或查詢失敗，不快取
+            self._assigned_class_ids = frozenset(c['class_id'] for c in classes)
+        return self._assigned_class_ids
+
+    def clear_assigned_classes(self):
+        """清除班級快取 (班級分配變更後呼叫)"""
+        self._assigned_classes = None
+        self._assigned_class_ids = None
+
+    def _load_assigned_classes(self):
+        """
+        查詢教師負責的班級，發生錯誤時返回 None。
+        班級 ID 保存在共用快取中 (標籤 user:<id>，修改班級分配時失效)，班級名稱來自班級目錄 (已刪除的班級不在目錄中)。
         """
-        if self.is_teacher():
-            conn = get_db()
+        conn = get_db()
+        if not conn:
+            return None
+        cursor = conn.cursor()
+        try:
+            def load():
+                cursor.execute(TEACHER_CLASSES_SQL, (self.id,)) # 使用 self.id (user_id)
+                return [class_id for (class_id,) in cursor.fetchall()]
+            class_ids = shared_cache.get_or_set(f"teacher_classes:{self.id}", load, tags=[f"user:{self.id}"])
             classes = []
-            if conn:
-                cursor = conn.cursor(dictionary=True)
-                try:
-                    cursor.execute("""
-                        SELECT c.class_id, c.class_name
-                        FROM classes c
-                        JOIN teacher_classes tc ON c.class_id = tc.class_id
-                        WHERE tc.user_id = %s
-                        ORDER BY c.class_name
-                    """, (self.id,)) # 使用 self.id (user_id)
-                    classes = cursor.fetchall()
-                except mysql.connector.Error as err:
-                    current_app.logger.error(f"資料庫錯誤 (獲取教師負責班級): {err}")
-                    # 這裡不閃現錯誤，因為這是在模型方法中
-                finally:
-                     if conn and conn.is_connected():
-                          cursor.close()
-                          conn.close()
-            return classes
-        return [] # 如果不是教師，返回空列表
+            for class_id in class_ids:
+                class_name = get_class_name(class_id)
+                if class_name is not None:
+                    classes.append({'class_id': class_id, 'class_name': class_name})
+            return sorted(classes, key=lambda c: c['class_name'])
+        except mysql.connector.Error as err:
+            current_app.logger.error(f"資料庫錯誤 (獲取教師負責班級): {err}")
+            # 這裡不閃現錯誤，因為這是在模型方法中
+            return None
+        finally:
+            cursor.close()
 
 
 # --- 其他資料表對應的模型類別骨架 ---
@@ -150,26 +436,14 @@ class Student:
         self.award_points = data.get('award_points', 0) # 設置預設值為 0
         # 您可以根據需要在這裡添加更多屬性或方法
 
-    # 獲取學生所屬班級的名稱 (如果需要頻繁在模板中顯示，可以考慮在查詢時 JOIN)
-    # 這裡提供一個通過查詢獲取班級名稱的方法作為示例
+    # 獲取學生所屬班級的名稱 (從進程內的班級目錄讀取，不查詢資料庫)
     @property
     def class_name(self):
-         conn = get_db()
-         class_name = None
-         if conn:
-              cursor = conn.cursor()
-              try:
-                   cursor.execute("SELECT class_name FROM classes WHERE class_id = %s", (self.class_id,))
-                   result = cursor.fetchone()
-                   if result:
-                        class_name = result[0]
-              except mysql.connector.Error as err:
-                   current_app.logger.error(f"資料庫錯誤 (獲取班級名稱 for Student {self.student_id}): {err}")
-              finally:
-                   if conn and conn.is_connected():
-                        cursor.close()
-                        conn.close()
-         return class_name
+         try:
+              return get_class_name(self.class_id)
+         except mysql.connector.Error as err:
+              current_app.logger.error(f"資料庫錯誤 (獲取班級名稱 for Student {self.student_id}): {err}")
+              return None
 
 
 class Absence:
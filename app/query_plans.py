@@ -0,0 +1,147 @@
+# app/query_plans.py
+# 查詢的執行計劃檢查 (flask db explain)
+#
+# 對路由、匯出、匯入、刷卡登記與記錄批量匯入執行的查詢執行 EXPLAIN，如果應該使用索引的表出現全表掃描 (type = ALL)
+# 或出現未預期的 filesort，就表示缺少索引或查詢寫法讓索引失效。新增或修改查詢時，請把它加到 hot_queries() 中。
+# 本來就要讀取整張表的查詢 (例如匯出、匯入前的預先載入) 不檢查全表掃描，但仍會執行 EXPLAIN，查詢寫錯時會報告失敗。
+# 注意：請在有代表性數據量的資料庫上執行；表格幾乎是空的時候，MySQL 可能認為全表掃描更便宜。
+from collections import namedtuple
+from datetime import date, datetime
+
+import mysql.connector
+
+
+# name：顯示名稱；checked_tables：不允許全表掃描的表格 (別名)；allow_filesort：結果集本來就需要排序 (例如整張表匯出)；
+# derived_row_limit：衍生表與 UNION 結果的行數上限 (各分支 LIMIT 的合計)，行數估計在上限內的衍生表允許 filesort
+HotQuery = namedtuple('HotQuery', 'name checked_tables sql params allow_filesort derived_row_limit',
+                      defaults=(False, None))
+
+
+def hot_queries(student_id, class_id=1, user_id=1):
+    """
+    返回需要檢查的查詢列表 [HotQuery, ...]。
+    查詢語句直接取自路由與模組使用的定義 (查詢建構函式或 SQL 常數)，確保檢查的是實際執行的查詢。
+    """
+    from app.main import (
+        SUPERVISOR_RECORD_VIEWS, STUDENT_TIMELINE_SOURCES, build_supervisor_records_query, build_student_timeline_query,
+        build_class_roster_query
+    )
+    from app.admin import USERS_EXPORT_SQL, build_manage_students_queries, build_students_export_query
+    from app.csv_import import (
+        STUDENT_PREFETCH_SQL, STUDENT_ID_LOOKUP_SQL, USER_PREFETCH_SQL, TEACHER_CLASSES_PREFETCH_SQL,
+        USER_ID_LOOKUP_SQL, TEACHER_CLASSES_LOOKUP_SQL
+    )
+    from app.kiosk import CARD_INDEX_SQL, LATE_TODAY_SQL
+    from app.record_ingest import RECORD_KINDS, STUDENT_LOOKUP_SQL, build_dedupe_query
+    from app.models import TEACHER_CLASSES_SQL, SUMMARY_ALL_TERMS
+
+    queries = []
+    today = date.today()
+    after = (today, datetime.now().replace(microsecond=0), 2 ** 31 - 1)
+
+    # 學生記錄頁面的時間線：五類記錄的 UNION ALL，第一頁與之後的鍵集分頁
+    kinds = list(STUDENT_TIMELINE_SOURCES)
+    tables = {spec['table'] for spec in STUDENT_TIMELINE_SOURCES.values()}
+    timeline_after = (after[0], after[1], kinds[0], after[2])
+    for label, cursor_key in (('first_page', None), ('next_page', timeline_after)):
+        sql, params = build_student_timeline_query(student_id, kinds, None, None, cursor_key, 51)
+        queries.append(HotQuery(f"student_timeline:{label}", tables, sql, params, derived_row_limit=len(kinds) * 51))
+
+    # 主管查看所有記錄頁面：第一頁與之後的鍵集分頁 (不帶篩選條件)
+    for view_name, spec in SUPERVISOR_RECORD_VIEWS.items():
+        for label, cursor_key in (('first_page', None), ('next_page', after)):
+            sql, params = build_supervisor_records_query(view_name, {}, cursor_key, 101)
+            queries.append(HotQuery(f"view_all_{view_name}:{label}", {spec['alias']}, sql, params))
+
+    # 班級學生名單 (student_list 與 students_json)：一個班級的學生，排序只涉及該班級的行
+    sql, params = build_class_roster_query(class_id, SUMMARY_ALL_TERMS)
+    queries.append(HotQuery("class_roster", {'s'}, sql, params, allow_filesort=True))
+
+    # 管理學生列表：按班級篩選時使用班級索引；不篩選時按所選欄位排序整張學生表 (分頁)
+    for label, filter_class_id in (('class_filter', class_id), ('all_classes', None)):
+        count_query, page_query = build_manage_students_queries(filter_class_id, 'class', 'asc', 50, 0)
+        checked = {'s'} if filter_class_id else set()
+        queries.append(HotQuery(f"manage_students:{label}:count", checked, *count_query))
+        queries.append(HotQuery(f"manage_students:{label}:page", checked, *page_query, allow_filesort=True))
+
+    # CSV 匯出：讀取整張表並排序
+    queries.append(HotQuery("export_users_csv", set(), USERS_EXPORT_SQL, (), allow_filesort=True))
+    queries.append(HotQuery("export_students_csv", set(), *build_students_export_query(), allow_filesort=True))
+
+    # 學生 / 使用者 CSV 匯入：預先載入 (整張表) 與按鍵查詢
+    queries.append(HotQuery("import_students:prefetch", set(), STUDENT_PREFETCH_SQL, ()))
+    queries.append(HotQuery("import_students:new_ids", {'students'},
+                            STUDENT_ID_LOOKUP_SQL.format(values='(%s, %s)'), ('1', class_id)))
+    queries.append(HotQuery("import_users:prefetch", set(), USER_PREFETCH_SQL, ()))
+    queries.append(HotQuery("import_users:prefetch_teacher_classes", set(), TEACHER_CLASSES_PREFETCH_SQL, ()))
+    queries.append(HotQuery("import_users:new_ids", {'users'}, USER_ID_LOOKUP_SQL.format(values='%s'), ('admin',)))
+    queries.append(HotQuery("import_users:teacher_classes", {'teacher_classes'},
+                            TEACHER_CLASSES_LOOKUP_SQL.format(values='%s'), (user_id,)))
+
+    # 刷卡登記的卡號索引：有卡號的所有學生 (整張表)，今天的遲到記錄 (日期索引)
+    queries.append(HotQuery("kiosk:card_index", set(), CARD_INDEX_SQL, ()))
+    queries.append(HotQuery("kiosk:late_today", {'late_records'}, LATE_TODAY_SQL, (today,)))
+
+    # 記錄批量匯入：學生對照表 (整張表) 與每種記錄的去重查詢
+    queries.append(HotQuery("ingest:student_lookup", set(), STUDENT_LOOKUP_SQL, ()))
+    for kind, spec in RECORD_KINDS.items():
+        sql, params = build_dedupe_query(spec, [student_id], today, today)
+        queries.append(HotQuery(f"ingest:{kind}:dedupe", {spec['table']}, sql, params))
+
+    # 教師負責的班級 (權限檢查)
+    queries.append(HotQuery("teacher_classes", {'teacher_classes'}, TEACHER_CLASSES_SQL, (user_id,)))
+    return queries
+
+
+def check_plan(plan_rows, checked_tables, allow_filesort=False, derived_row_limit=None):
+    """
+    檢查 EXPLAIN 的結果，返回問題描述列表 (沒有問題時為空列表)。
+    衍生表 (<derived2>) 的 filesort 只在行數估計不超過 derived_row_limit 時允許；UNION 結果 (<union2,3>) 沒有行數估計，
+    只在指定了 derived_row_limit (各分支都有 LIMIT) 時允許。外層 ORDER BY 讀取的衍生表行數超過上限時仍會報告。
+    """
+    problems = []
+    for row in plan_rows:
+        table = row.get('table') or ''
+        if table in checked_tables and row.get('type') == 'ALL':
+            problems.append(f"{table}: 全表掃描 (type=ALL)")
+        # filesort 會顯示在聯結的第一個表上 (例如從 classes 開始聯結時)，因此檢查所有行
+        if allow_filesort or 'Using filesort' not in (row.get('Extra') or ''):
+            continue
+        if derived_row_limit is not None:
+            rows = row.get('rows')
+            if table.startswith('<union') and rows is None:
+                continue
+            if table.startswith(('<derived', '<union')) and rows is not None and rows <= derived_row_limit:
+                continue
+        problems.append(f"{table}: 使用 filesort" + (f" (估計 {row.get('rows')} 行)" if table.startswith('<') else ""))
+    return problems
+
+
+def explain_hot_queries(conn):
+    """
+    對所有熱點查詢執行 EXPLAIN。
+    返回 [(名稱, 問題列表, EXPLAIN 結果), ...]。
+    """
+    cursor = conn.cursor(dictionary=True)
+    try:
+        samples = []
+        for sql in ("SELECT student_id FROM students ORDER BY student_id LIMIT 1",
+                    "SELECT class_id FROM classes ORDER BY class_id LIMIT 1",
+                    "SELECT user_id FROM users ORDER BY user_id LIMIT 1"):
+            cursor.execute(sql)
+            row = cursor.fetchone()
+            samples.append(next(iter(row.values())) if row else 1)
+
+        results = []
+        for query in hot_queries(*samples):
+            try:
+                cursor.execute(f"EXPLAIN {query.sql}", query.params)
+                plan = cursor.fetchall()
+            except mysql.connector.Error as err:
+                results.append((query.name, [f"EXPLAIN 失敗: {err}"], []))
+                continue
+            results.append((query.name, check_plan(plan, query.checked_tables, query.allow_filesort,
+                                                   query.derived_row_limit), plan))
+        return results
+    finally:
+        cursor.close()
@@ -0,0 +1,225 @@
+# app/reconcile.py
+# 學生計數器的核對與修正 (flask counters reconcile)
+#
+# students 表上的 late_count、incomplete_homework_count、violation_points、award_points 是由記錄寫入路徑
+# 增量維護的反正規化計數器；直接在 MySQL 控制台修改或刪除記錄時，計數器會與記錄表不一致。
+# 這裡以幾個分組查詢重新計算計數器並找出差異，再分批修正：
+# - 偵測：非鎖定的一致性讀取，不會阻塞同時進行的寫入
+# - 修正：每批學生一個短事務，先以 SELECT ... FOR UPDATE 鎖定該批學生行，重新計算後以一個 UPDATE 寫入。
+#   記錄寫入路徑在同一事務中更新 students，因此會與修正排隊，不會互相覆蓋
+# student_summary (全部學期行與各學期行) 也保存同樣的計數，同樣會不一致：一併核對，
+# 修正時在同一事務中鎖定並重建該批學生的摘要行 (寫入路徑更新摘要行時同樣會與修正排隊)
+from datetime import date
+
+import click
+import mysql.connector
+from flask.cli import AppGroup
+
+import config
+from app.db import acquire_connection, release_connection
+from app.models import (
+    STUDENT_COUNTER_COLUMNS, STUDENT_SUMMARY_COLUMNS, SUMMARY_ALL_TERMS, record_summary_deltas, term_for_date,
+    bump_data_versions
+)
+
+
+def _student_filter(student_ids):
+    """返回 (WHERE 子句, 參數)；student_ids 為 None 時不篩選"""
+    if student_ids is None:
+        return "", []
+    return f"WHERE student_id IN ({', '.join(['%s'] * len(student_ids))})", list(student_ids)
+
+
+# 重新計算摘要的分組查詢：(學生, 年, 月) 決定學期，其餘欄位傳給 record_summary_deltas()
+# 與寫入路徑使用相同的規則 (學期劃分、點數與類型對應)，不需要在 SQL 中重複
+SUMMARY_SOURCE_QUERIES = (
+    ('absence', "SELECT student_id, YEAR(absence_date), MONTH(absence_date), NULL, SUM(session_count), COUNT(*)"
+                " FROM absences {where} GROUP BY student_id, YEAR(absence_date), MONTH(absence_date)"),
+    ('award_punish', "SELECT student_id, YEAR(record_date), MONTH(record_date), type, 0, COUNT(*)"
+                     " FROM awards_punishments {where} GROUP BY student_id, YEAR(record_date), MONTH(record_date), type"),
+    ('competition', "SELECT student_id, YEAR(comp_date), MONTH(comp_date), result, 0, COUNT(*)"
+                    " FROM competitions {where} GROUP BY student_id, YEAR(comp_date), MONTH(comp_date), result"),
+    ('late', "SELECT student_id, YEAR(late_date), MONTH(late_date), NULL, 0, COUNT(*)"
+             " FROM late_records {where} GROUP BY student_id, YEAR(late_date), MONTH(late_date)"),
+    ('incomplete_homework', "SELECT student_id, YEAR(record_date), MONTH(record_date), NULL, 0, COUNT(*)"
+                            " FROM incomplete_homework_records {where} GROUP BY student_id, YEAR(record_date), MONTH(record_date)"),
+)
+
+
+def compute_expected_summary(cursor, student_ids=None):
+    """
+    從記錄表重新計算統計摘要，返回 {(student_id, 學期): {欄位: 值}}，包括全部學期行 (學期為 SUMMARY_ALL_TERMS)；
+    沒有任何記錄的學生不在結果中。每個記錄表一個分組查詢，student_ids 為 None 時計算所有學生。
+    """
+    where_sql, where_params = _student_filter(student_ids)
+    expected = {}
+    for kind, sql in SUMMARY_SOURCE_QUERIES:
+        cursor.execute(sql.format(where=where_sql), where_params)
+        for student_id, year, month, record_type, session_count, count in cursor.fetchall():
+            deltas = record_summary_deltas(kind, record_type=record_type, session_count=int(session_count or 0))
+            if kind != 'absence':
+                deltas = {column: delta * count for column, delta in deltas.items()}
+            for term in (SUMMARY_ALL_TERMS, term_for_date(date(year, month, 1))):
+                totals = expected.setdefault((student_id, term), dict.fromkeys(STUDENT_SUMMARY_COLUMNS, 0))
+                for column, delta in deltas.items():
+                    totals[column] += delta
+    return expected
+
+
+def _summary_diffs(current, expected):
+    """比較一個學生的摘要行，返回 {'student_summary[學期].欄位': (目前值, 正確值)} (沒有的行視為全部為 0)"""
+    diffs = {}
+    for term in sorted(set(current) | set(expected)):
+        current_totals = current.get(term, {})
+        expected_totals = expected.get(term, {})
+        for column in STUDENT_SUMMARY_COLUMNS:
+            value, correct = int(current_totals.get(column) or 0), expected_totals.get(column, 0)
+            if value != correct:
+                diffs[f"student_summary[{term}].{column}"] = (value, correct)
+    return diffs
+
+
+def find_drift(cursor, student_ids=None, lock=False):
+    """
+    比較 students 上的計數器與 student_summary 的摘要行和重新計算的值，返回不一致的學生列表
+    [(student_id, student_number, name, {欄位: (目前值, 正確值)}), ...]；摘要行的欄位名稱為 'student_summary[學期].欄位'。
+    lock 為 True 時以 FOR UPDATE 鎖定學生行與摘要行 (必須在事務中呼叫)。
+    """
+    where_sql, where_params = _student_filter(student_ids)
+    cursor.execute(f"""
+        SELECT student_id, student_number, name, {', '.join(STUDENT_COUNTER_COLUMNS)}
+        FROM students {where_sql}
+        ORDER BY student_id
+        {'FOR UPDATE' if lock else ''}
+    """, where_params)
+    students = cursor.fetchall()
+    cursor.execute(f"""
+        SELECT student_id, term, {', '.join(STUDENT_SUMMARY_COLUMNS)}
+        FROM student_summary {where_sql}
+        ORDER BY student_id, term
+        {'FOR UPDATE' if lock else ''}
+    """, where_params)
+    current_summary = {}
+    for student_id, term, *values in cursor.fetchall():
+        current_summary.setdefault(student_id, {})[term] = dict(zip(STUDENT_SUMMARY_COLUMNS, values))
+    # 先讀取 (並鎖定) 學生行與摘要行再計算，修正時計算結果反映的是取得鎖之後的記錄
+    expected_summary = {}
+    for (student_id, term), totals in compute_expected_summary(cursor, student_ids).items():
+        expected_summary.setdefault(student_id, {})[term] = totals
+
+    drift = []
+    for student_id, student_number, name, *current in students:
+        expected = expected_summary.get(student_id, {})
+        correct = expected.get(SUMMARY_ALL_TERMS, {})
+        diffs = {}
+        for column, value in zip(STUDENT_COUNTER_COLUMNS, current):
+            if (value or 0) != correct.get(column, 0):
+                diffs[column] = (value, correct.get(column, 0))
+        diffs.update(_summary_diffs(current_summary.get(student_id, {}), expected))
+        if diffs:
+            drift.append((student_id, student_number, name, diffs))
+    return drift
+
+
+def _update_counters(cursor, drift):
+    """以一個 UPDATE 寫入一批學生的正確計數器值，重建摘要不一致的學生的摘要行，並遞增這些學生的資料版本"""
+    assignments = []
+    params = []
+    for column in STUDENT_COUNTER_COLUMNS:
+        cases = []
+        for student_id, _, _, diffs in drift:
+            if column in diffs:
+                cases.append("WHEN %s THEN %s")
+                params.extend([student_id, diffs[column][1]])
+        if cases:
+            assignments.append(f"{column} = CASE student_id {' '.join(cases)} ELSE {column} END")
+    student_ids = [student_id for student_id, _, _, _ in drift]
+    if assignments:
+        cursor.execute(
+            f"UPDATE students SET {', '.join(assignments)} WHERE student_id IN ({', '.join(['%s'] * len(student_ids))})",
+            params + student_ids
+        )
+    summary_ids = [student_id for student_id, _, _, diffs in drift
+                   if any(column.startswith('student_summary[') for column in diffs)]
+    if summary_ids:
+        _rebuild_summary(cursor, summary_ids)
+    bump_data_versions(cursor, student_ids=student_ids)
+
+
+def _rebuild_summary(cursor, student_ids):
+    """刪除並從記錄表重新插入學生的摘要行 (全部學期行與各學期行)，在呼叫者的事務中執行"""
+    where_sql, where_params = _student_filter(student_ids)
+    rows = [(student_id, term, totals) for (student_id, term), totals in sorted(compute_expected_summary(cursor, student_ids).items())
+            if any(totals.values())]
+    cursor.execute(f"DELETE FROM student_summary {where_sql}", where_params)
+    if not rows:
+        return
+    placeholders = ', '.join(['%s'] * (len(STUDENT_SUMMARY_COLUMNS) + 2))
+    cursor.execute(
+        f"INSERT INTO student_summary (student_id, term, {', '.join(STUDENT_SUMMARY_COLUMNS)}) VALUES "
+        f"{', '.join(f'({placeholders})' for _ in rows)}",
+        [value for student_id, term, totals in rows
+         for value in (student_id, term, *(totals[column] for column in STUDENT_SUMMARY_COLUMNS))]
+    )
+
+
+def reconcile_counters(conn, fix=False, chunk_size=None):
+    """
+    核對所有學生的計數器。返回 (偵測到的不一致列表, 已修正的學生數)。
+    fix 為 True 時按 chunk_size 分批修正，每批一個事務。
+    """
+    chunk_size = chunk_size or config.COUNTER_RECONCILE_CHUNK_SIZE
+    cursor = conn.cursor()
+    try:
+        drift = find_drift(cursor)
+        conn.commit() # 結束偵測使用的讀取快照
+        fixed = 0
+        if fix:
+            drifted_ids = [student_id for student_id, _, _, _ in drift]
+            for start in range(0, len(drifted_ids), chunk_size):
+                chunk = drifted_ids[start:start + chunk_size]
+                try:
+                    conn.start_transaction()
+                    # 鎖定後重新核對：偵測之後已被寫入路徑修正或改變的學生以最新的值為準
+                    chunk_drift = find_drift(cursor, chunk, lock=True)
+                    if chunk_drift:
+                        _update_counters(cursor, chunk_drift)
+                    conn.commit()
+                    fixed += len(chunk_drift)
+                except mysql.connector.Error:
+                    conn.rollback()
+                    raise
+        return drift, fixed
+    finally:
+        cursor.close()
+
+
+# --- flask counters 命令 ---
+counters_cli = AppGroup('counters', help='學生計數器維護命令')
+
+
+@counters_cli.command('reconcile')
+@click.option('--fix', is_flag=True, help='修正不一致的計數器 (預設只報告)')
+@click.option('--chunk-size', type=int, default=None, help='每批修正的學生數')
+def reconcile_command(fix, chunk_size):
+    """從記錄表重新計算 students 上的計數器與 student_summary 的摘要行，報告並 (可選) 修正不一致"""
+    try:
+        conn = acquire_connection()
+    except mysql.connector.Error as err:
+        raise click.ClickException(f"資料庫錯誤: {err}")
+    try:
+        drift, fixed = reconcile_counters(conn, fix=fix, chunk_size=chunk_size)
+    except mysql.connector.Error as err:
+        raise click.ClickException(f"資料庫錯誤: {err}")
+    finally:
+        release_connection(conn)
+
+    for student_id, student_number, name, diffs in drift:
+        details = ", ".join(f"{column} {current} -> {correct}" for column, (current, correct) in diffs.items())
+        click.echo(f"學生 {student_id} ({student_number or '-'} {name}): {details}")
+    if not drift:
+        click.echo("所有學生的計數器都正確")
+    elif fix:
+        click.echo(f"{len(drift)} 個學生的計數器不一致，已修正 {fixed} 個")
+    else:
+        click.echo(f"{len(drift)} 個學生的計數器不一致 (使用 --fix 修正)")
@@ -0,0 +1,332 @@
+# app/record_ingest.py
+# 記錄批量匯入 (CSV / JSON Lines)：POST /api/records/<種類>/ingest 與 flask records ingest
+#
+# 門禁讀卡機與試算表中已有的缺席、遲到等數據可以一次匯入，不需要逐筆使用網頁表單：
+# - 學生以學號、ID 卡號碼或學生證號碼識別，全部學生以一次查詢預先載入為記憶體中的對照表
+# - 與資料庫中已有的記錄以 (學生, 日期, 類型) 去重 (每批學生一個查詢)，同一文件中重複的行也只匯入一次
+# - 以多行 INSERT 分批插入，每個學生的計數器與統計摘要變化加總後以 apply_bulk_record_changes() 套用一次，整個匯入一個事務
+#
+# 每行的欄位 (CSV 表頭或 JSON 物件的鍵)：
+#   student_number / id_card_number / student_id_number (至少一個)、date (YYYY-MM-DD)，以及各種類的欄位 (見 RECORD_KINDS)
+import csv
+import io
+import json
+from datetime import datetime
+
+import click
+import mysql.connector
+from flask.cli import AppGroup
+
+import config
+from app.db import acquire_connection, release_connection
+from app.kiosk import invalidate_card_index
+from app.models import (
+    ABSENCE_TYPES, AWARD_PUNISH_TYPES, COMPETITION_RESULTS,
+    record_summary_deltas, apply_bulk_record_changes
+)
+
+
+class RecordIngestError(Exception):
+    """匯入的內容無法處理 (例如未知的記錄種類或格式) 時拋出"""
+    pass
+
+
+# --- 欄位解析 ---
+def _clean(value):
+    """CSV 的值為字串，JSON 的值可能是數字或 null；統一轉為去除空白的字串"""
+    return '' if value is None else str(value).strip()
+
+
+def _text(max_length=None, required=False):
+    def parse(value):
+        value = _clean(value)
+        if not value:
+            if required:
+                raise ValueError("不能為空")
+            return None
+        if max_length and len(value) > max_length:
+            raise ValueError(f"長度不能超過 {max_length} 個字元")
+        return value
+    return parse
+
+
+def _choice(choices):
+    def parse(value):
+        value = _clean(value)
+        if value not in choices:
+            raise ValueError(f"必須是 {', '.join(choices)} 之一")
+        return value
+    return parse
+
+
+def _positive_int(value):
+    try:
+        number = int(value)
+    except (TypeError, ValueError):
+        raise ValueError("必須是整數")
+    if number < 1:
+        raise ValueError("必須大於 0")
+    return number
+
+
+def _parse_date(value):
+    value = _clean(value)
+    for fmt in ('%Y-%m-%d', '%Y/%m/%d'):
+        try:
+            return datetime.strptime(value, fmt).date()
+        except ValueError:
+            pass
+    raise ValueError("日期格式必須是 YYYY-MM-DD")
+
+
+# 各記錄種類：表格、日期欄位、去重使用的類型欄位 (None 表示只按學生與日期去重)、欄位解析與統計變化
+RECORD_KINDS = {
+    'absences': {
+        'table': 'absences', 'date': 'absence_date', 'dedupe': 'type',
+        'fields': {'session_count': _positive_int, 'type': _choice(ABSENCE_TYPES), 'reason': _text(500)},
+        'deltas': lambda values: record_summary_deltas('absence', session_count=values['session_count']),
+    },
+    'late_records': {
+        'table': 'late_records', 'date': 'late_date', 'dedupe': None,
+        'fields': {'reason': _text(500)},
+        'deltas': lambda values: record_summary_deltas('late'),
+    },
+    'incomplete_homework_records': {
+        'table': 'incomplete_homework_records', 'date': 'record_date', 'dedupe': 'subject',
+        'fields': {'subject': _text(100), 'description': _text(500)},
+        'deltas': lambda values: record_summary_deltas('incomplete_homework'),
+    },
+    'awards_punishments': {
+        'table': 'awards_punishments', 'date': 'record_date', 'dedupe': 'type',
+        'fields': {'type': _choice(AWARD_PUNISH_TYPES), 'description': _text(1000, required=True)},
+        'deltas': lambda values: record_summary_deltas('award_punish', values['type']),
+    },
+    'competitions': {
+        'table': 'competitions', 'date': 'comp_date', 'dedupe': 'comp_name',
+        'fields': {'comp_name': _text(255, required=True), 'result': _choice(COMPETITION_RESULTS), 'description': _text(1000)},
+        'deltas': lambda values: record_summary_deltas('competition', values['result']),
+    },
+}
+STUDENT_KEY_FIELDS = ('id_card_number', 'student_id_number', 'student_number') # 按此順序識別學生
+
+
+# --- 讀取輸入 ---
+def read_rows(stream, fmt):
+    """
+    逐行讀取二進位串流，產生 (行號, {欄位: 值})。fmt 為 'csv' (第一行為表頭) 或 'jsonl' (每行一個 JSON 物件)。
+    無法解析的 JSON 行產生 (行號, ValueError)。
+    """
+    text = io.TextIOWrapper(stream, encoding='utf-8-sig', newline='' if fmt == 'csv' else None)
+    if fmt == 'csv':
+        reader = csv.DictReader(text)
+        for row in reader:
+            yield reader.line_num, row
+    elif fmt == 'jsonl':
+        for line_no, line in enumerate(text, start=1):
+            if not line.strip():
+                continue
+            try:
+                row = json.loads(line)
+            except ValueError as e:
+                yield line_no, ValueError(f"JSON 格式錯誤: {e}")
+                continue
+            yield line_no, row if isinstance(row, dict) else ValueError("每行必須是一個 JSON 物件")
+    else:
+        raise RecordIngestError(f"不支援的格式: {fmt} (請使用 csv 或 jsonl)")
+
+
+# --- 學生對照表 ---
+STUDENT_LOOKUP_SQL = "SELECT student_id, id_card_number, student_id_number, student_number FROM students"
+
+
+class StudentLookup:
+    """學號 / ID 卡號碼 / 學生證號碼 -> student_id 的記憶體對照表 (一次查詢建立)"""
+
+    def __init__(self, cursor):
+        self.maps = {field: {} for field in STUDENT_KEY_FIELDS}
+        cursor.execute(STUDENT_LOOKUP_SQL)
+        for student_id, *keys in cursor.fetchall():
+            for field, key in zip(STUDENT_KEY_FIELDS, keys):
+                if key:
+                    # 學號只在同一班級內唯一，不同班級重複的學號標記為無法識別
+                    mapping = self.maps[field]
+                    mapping[key] = student_id if mapping.get(key, student_id) == student_id else None
+
+    def resolve(self, row):
+        """返回 student_id；找不到、學號重複或多個識別欄位指向不同學生時拋出 ValueError"""
+        found = set()
+        given = False
+        for field in STUDENT_KEY_FIELDS:
+            key = _clean(row.get(field))
+            if not key:
+                continue
+            given = True
+            if key not in self.maps[field]:
+                raise ValueError(f"找不到 {field} 為 '{key}' 的學生")
+            if self.maps[field][key] is None:
+                raise ValueError(f"{field} '{key}' 對應多個學生，請改用 ID 卡號碼或學生證號碼")
+            found.add(self.maps[field][key])
+        if not given:
+            raise ValueError("缺少學生識別欄位 (student_number、id_card_number 或 student_id_number)")
+        if len(found) > 1:
+            raise ValueError("識別欄位指向不同的學生")
+        return found.pop()
+
+
+# --- 匯入 ---
+def _dedupe_key(spec, student_id, record_date, values):
+    return (student_id, record_date, (values[spec['dedupe']] or '') if spec['dedupe'] else None)
+
+
+def build_dedupe_query(spec, student_ids, date_from, date_to):
+    """去重查詢的語句與參數：一批學生在日期範圍內的記錄鍵 (flask db explain 也使用這個函式)"""
+    type_sql = f", {spec['dedupe']}" if spec['dedupe'] else ""
+    sql = (f"SELECT student_id, {spec['date']}{type_sql} FROM {spec['table']} "
+           f"WHERE student_id IN ({', '.join(['%s'] * len(student_ids))}) AND {spec['date']} BETWEEN %s AND %s")
+    return sql, [*student_ids, date_from, date_to]
+
+
+def _existing_keys(cursor, spec, candidates, chunk_size):
+    """查詢資料庫中與候選記錄相同 (學生, 日期, 類型) 的記錄鍵；每批學生一個查詢，只讀取候選日期範圍內的記錄"""
+    existing = set()
+    student_ids = sorted({student_id for student_id, _, _ in candidates})
+    if not student_ids:
+        return existing
+    dates = [record_date for _, record_date, _ in candidates]
+    for start in range(0, len(student_ids), chunk_size):
+        chunk = student_ids[start:start + chunk_size]
+        cursor.execute(*build_dedupe_query(spec, chunk, min(dates), max(dates)))
+        for student_id, record_date, *record_type in cursor.fetchall():
+            existing.add((student_id, record_date, (record_type[0] or '') if spec['dedupe'] else None))
+    return existing
+
+
+def ingest_records(conn, kind, rows, user_id, chunk_size=None):
+    """
+    匯入一種記錄。rows 為 read_rows() 產生的 (行號, 欄位) 序列，user_id 為記錄者。
+    所有插入與統計更新在一個事務中提交；返回 {'received', 'inserted', 'duplicates', 'errors': [(行號, 訊息), ...]}。
+    """
+    spec = RECORD_KINDS.get(kind)
+    if spec is None:
+        raise RecordIngestError(f"未知的記錄種類: {kind} (可用: {', '.join(RECORD_KINDS)})")
+    chunk_size = chunk_size or config.RECORD_INGEST_CHUNK_SIZE
+    result = {'received': 0, 'inserted': 0, 'duplicates': 0, 'errors': []}
+
+    cursor = conn.cursor()
+    try:
+        students = StudentLookup(cursor)
+
+        # 解析與驗證所有行 (不查詢資料庫)，同一文件中重複的記錄只保留第一筆
+        candidates = {} # 去重鍵 -> (student_id, 日期, 欄位值)
+        for line_no, row in rows:
+            result['received'] += 1
+            try:
+                if isinstance(row, Exception):
+                    raise row
+                student_id = students.resolve(row)
+                record_date = _parse_date(row.get('date'))
+                values = {}
+                for field, parse in spec['fields'].items():
+                    try:
+                        values[field] = parse(row.get(field))
+                    except ValueError as e:
+                        raise ValueError(f"{field} {e}")
+            except ValueError as e:
+                result['errors'].append((line_no, str(e)))
+                continue
+            key = _dedupe_key(spec, student_id, record_date, values)
+            if key in candidates:
+                result['duplicates'] += 1
+            else:
+                candidates[key] = (student_id, record_date, values)
+
+        # 與資料庫中已有的記錄去重
+        existing = _existing_keys(cursor, spec, list(candidates.values()), chunk_size)
+        new_records = [record for key, record in candidates.items() if key not in existing]
+        result['duplicates'] += len(candidates) - len(new_records)
+
+        # 分批插入，計數器與統計摘要的變化按學生加總後一次套用
+        fields = list(spec['fields'])
+        columns = ['student_id', spec['date'], *fields, 'recorded_by_user_id']
+        row_sql = "(" + ", ".join(["%s"] * len(columns)) + ")"
+        changes = {}
+        for start in range(0, len(new_records), chunk_size):
+            chunk = new_records[start:start + chunk_size]
+            cursor.execute(
+                f"INSERT INTO {spec['table']} ({', '.join(columns)}) VALUES {', '.join([row_sql] * len(chunk))}",
+                [value for student_id, record_date, values in chunk
+                 for value in (student_id, record_date, *(values[field] for field in fields), user_id)]
+            )
+        for student_id, record_date, values in new_records:
+            changes.setdefault(student_id, []).append((record_date, spec['deltas'](values)))
+        student_ids = sorted(changes)
+        for start in range(0, len(student_ids), chunk_size):
+            apply_bulk_record_changes(cursor, {student_id: changes[student_id] for student_id in student_ids[start:start + chunk_size]})
+        conn.commit()
+        if kind == 'late_records' and new_records:
+            invalidate_card_index() # 刷卡登記的「今天已遲到」名單需要重新讀取
+        result['inserted'] = len(new_records)
+        return result
+    except mysql.connector.Error:
+        conn.rollback()
+        raise
+    finally:
+        cursor.close()
+
+
+def detect_format(filename=None, content_type=None):
+    """按文件擴展名或 Content-Type 判斷格式，無法判斷時返回 None"""
+    if filename:
+        extension = filename.rsplit('.', 1)[-1].lower() if '.' in filename else ''
+        if extension in ('csv', 'jsonl'):
+            return extension
+        if extension == 'ndjson':
+            return 'jsonl'
+    if content_type:
+        content_type = content_type.split(';')[0].strip().lower()
+        if content_type in ('text/csv', 'application/csv'):
+            return 'csv'
+        if content_type in ('application/x-ndjson', 'application/jsonl', 'application/x-jsonlines', 'application/json-lines'):
+            return 'jsonl'
+    return None
+
+
+# --- flask records 命令 ---
+records_cli = AppGroup('records', help='記錄批量匯入命令')
+
+
+@records_cli.command('ingest')
+@click.argument('kind', type=click.Choice(list(RECORD_KINDS)))
+@click.argument('path', type=click.Path(exists=True, dir_okay=False))
+@click.option('--user', 'username', required=True, help='記錄者的使用者名稱')
+@click.option('--format', 'fmt', type=click.Choice(['csv', 'jsonl']), default=None, help='文件格式 (預設按擴展名判斷)')
+def ingest_command(kind, path, username, fmt):
+    """從 CSV 或 JSON Lines 文件批量匯入記錄"""
+    fmt = fmt or detect_format(path)
+    if fmt is None:
+        raise click.ClickException("無法判斷文件格式，請使用 --format 指定")
+    try:
+        conn = acquire_connection()
+    except mysql.connector.Error as err:
+        raise click.ClickException(f"資料庫錯誤: {err}")
+    try:
+        cursor = conn.cursor()
+        try:
+            cursor.execute("SELECT user_id FROM users WHERE username = %s", (username,))
+            user = cursor.fetchone()
+        finally:
+            cursor.close()
+        if not user:
+            raise click.ClickException(f"找不到使用者: {username}")
+        with open(path, 'rb') as f:
+            result = ingest_records(conn, kind, read_rows(f, fmt), user[0])
+    except (RecordIngestError, UnicodeDecodeError, csv.Error) as e:
+        raise click.ClickException(str(e))
+    except mysql.connector.Error as err:
+        raise click.ClickException(f"資料庫錯誤: {err}")
+    finally:
+        release_connection(conn)
+
+    for line_no, message in result['errors']:
+        click.echo(f"第 {line_no} 行: {message}")
+    click.echo(f"讀取 {result['received']} 行，匯入 {result['inserted']} 筆，重複 {result['duplicates']} 筆，錯誤 {len(result['errors'])} 行")
@@ -6,30 +6,109 @@
 document.addEventListener('DOMContentLoaded', function() {
     console.log('DOM fully loaded and parsed');
 
-    // 範例：處理班級選擇後的動態學生列表載入 (如果使用 AJAX 而非頁面跳轉)
-    // 注意：目前的 Flask 路由設計是通過頁面跳轉來顯示學生列表，
-    // 如果您希望實現無刷新載入，需要修改後端路由以返回 JSON 數據，並在這裡使用 AJAX 處理。
-    const classSelect = document.getElementById('class_id'); // 假設班級選擇框的 ID 是 'class_id'
-    if (classSelect) {
+    // 儀表板的班級學生名單：切換班級時從 students_json 取得名單並在客戶端渲染。
+    // 每個班級的名單與 ETag 保存在記憶體中，再次選擇時以 If-None-Match 重新驗證，名單未改變時伺服器只返回 304。
+    const roster = document.getElementById('class-roster');
+    if (roster) {
+        const field = name => roster.querySelector(`[data-field="${name}"]`);
+        const classSelect = field('class');
+        const rosterCache = {}; // 班級 ID -> {etag, data}
+        let current = null; // 目前顯示的名單 (students_json 的回應)
+        let sortKey = null;
+        let sortDescending = false;
+        const withId = (url, id) => url.replace('/0/', `/${id}/`);
+
+        const showMessage = function(text) {
+            field('message').textContent = text;
+            field('message').classList.toggle('hidden', !text);
+        };
+        const render = function() {
+            const index = Object.fromEntries(current.fields.map((name, i) => [name, i]));
+            const students = current.students.slice();
+            if (sortKey) {
+                const i = index[sortKey];
+                students.sort((a, b) => {
+                    const order = typeof a[i] === 'number'
+                        ? a[i] - b[i]
+                        : String(a[i] || '').localeCompare(String(b[i] || ''), 'zh-Hant', {numeric: true});
+                    return sortDescending ? -order : order;
+                });
+            }
+            field('rows').replaceChildren(...students.map(student => {
+                const row = document.createElement('tr');
+                roster.querySelectorAll('th[data-sort]').forEach(th => {
+                    const td = document.createElement('td');
+                    td.dataset.label = th.dataset.label;
+                    const value = student[index[th.dataset.sort]];
+                    td.textContent = value === null || value === '' ? 'N/A' : value;
+                    row.appendChild(td);
+                });
+                const actions = document.createElement('td');
+                actions.dataset.label = '操作';
+                const link = document.createElement('a');
+                link.href = withId(roster.dataset.recordsUrl, student[index.student_id]);
+                link.className = 'btn btn-secondary btn-sm';
+                link.textContent = '查看記錄';
+                actions.appendChild(link);
+                row.appendChild(actions);
+                return row;
+            }));
+            field('table').classList.toggle('hidden', students.length === 0);
+            showMessage(students.length === 0 ? '該班級目前沒有學生資料。' : '');
+        };
+        const load = function(classId) {
+            const cached = rosterCache[classId];
+            const headers = {'Accept': 'application/json'};
+            if (cached && cached.etag) {
+                headers['If-None-Match'] = cached.etag;
+            }
+            // cache: 'no-store' 讓 304 直接交給這裡處理，不經過瀏覽器的 HTTP 快取
+            fetch(withId(roster.dataset.rosterUrl, classId), {headers: headers, cache: 'no-store'})
+                .then(response => {
+                    if (response.status === 304) {
+                        return cached.data;
+                    }
+                    return response.json().then(data => {
+                        if (!response.ok) {
+                            return Promise.reject(data.error);
+                        }
+                        rosterCache[classId] = {etag: response.headers.get('ETag'), data: data};
+                        return data;
+                    });
+                })
+                .then(data => {
+                    if (classSelect.value !== String(classId)) {
+                        return; // 載入期間已切換到其他班級
+                    }
+                    current = data;
+                    render();
+                })
+                .catch(error => {
+                    field('table').classList.add('hidden');
+                    showMessage(typeof error === 'string' ? error : '獲取學生列表失敗，請稍後再試');
+                    console.error('獲取學生列表失敗:', error);
+                });
+        };
+
         classSelect.addEventListener('change', function() {
-            const selectedClassId = this.value;
-            if (selectedClassId) {
-                // 這裡可以發送 AJAX 請求到後端獲取該班級的學生列表
-                // 範例 (僅為示意，需要後端對應的 JSON 接口):
-                // fetch(`/class/${selectedClassId}/students_json`)
-                //     .then(response => response.json())
-                //     .then(data => {
-                //         // 在前端更新學生列表的 HTML
-                //         console.log('學生列表數據:', data);
-                //         // updateStudentList(data.students); // 調用一個函式來更新頁面上的學生列表
-                //     })
-                //     .catch(error => {
-                //         console.error('獲取學生列表失敗:', error);
-                //     });
-
-                // 目前的實現是通過表單提交或鏈接跳轉，所以這裡可以不做任何事情
-                // 或者如果班級選擇框在一個表單中，提交表單會觸發後端路由
+            const classId = this.value;
+            field('list-link').classList.toggle('hidden', !classId);
+            if (!classId) {
+                field('table').classList.add('hidden');
+                showMessage('');
+                return;
             }
+            field('list-link').href = withId(roster.dataset.listUrl, classId);
+            load(classId);
+        });
+        roster.querySelectorAll('th[data-sort]').forEach(th => {
+            th.addEventListener('click', function() {
+                sortDescending = sortKey === th.dataset.sort ? !sortDescending : false;
+                sortKey = th.dataset.sort;
+                if (current) {
+                    render();
+                }
+            });
         });
     }
 
@@ -103,6 +182,213 @@ document.addEventListener('DOMContentLoaded', function() {
         });
     }
 
+    // CSV 匯入進度：每秒輪詢一次進度 (JSON)，更新頁面直到匯入完成或失敗 (預覽完成時重新載入頁面顯示差異)
+    const importJob = document.getElementById('import-job');
+    if (importJob && !['done', 'failed'].includes(importJob.dataset.status)) {
+        const statusLabels = {pending: '等待中', running: '匯入中', done: '已完成', failed: '失敗'};
+        const field = name => importJob.querySelector(`[data-field="${name}"]`);
+        const poll = function() {
+            fetch(importJob.dataset.progressUrl, {headers: {'Accept': 'application/json'}})
+                .then(response => response.ok ? response.json() : Promise.reject(response.status))
+                .then(job => {
+                    field('bar').style.width = `${job.percent}%`;
+                    field('status').textContent = statusLabels[job.status] || job.status;
+                    ['rows', 'imported', 'updated', 'error_count'].forEach(name => {
+                        field(name).textContent = job[name];
+                    });
+                    if (job.message) {
+                        field('message').textContent = job.message;
+                        field('message').classList.remove('hidden');
+                    }
+                    const errorList = field('errors');
+                    errorList.replaceChildren(...job.errors.map(error => {
+                        const item = document.createElement('li');
+                        item.textContent = error;
+                        return item;
+                    }));
+                    field('errors-container').classList.toggle('hidden', job.errors.length === 0);
+                    if (job.status === 'done' && job.dry_run) {
+                        window.location.reload(); // 預覽完成：重新載入頁面以顯示差異表格
+                    } else if (job.status !== 'done' && job.status !== 'failed') {
+                        setTimeout(poll, 1000);
+                    }
+                })
+                .catch(error => {
+                    console.error('獲取匯入進度失敗:', error);
+                });
+        };
+        setTimeout(poll, 1000);
+    }
+
+    // 刷卡登記遲到：讀卡機輸入卡號後按 Enter，提交後清空輸入框並在列表頂部顯示結果
+    const kiosk = document.getElementById('kiosk-late');
+    if (kiosk) {
+        const field = name => kiosk.querySelector(`[data-field="${name}"]`);
+        const codeInput = field('code');
+        let recorded = 0;
+        const showResult = function(text, className) {
+            const item = document.createElement('li');
+            item.textContent = `${new Date().toLocaleTimeString()} ${text}`;
+            item.className = className;
+            field('results').prepend(item);
+        };
+        field('form').addEventListener('submit', function(event) {
+            event.preventDefault();
+            const code = codeInput.value.trim();
+            codeInput.value = '';
+            codeInput.focus();
+            if (!code) {
+                return;
+            }
+            fetch(kiosk.dataset.scanUrl, {
+                method: 'POST',
+                headers: {'Content-Type': 'application/json', 'Accept': 'application/json',
+                          'X-CSRFToken': kiosk.dataset.csrfToken},
+                body: JSON.stringify({code: code, reason: field('reason').value})
+            })
+                .then(response => response.json().then(data => ({ok: response.ok, data: data})))
+                .then(({ok, data}) => {
+                    if (!ok) {
+                        showResult(`${code}: ${data.error}`, 'text-red-700');
+                    } else if (data.status === 'duplicate') {
+                        showResult(`${data.student.class_name} ${data.student.name}: 今天已登記`, 'text-yellow-700');
+                    } else {
+                        recorded += 1;
+                        field('count').textContent = recorded;
+                        showResult(`${data.student.class_name} ${data.student.name}: 已登記遲到`, 'text-green-700');
+                    }
+                })
+                .catch(error => {
+                    showResult(`${code}: 提交失敗，請重新刷卡`, 'text-red-700');
+                    console.error('刷卡登記失敗:', error);
+                });
+        });
+    }
+
+    // 學生記錄時間線：分頁標籤第一次顯示時才載入記錄 (已載入的標籤保留結果，篩選條件改變時清除)，「載入更多」取得下一頁
+    const timeline = document.getElementById('student-timeline');
+    if (timeline) {
+        const field = name => timeline.querySelector(`[data-field="${name}"]`);
+        const filters = field('filters');
+        const tabs = timeline.querySelectorAll('.timeline-tab');
+        let tabStates = {}; // 類別 -> {records, nextCursor}
+        let activeKind = '';
+
+        const cell = function(label, content) {
+            const td = document.createElement('td');
+            td.dataset.label = label;
+            if (content instanceof Node) {
+                td.appendChild(content);
+            } else {
+                td.textContent = content === null || content === undefined || content === '' ? 'N/A' : content;
+            }
+            return td;
+        };
+        const link = function(href, text, className) {
+            const a = document.createElement('a');
+            a.href = href;
+            a.textContent = text;
+            a.className = className;
+            return a;
+        };
+        const renderRow = function(record) {
+            const row = document.createElement('tr');
+            const content = [record.title, record.detail].filter(Boolean).join('：');
+            const category = record.session_count ? `${record.category} (${record.session_count} 節)` : record.category;
+            const upload = record.upload_url ? link(record.upload_url, '查看證明', 'text-blue-600 hover:underline') : '無';
+            if (record.upload_url) {
+                upload.target = '_blank';
+            }
+            row.append(
+                cell('日期', record.date),
+                cell('記錄', record.kind_label),
+                cell('類型/結果/科目', category),
+                cell('內容', content),
+                cell('證明', upload),
+                cell('記錄人', record.recorder_name),
+                cell('記錄時間', record.recorded_at),
+                cell('操作', record.edit_url ? link(record.edit_url, '修改', 'btn btn-secondary btn-sm') : '無權修改')
+            );
+            return row;
+        };
+        const render = function() {
+            const state = tabStates[activeKind];
+            field('rows').replaceChildren(...state.records.map(renderRow));
+            field('empty').classList.toggle('hidden', state.records.length > 0 || state.loading);
+            field('more').classList.toggle('hidden', !state.nextCursor);
+        };
+        const load = function() {
+            const kind = activeKind;
+            const state = tabStates[kind];
+            const params = new URLSearchParams();
+            new FormData(filters).forEach((value, key) => {
+                if (value) {
+                    params.append(key, value);
+                }
+            });
+            if (kind) {
+                params.set('kind', kind);
+            }
+            if (state.nextCursor) {
+                params.set('after', state.nextCursor);
+            }
+            state.loading = true;
+            field('more').disabled = true;
+            field('message').classList.add('hidden');
+            fetch(`${timeline.dataset.timelineUrl}?${params}`, {headers: {'Accept': 'application/json'}})
+                .then(response => response.json().then(data => ({ok: response.ok, data: data})))
+                .then(({ok, data}) => {
+                    if (tabStates[kind] !== state) {
+                        return; // 載入期間篩選條件已改變
+                    }
+                    state.loading = false;
+                    if (!ok) {
+                        field('message').textContent = data.error;
+                        field('message').classList.remove('hidden');
+                    } else {
+                        state.records = state.records.concat(data.records);
+                        state.nextCursor = data.next_cursor;
+                    }
+                    if (kind === activeKind) {
+                        render();
+                    }
+                })
+                .catch(error => {
+                    state.loading = false;
+                    console.error('獲取學生記錄失敗:', error);
+                })
+                .finally(() => {
+                    field('more').disabled = false;
+                });
+        };
+        const show = function(kind) {
+            activeKind = kind;
+            tabs.forEach(tab => {
+                const active = tab.dataset.kind === kind;
+                tab.classList.toggle('border-blue-500', active);
+                tab.classList.toggle('text-blue-600', active);
+                tab.classList.toggle('border-transparent', !active);
+                tab.classList.toggle('text-gray-600', !active);
+            });
+            if (!tabStates[kind]) {
+                tabStates[kind] = {records: [], nextCursor: null, loading: true};
+                render();
+                load();
+            } else {
+                render();
+            }
+        };
+
+        tabs.forEach(tab => tab.addEventListener('click', () => show(tab.dataset.kind)));
+        field('more').addEventListener('click', load);
+        filters.addEventListener('submit', function(event) {
+            event.preventDefault();
+            tabStates = {};
+            show(activeKind);
+        });
+        show('');
+    }
+
     // 範例：消息閃現自動消失 (可選)
     const flashMessages = document.querySelectorAll('.flash-message');
     flashMessages.forEach(function(message) {
@@ -118,10 +404,6 @@ document.addEventListener('DOMContentLoaded', function() {
 });
 
 // 您可以在這裡添加其他 JavaScript 函式，例如：
-// function updateStudentList(students) {
-//     // 根據獲取的學生數據更新頁面上的學生列表 HTML
-// }
-
 // function previewImage(file) {
 //     // 預覽圖片文件
 // }
@@ -6,7 +6,81 @@ MYSQL_USER = 'admin' # <<<<<< 請將這裡替換為您的 MySQL 使用者名稱
 MYSQL_PASSWORD = 'cdsj' # <<<<<< 請將這裡替換為您的 MySQL 密碼
 MYSQL_DB = 'school_records_db' # <<<<<< 請將這裡替換為您的資料庫名稱 (需要先創建)
 
+# 資料庫連接池設定 (每個工作進程各自擁有一個連接池)
+DB_POOL_SIZE = int(os.environ.get('DB_POOL_SIZE', 5)) # 常駐的閒置連接數量
+DB_POOL_MAX_OVERFLOW = int(os.environ.get('DB_POOL_MAX_OVERFLOW', 10)) # 尖峰時可額外開啟的連接數量
+DB_POOL_TIMEOUT = 10 # 連接全部被借出時，等待可用連接的最長秒數
+DB_POOL_RECYCLE = 3600 # 連接使用超過此秒數後重新建立，避免被 MySQL 的 wait_timeout 斷開
+DB_POOL_PRE_PING = True # 借出閒置連接前先 ping 一次，確認連接仍然有效
+
+# 使用者快取設定 (user_loader 使用，保存在下方的共用快取中；修改使用者時以標籤立即失效)
+USER_CACHE_TTL = 60 # 快取項目的存活秒數
+
+# 共用快取 (app/cache.py 的 shared_cache)：使用者資料、班級學生名單、學生統計摘要與教師的班級權限
+# 多進程部署請使用 'sqlite' 或 'network'，否則修改使用者等失效只影響處理該請求的進程
+# CACHE_BACKEND: 'memory' (每個進程各自一份)、'sqlite' (同一主機上所有進程共用一個文件) 或 'network' (網路快取服務)
+CACHE_BACKEND = os.environ.get('CACHE_BACKEND', 'memory')
+# 'sqlite' 後端的文件路徑 (不設定時為應用程式 instance 文件夾中的 cache.sqlite3)；文件以 0600 權限建立，
+# 內容包含學生資料，不要放在其他使用者可寫入的共用目錄 (例如 /tmp)
+CACHE_SQLITE_PATH = os.environ.get('CACHE_SQLITE_PATH')
+CACHE_SQLITE_MAX_ENTRIES = 20000 # SQLite 文件中最多保存的項目數
+CACHE_MEMORY_SIZE = 4096 # 'memory' 後端每個進程最多保存的項目數
+# 'network' 後端的服務網址：'redis://host:6379/0' (需要安裝 redis 套件)，'local://' 為進程內的替代實現 (開發 / 測試)
+CACHE_NETWORK_URL = os.environ.get('CACHE_NETWORK_URL', 'local://')
+CACHE_DEFAULT_TTL = 600 # 項目的預設存活秒數 (資料變更時由標籤立即失效，TTL 只是上限)
+
+# 管理學生列表每頁顯示的學生數量 (可用查詢參數 per_page 覆蓋，範圍 10-200)
+STUDENTS_PER_PAGE = 50
+
+# 主管查看所有記錄頁面：每頁記錄數，以及長文字欄位 (原因、描述) 在列表中顯示的最大字元數
+SUPERVISOR_RECORDS_PER_PAGE = 100
+RECORD_TEXT_PREVIEW_LENGTH = 80
+
+# 學生記錄頁面的時間線 (五類記錄合併) 每次載入的記錄數
+STUDENT_TIMELINE_PER_PAGE = 50
+
+# CSV 匯出串流設定：每次從伺服器端游標讀取並送出的資料列數
+CSV_EXPORT_CHUNK_SIZE = 500
+
+# 學生 / 使用者 CSV 匯入：每個多行 INSERT (... ON DUPLICATE KEY UPDATE) 語句包含的行數
+CSV_IMPORT_CHUNK_SIZE = 500
+CSV_IMPORT_COMMIT_ROWS = 500 # 每讀取多少行 CSV 寫入並提交一次
+IMPORT_JOB_TTL = 3600 # 匯入完成後保留進度資訊的秒數
+IMPORT_JOB_MAX_ERRORS = 500 # 每個匯入任務最多保留的錯誤訊息數 (仍會計算錯誤總數)
+IMPORT_PREVIEW_PER_PAGE = 100 # 匯入預覽每頁顯示的差異行數
+IMPORT_PREVIEW_TTL = 900 # 未確認的匯入預覽保留暫存文件 (使用者匯入包含明文密碼) 的秒數
+IMPORT_PREVIEW_MAX_DIFF = 5000 # 每個匯入預覽最多保存的差異行數 (仍會計算各動作的總數)
+# 匯入使用者時計算密碼雜湊的進程數 (0 表示使用所有 CPU 核心)
+PASSWORD_HASH_WORKERS = int(os.environ.get('PASSWORD_HASH_WORKERS', 0))
+
+# 資料庫遷移設定
+MIGRATIONS_FOLDER = os.path.join(os.path.dirname(__file__), 'migrations')
+MIGRATION_LOCK_TIMEOUT = 60 # 等待其他進程完成遷移的最長秒數
+MIGRATION_LOCK_WAIT_TIMEOUT = 30 # ALTER TABLE 等待 metadata lock 的最長秒數
+# 應用程式啟動時是否檢查資料庫版本 (多進程部署時可在工作進程中設為 0)
+DB_SCHEMA_CHECK_ON_STARTUP = os.environ.get('DB_SCHEMA_CHECK_ON_STARTUP', '1') == '1'
+
+# 計數器核對 (flask counters reconcile --fix)：每個修正事務鎖定並更新的學生數
+COUNTER_RECONCILE_CHUNK_SIZE = 200
+
+# 記錄批量匯入 (app/record_ingest.py)：每個多行 INSERT 與每個去重查詢包含的行數 / 學生數
+RECORD_INGEST_CHUNK_SIZE = 1000
+# 記錄匯入 API 的 HTTP Basic 認證：同一用戶端位址失敗達到此次數後，在 INGEST_AUTH_LOCKOUT 秒內拒絕認證 (每個工作進程各自計算)
+INGEST_AUTH_MAX_FAILURES = 5
+INGEST_AUTH_LOCKOUT = 300
+
+# 校門刷卡登記遲到 (app/kiosk.py)
+KIOSK_INDEX_TTL = 300 # 卡號索引最多使用多少秒後重新建立 (學生名單變更時會立即失效)
+KIOSK_FLUSH_INTERVAL = 0.5 # 寫入佇列每次收集記錄的最長秒數 (之後一次寫入並提交)
+KIOSK_FLUSH_MAX_ROWS = 200 # 每次寫入的最多記錄數
+KIOSK_WRITE_MAX_ATTEMPTS = 5 # 暫時性資料庫錯誤 (斷線、鎖等待逾時、死鎖) 時每批記錄最多嘗試寫入的次數
+KIOSK_CSRF_TIME_LIMIT = 12 * 3600 # 刷卡頁面的 CSRF token 有效秒數 (刷卡頁面通常整個上午保持開啟)
+
+# 班級目錄 (app/class_catalog.py)：每隔多少秒比較一次資料庫中的班級目錄版本 (其他進程修改班級後最多延遲這麼久)
+CLASS_CATALOG_CHECK_INTERVAL = 30
+
 UPLOAD_FOLDER = os.path.join(os.path.dirname(__file__), 'uploads')
+UPLOAD_CACHE_MAX_AGE = 30 * 24 * 3600 # 上傳的證明文件在瀏覽器中的快取秒數 (文件不會被修改)
 ALLOWED_EXTENSIONS = {'txt', 'pdf', 'png', 'jpg', 'jpeg', 'gif', 'doc', 'docx'}
 
 # 檢查文件擴展名是否允許
@@ -1,21 +1,8 @@
 -- school_records_db 資料庫的 schema
 
--- 創建資料庫 (如果不存在)
-CREATE DATABASE IF NOT EXISTS school_records_db CHARACTER SET utf8mb4 COLLATE utf8mb4_unicode_ci;
-
--- 使用剛創建或已存在的資料庫
-USE school_records_db;
-
--- 刪除現有的表格 (如果存在)，以便重新創建
-DROP TABLE IF EXISTS teacher_classes;
-DROP TABLE IF EXISTS absences;
-DROP TABLE IF EXISTS awards_punishments;
-DROP TABLE IF EXISTS competitions;
-DROP TABLE IF EXISTS late_records;
-DROP TABLE IF EXISTS incomplete_homework_records;
-DROP TABLE IF EXISTS students;
-DROP TABLE IF EXISTS classes;
-DROP TABLE IF EXISTS users;
+-- 遷移 0001：初始資料表
+-- 由 flask db upgrade 執行 (資料庫本身由遷移命令建立，這裡不再包含 CREATE DATABASE / USE / DROP TABLE)
+-- 使用 IF NOT EXISTS / INSERT IGNORE，讓舊版 init_db() 建立的現有資料庫也可以直接標記為版本 1
 
 
 -- 創建 users 表格
@@ -25,7 +12,7 @@ DROP TABLE IF EXISTS users;
 -- role: 使用者角色 (admin, supervisor, teacher)
 -- teacher_name: 教師姓名 (只有教師角色需要)
 -- id_card_number: ID 卡號碼 (可選，唯一)
-CREATE TABLE users (
+CREATE TABLE IF NOT EXISTS users (
     user_id INT AUTO_INCREMENT PRIMARY KEY,
     username VARCHAR(50) UNIQUE NOT NULL,
     password_hash VARCHAR(255) NOT NULL,
@@ -38,7 +25,7 @@ CREATE TABLE users (
 -- 創建 classes 表格
 -- class_id: 班級唯一識別碼 (自動生成數字)
 -- class_name: 班級名稱 (唯一)
-CREATE TABLE classes (
+CREATE TABLE IF NOT EXISTS classes (
     class_id INT AUTO_INCREMENT PRIMARY KEY,
     class_name VARCHAR(10) UNIQUE NOT NULL
 );
@@ -54,7 +41,7 @@ CREATE TABLE classes (
 -- incomplete_homework_count: 欠交功課次數計數
 -- violation_points: 違規點數計數
 -- award_points: 獎勵點數計數
-CREATE TABLE students (
+CREATE TABLE IF NOT EXISTS students (
     student_id INT AUTO_INCREMENT PRIMARY KEY,
     student_number VARCHAR(20),
     name VARCHAR(100) NOT NULL,
@@ -74,7 +61,7 @@ CREATE TABLE students (
 -- 用於記錄教師負責哪些班級 (多對多關係)
 -- user_id: 教師使用者 ID (外鍵參考 users 表格的 user_id)
 -- class_id: 班級 ID (外鍵參考 classes 表格的 class_id)
-CREATE TABLE teacher_classes (
+CREATE TABLE IF NOT EXISTS teacher_classes (
     user_id INT NOT NULL,
     class_id INT NOT NULL,
     PRIMARY KEY (user_id, class_id), -- 複合主鍵
@@ -93,7 +80,7 @@ CREATE TABLE teacher_classes (
 -- upload_path: 證明文件上傳路徑
 -- recorded_at: 記錄時間
 -- recorded_by_user_id: 記錄者使用者 ID (外鍵參考 users 表格的 user_id)
-CREATE TABLE absences (
+CREATE TABLE IF NOT EXISTS absences (
     absence_id INT AUTO_INCREMENT PRIMARY KEY,
     student_id INT NOT NULL,
     absence_date DATE NOT NULL,
@@ -116,7 +103,7 @@ CREATE TABLE absences (
 -- upload_path: 證明文件上傳路徑
 -- recorded_at: 記錄時間
 -- recorded_by_user_id: 記錄者使用者 ID (外鍵參考 users 表格的 user_id)
-CREATE TABLE awards_punishments (
+CREATE TABLE IF NOT EXISTS awards_punishments (
     record_id INT AUTO_INCREMENT PRIMARY KEY,
     student_id INT NOT NULL,
     record_date DATE NOT NULL,
@@ -139,7 +126,7 @@ CREATE TABLE awards_punishments (
 -- upload_path: 證明文件上傳路徑
 -- recorded_at: 記錄時間
 -- recorded_by_user_id: 記錄者使用者 ID (外鍵參考 users 表格的 user_id)
-CREATE TABLE competitions (
+CREATE TABLE IF NOT EXISTS competitions (
     comp_record_id INT AUTO_INCREMENT PRIMARY KEY,
     student_id INT NOT NULL,
     comp_date DATE NOT NULL,
@@ -160,7 +147,7 @@ CREATE TABLE competitions (
 -- reason: 原因
 -- recorded_at: 記錄時間
 -- recorded_by_user_id: 記錄者使用者 ID (外鍵參考 users 表格的 user_id)
-CREATE TABLE late_records (
+CREATE TABLE IF NOT EXISTS late_records (
     late_id INT AUTO_INCREMENT PRIMARY KEY,
     student_id INT NOT NULL, -- Foreign Key to students(student_id)
     late_date DATE NOT NULL,
@@ -179,7 +166,7 @@ CREATE TABLE late_records (
 -- description: 描述/備註
 -- recorded_at: 記錄時間
 -- recorded_by_user_id: 記錄者使用者 ID (外鍵參考 users 表格的 user_id)
-CREATE TABLE incomplete_homework_records (
+CREATE TABLE IF NOT EXISTS incomplete_homework_records (
     incomplete_hw_id INT AUTO_INCREMENT PRIMARY KEY,
     student_id INT NOT NULL, -- Foreign Key to students(student_id)
     record_date DATE NOT NULL,
@@ -195,4 +182,4 @@ CREATE TABLE incomplete_homework_records (
 -- 密碼 'admin_password' 的雜湊值，請替換為您自己生成的雜湊值
 -- 您可以使用 Flask 的 generate_password_hash('您的密碼') 來生成
 -- 這裡使用一個示例雜湊值，您需要替換它
-INSERT INTO users (username, password_hash, role, teacher_name, id_card_number) VALUES ('admin','scrypt:32768:8:1$3joQ2X38l7UYcYW4$fd38948c8a94fa823cb887c02b6aa5f07772d5750d9f1a9ff1f5f73eedf40aa098593dc6cc74a67100a6a1e3b90652a8dc20504676882e223213b93b9b6a1a52', 'admin', NULL, NULL);
+INSERT IGNORE INTO users (username, password_hash, role, teacher_name, id_card_number) VALUES ('admin','scrypt:32768:8:1$3joQ2X38l7UYcYW4$fd38948c8a94fa823cb887c02b6aa5f07772d5750d9f1a9ff1f5f73eedf40aa098593dc6cc74a67100a6a1e3b90652a8dc20504676882e223213b93b9b6a1a52', 'admin', NULL, NULL);
@@ -0,0 +1,9 @@
+-- 遷移 0006：incomplete_homework_records (欠交功課記錄) 的複合索引
+-- (student_id, record_date, recorded_at)：學生記錄頁面按學生篩選並按日期降序排列，避免 filesort
+-- (record_date, recorded_at)：主管查看所有記錄頁面按日期降序的鍵集分頁 (InnoDB 二級索引隱含主鍵，可涵蓋 id 排序)
+-- 複合索引的最左前綴 (student_id) 同時可供外鍵約束使用
+-- 線上執行：ALGORITHM=INPLACE, LOCK=NONE，建立索引期間表格仍可讀寫
+ALTER TABLE incomplete_homework_records
+    ADD INDEX idx_incomplete_homework_records_student_date (student_id, record_date, recorded_at),
+    ADD INDEX idx_incomplete_homework_records_date (record_date, recorded_at),
+    ALGORITHM=INPLACE, LOCK=NONE;
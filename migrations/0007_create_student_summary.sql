@@ -0,0 +1,60 @@
+-- 遷移 0007：學生統計摘要表 student_summary
+-- 每個學生每個學期一行 (term 例如 '2024-1' 為 2024-25 學年上學期，'2024-2' 為下學期)，
+-- 另有 term = 'all' 的一行為全部學期的合計。由記錄寫入路徑 (app.models.apply_record_changes) 增量維護。
+-- 獎懲點數與學期劃分規則與 app/models.py 中的 AWARD_POINTS、VIOLATION_POINTS、term_for_date() 相同。
+CREATE TABLE IF NOT EXISTS student_summary (
+    student_id INT NOT NULL,
+    term VARCHAR(10) NOT NULL,
+    absence_sessions INT NOT NULL DEFAULT 0,
+    late_count INT NOT NULL DEFAULT 0,
+    incomplete_homework_count INT NOT NULL DEFAULT 0,
+    violation_points INT NOT NULL DEFAULT 0,
+    award_points INT NOT NULL DEFAULT 0,
+    ap_commendation INT NOT NULL DEFAULT 0,
+    ap_merit INT NOT NULL DEFAULT 0,
+    ap_minor_merit INT NOT NULL DEFAULT 0,
+    ap_major_merit INT NOT NULL DEFAULT 0,
+    ap_warning INT NOT NULL DEFAULT 0,
+    ap_demerit INT NOT NULL DEFAULT 0,
+    ap_minor_demerit INT NOT NULL DEFAULT 0,
+    ap_major_demerit INT NOT NULL DEFAULT 0,
+    comp_participated INT NOT NULL DEFAULT 0,
+    comp_finalist INT NOT NULL DEFAULT 0,
+    comp_awarded INT NOT NULL DEFAULT 0,
+    updated_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP ON UPDATE CURRENT_TIMESTAMP,
+    PRIMARY KEY (student_id, term),
+    FOREIGN KEY (student_id) REFERENCES students(student_id) ON DELETE CASCADE -- 學生刪除時，刪除其摘要
+);
+
+-- 從現有記錄回填 (可以安全地重新執行)
+-- WITH ROLLUP 產生的小計行 (term 為 NULL) 即全部學期的合計
+DELETE FROM student_summary;
+
+INSERT INTO student_summary (student_id, term, absence_sessions, late_count, incomplete_homework_count, violation_points, award_points, ap_commendation, ap_merit, ap_minor_merit, ap_major_merit, ap_warning, ap_demerit, ap_minor_demerit, ap_major_demerit, comp_participated, comp_finalist, comp_awarded)
+SELECT student_id, COALESCE(term, 'all'), absence_sessions, late_count, incomplete_homework_count, violation_points, award_points, ap_commendation, ap_merit, ap_minor_merit, ap_major_merit, ap_warning, ap_demerit, ap_minor_demerit, ap_major_demerit, comp_participated, comp_finalist, comp_awarded
+FROM (
+    SELECT student_id, term, SUM(absence_sessions) AS absence_sessions, SUM(late_count) AS late_count, SUM(incomplete_homework_count) AS incomplete_homework_count, SUM(violation_points) AS violation_points, SUM(award_points) AS award_points, SUM(ap_commendation) AS ap_commendation, SUM(ap_merit) AS ap_merit, SUM(ap_minor_merit) AS ap_minor_merit, SUM(ap_major_merit) AS ap_major_merit, SUM(ap_warning) AS ap_warning, SUM(ap_demerit) AS ap_demerit, SUM(ap_minor_demerit) AS ap_minor_demerit, SUM(ap_major_demerit) AS ap_major_demerit, SUM(comp_participated) AS comp_participated, SUM(comp_finalist) AS comp_finalist, SUM(comp_awarded) AS comp_awarded
+    FROM (
+        SELECT student_id, CASE WHEN MONTH(absence_date) >= 9 THEN CONCAT(YEAR(absence_date), '-1') WHEN MONTH(absence_date) < 2 THEN CONCAT(YEAR(absence_date) - 1, '-1') ELSE CONCAT(YEAR(absence_date) - 1, '-2') END AS term,
+               session_count AS absence_sessions, 0 AS late_count, 0 AS incomplete_homework_count, 0 AS violation_points, 0 AS award_points, 0 AS ap_commendation, 0 AS ap_merit, 0 AS ap_minor_merit, 0 AS ap_major_merit, 0 AS ap_warning, 0 AS ap_demerit, 0 AS ap_minor_demerit, 0 AS ap_major_demerit, 0 AS comp_participated, 0 AS comp_finalist, 0 AS comp_awarded
+        FROM absences
+        UNION ALL
+        SELECT student_id, CASE WHEN MONTH(record_date) >= 9 THEN CONCAT(YEAR(record_date), '-1') WHEN MONTH(record_date) < 2 THEN CONCAT(YEAR(record_date) - 1, '-1') ELSE CONCAT(YEAR(record_date) - 1, '-2') END AS term,
+               0, 0, 0, CASE type WHEN '缺點' THEN 1 WHEN '小過' THEN 3 WHEN '大過' THEN 9 ELSE 0 END, CASE type WHEN '優點' THEN 1 WHEN '小功' THEN 3 WHEN '大功' THEN 9 ELSE 0 END, type = '表揚', type = '優點', type = '小功', type = '大功', type = '警告', type = '缺點', type = '小過', type = '大過', 0, 0, 0
+        FROM awards_punishments
+        UNION ALL
+        SELECT student_id, CASE WHEN MONTH(comp_date) >= 9 THEN CONCAT(YEAR(comp_date), '-1') WHEN MONTH(comp_date) < 2 THEN CONCAT(YEAR(comp_date) - 1, '-1') ELSE CONCAT(YEAR(comp_date) - 1, '-2') END AS term,
+               0, 0, 0, 0, 0, 0, 0, 0, 0, 0, 0, 0, 0, result = '參與', result = '入圍', result = '得獎'
+        FROM competitions
+        UNION ALL
+        SELECT student_id, CASE WHEN MONTH(late_date) >= 9 THEN CONCAT(YEAR(late_date), '-1') WHEN MONTH(late_date) < 2 THEN CONCAT(YEAR(late_date) - 1, '-1') ELSE CONCAT(YEAR(late_date) - 1, '-2') END AS term,
+               0, 1, 0, 0, 0, 0, 0, 0, 0, 0, 0, 0, 0, 0, 0, 0
+        FROM late_records
+        UNION ALL
+        SELECT student_id, CASE WHEN MONTH(record_date) >= 9 THEN CONCAT(YEAR(record_date), '-1') WHEN MONTH(record_date) < 2 THEN CONCAT(YEAR(record_date) - 1, '-1') ELSE CONCAT(YEAR(record_date) - 1, '-2') END AS term,
+               0, 0, 1, 0, 0, 0, 0, 0, 0, 0, 0, 0, 0, 0, 0, 0
+        FROM incomplete_homework_records
+    ) contributions
+    GROUP BY student_id, term WITH ROLLUP
+) totals
+WHERE student_id IS NOT NULL;
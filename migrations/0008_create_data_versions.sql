@@ -0,0 +1,13 @@
+-- 遷移 0008：資料版本表 data_versions
+-- 每個學生 (scope = 'student')、每個班級 ('class') 一行，另有班級列表 ('classes', 0) 與使用者資料 ('users', 0) 各一行；
+-- 全校頁面以所有班級版本的合計為版本 (見 app/http_cache.py 的 read_data_versions)，不使用全校共用的一行，避免每個寫入事務都鎖住同一行。
+-- 寫入路徑在同一事務中以 app.models.bump_data_versions() 遞增 version；
+-- 讀取頁面以 (version, updated_at) 組成 ETag / Last-Modified，資料未改變時返回 304 (見 app/http_cache.py)。
+-- 沒有行的範圍視為版本 0，因此不需要回填。
+CREATE TABLE IF NOT EXISTS data_versions (
+    scope VARCHAR(10) NOT NULL,
+    scope_id INT NOT NULL,
+    version BIGINT NOT NULL DEFAULT 1,
+    updated_at TIMESTAMP NOT NULL DEFAULT CURRENT_TIMESTAMP ON UPDATE CURRENT_TIMESTAMP,
+    PRIMARY KEY (scope, scope_id)
+);
@@ -0,0 +1,27 @@
+-- 遷移 0009：五類記錄表的 recorded_at 改為 NOT NULL
+-- 學生記錄頁面與主管查看所有記錄頁面以 (日期, recorded_at, id) 做鍵集分頁，並把 recorded_at 格式化到游標與 JSON 中；
+-- recorded_at 為 NULL 的行會令格式化失敗 (500)，而 "recorded_at < %s" 的鍵集條件也會跳過這些行。
+-- 不在查詢中使用 COALESCE(recorded_at, ...)，因為排序欄位變成表達式後無法使用 0002-0006 的複合索引 (會出現 filesort)。
+-- 先把現有的 NULL 回填為記錄日期當天 00:00:00 (可以安全地重新執行)，再修改欄位定義。
+-- 線上執行：ALGORITHM=INPLACE, LOCK=NONE，重建表格期間仍可讀寫 (需要嚴格 SQL 模式，MySQL 8 預設即是)
+UPDATE absences SET recorded_at = TIMESTAMP(absence_date) WHERE recorded_at IS NULL;
+UPDATE awards_punishments SET recorded_at = TIMESTAMP(record_date) WHERE recorded_at IS NULL;
+UPDATE competitions SET recorded_at = TIMESTAMP(comp_date) WHERE recorded_at IS NULL;
+UPDATE late_records SET recorded_at = TIMESTAMP(late_date) WHERE recorded_at IS NULL;
+UPDATE incomplete_homework_records SET recorded_at = TIMESTAMP(record_date) WHERE recorded_at IS NULL;
+
+ALTER TABLE absences
+    MODIFY recorded_at TIMESTAMP NOT NULL DEFAULT CURRENT_TIMESTAMP,
+    ALGORITHM=INPLACE, LOCK=NONE;
+ALTER TABLE awards_punishments
+    MODIFY recorded_at TIMESTAMP NOT NULL DEFAULT CURRENT_TIMESTAMP,
+    ALGORITHM=INPLACE, LOCK=NONE;
+ALTER TABLE competitions
+    MODIFY recorded_at TIMESTAMP NOT NULL DEFAULT CURRENT_TIMESTAMP,
+    ALGORITHM=INPLACE, LOCK=NONE;
+ALTER TABLE late_records
+    MODIFY recorded_at TIMESTAMP NOT NULL DEFAULT CURRENT_TIMESTAMP,
+    ALGORITHM=INPLACE, LOCK=NONE;
+ALTER TABLE incomplete_homework_records
+    MODIFY recorded_at TIMESTAMP NOT NULL DEFAULT CURRENT_TIMESTAMP,
+    ALGORITHM=INPLACE, LOCK=NONE;
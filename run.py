@@ -2,11 +2,15 @@ import os
 from app import create_app
 
 from config import UPLOAD_FOLDER
-app = create_app()
 
-if not os.path.exists(UPLOAD_FOLDER):
-    os.makedirs(UPLOAD_FOLDER)
-    print(f"Created upload folder: {UPLOAD_FOLDER}")
+# 匯入使用者時的密碼雜湊進程池 (app/hashing.py) 會以 __mp_main__ 名稱重新導入這個腳本，
+# 子進程中不建立應用程式 (不建立連接池、不檢查資料庫版本)
+if __name__ != '__mp_main__':
+    app = create_app()
+
+    if not os.path.exists(UPLOAD_FOLDER):
+        os.makedirs(UPLOAD_FOLDER)
+        print(f"Created upload folder: {UPLOAD_FOLDER}")
 
 # 如果直接運行此腳本，則啟動開發伺服器
 if __name__ == '__main__':